@@ -1,20 +1,52 @@
 # =========================
 # Imports and Configuration
 # =========================
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+import time
+STARTED = time.time()  # for the startup timings below
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, g
+from flask import before_render_template, template_rendered
 import requests
 import os
 import json
-import pyrebase
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
-from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 import firebase_admin
-from firebase_admin import credentials, auth, db
+import firebase_admin.auth
+import firebase_admin.exceptions
 import sys
+import threading
 import uuid
+import hashlib
+import hmac
+import ipaddress
+import math
 import jinja2
+from markupsafe import Markup
+from werkzeug.middleware.proxy_fix import ProxyFix
+import itertools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, TimeoutError as FutureTimeoutError
+from yelp_client import YelpClient, UpstreamBudgetExceeded, YELP_API_BASE
+from upstream import budget_from_env, PRIORITIES
+from breaker import CircuitOpenError, breaker_from_env, STATES, CLOSED
+from cache import ResponseCache, backend_from_env, FRESH, STALE
+from ratelimit import KeyedRateLimiter
+from geo_index import GeoIndex
+from featured import FeaturedLists
+from fragments import FragmentCache, content_hash
+from prewarm import AccessStore, AccessTracker, Prewarmer
+from review_queue import ReviewQueue
+from models import Restaurant, Review
+from token_cache import VerifiedTokenCache
+import storage
+import clients
+from clients import CLIENTS
+from local_auth import LocalAuth
+import logs
+from metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from wishlists import valid_business_id, is_legacy, to_wishlist_map, wishlist_ids
+from review_stats import STATS_ROOT, add_rating, stats_from_reviews, dinewise_average, combined_rating
 
 # =========================
 # Flask App Initialization
@@ -24,59 +56,1018 @@ app = Flask(__name__)
 app.config['TEMPLATES_AUTO_RELOAD'] = True
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "dev")
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=1)
+# Behind a reverse proxy (nginx, a load balancer) set TRUSTED_PROXY_COUNT to
+# the number of proxies in front of the app, so request.remote_addr is the
+# client's address from X-Forwarded-For rather than the proxy's.
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', '0'))
+if TRUSTED_PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=TRUSTED_PROXY_COUNT)
 
 # =========================
-# Firebase Admin SDK Initialization
+# Firebase Clients
 # =========================
-try:
-    cred = credentials.Certificate('dinewise-1ade0-firebase-adminsdk-fbsvc-826e342dd1.json')
-    firebase_admin.initialize_app(cred, {
-        'databaseURL': os.getenv('FIREBASE_DATABASE_URL', 'https://your-project-id.firebaseio.com')
-    })
-    print("✅ Firebase Admin SDK initialized successfully")
-except Exception as e:
-    print(f"❌ Firebase Admin SDK Error: {str(e)}")
+# The Admin SDK app and the Pyrebase client are initialised on first use by
+# the shared registry in clients.py, in each worker process.
+# Users, reviews, wishlists and aggregates; Firebase unless DINEWISE_STORAGE=local
+db = storage.database()
 
-# =========================
-# Pyrebase Client Initialization
-# =========================
-try:
-    with open('firebase_config.json', 'r') as f:
-        firebase_config = json.load(f)
-    firebase = pyrebase.initialize_app(firebase_config)
-    auth = firebase.auth()
-    print("✅ Firebase client initialized successfully from config file")
-except Exception as e:
-    print(f"❌ Firebase client initialization error: {str(e)}")
-    firebase = None
-    auth = None
+# Load tests against local storage sign in without Firebase (see local_auth.py).
+local_auth = None
+if os.getenv('DINEWISE_LOCAL_AUTH') == '1':
+    if storage.is_local():
+        local_auth = LocalAuth(app.secret_key)
+        print("⚠️ Local auth enabled: any email/password signs in. Never use this in production.")
+    else:
+        print("❌ DINEWISE_LOCAL_AUTH requires DINEWISE_STORAGE=local; ignoring it")
+
+# Pyrebase auth (or the local stand-in); None if it could not be initialised.
+def auth_client():
+    return local_auth or clients.pyrebase_auth()
 
 # =========================
 # API Keys and Global Variables
 # =========================
 YELP_API_KEY = os.getenv('YELP_API_KEY')
-YELP_ENDPOINT = 'https://api.yelp.com/v3/businesses'
+YELP_ENDPOINT = f'{YELP_API_BASE}/businesses'
 GOOGLE_MAPS_API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
-HEADERS = {'Authorization': f'Bearer {YELP_API_KEY}'}
 
 if not YELP_API_KEY:
     print("WARNING: YELP_API_KEY not found in environment variables!")
 
 reviews = {}
 wishlists = {}
-users = {
-    'test@example.com': {
-        'id': '1',
-        'name': 'Test User',
-        'email': 'test@example.com',
-        'password': generate_password_hash('password123')
+
+# Shared keep-alive client; every Yelp call in this module goes through it.
+yelp = YelpClient(YELP_API_KEY)
+# One call budget for every worker (see upstream.py): background and
+# autocomplete calls are shed before the ones a visitor is waiting for.
+yelp_budget = budget_from_env()
+yelp.limiter = yelp_budget
+
+# =========================
+# Upstream Circuit Breakers
+# =========================
+# After YELP_BREAKER_THRESHOLD / FIREBASE_BREAKER_THRESHOLD failures in a row
+# (a Yelp call slower than YELP_BREAKER_SLOW_CALL counts as one) calls to
+# that upstream fail at once for *_BREAKER_RESET seconds instead of holding
+# a thread each; pages fall back to the last good copies in the caches
+# below and say they may be out of date. See breaker.py.
+# Only errors that mean Firebase itself is unreachable or failing count; a
+# rejected query or an aborted transaction shows it is up.
+FIREBASE_OUTAGE_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                          firebase_admin.exceptions.UnavailableError,
+                          firebase_admin.exceptions.DeadlineExceededError,
+                          firebase_admin.exceptions.InternalError,
+                          firebase_admin.exceptions.UnknownError)
+
+yelp_breaker = breaker_from_env('yelp', 'YELP', slow_call_s=5.0)
+yelp.breaker = yelp_breaker
+storage_breaker = breaker_from_env(db.name, 'FIREBASE',
+                                   is_failure=lambda error: isinstance(error, FIREBASE_OUTAGE_ERRORS))
+db.breaker = storage_breaker
+BREAKERS = (yelp_breaker, storage_breaker)
+
+# Retry-After (seconds) for a 503 sent while a breaker is open.
+def retry_after(breaker):
+    return str(max(1, int(breaker.stats()['retry_in_s'])))
+
+# =========================
+# Yelp Response Caches
+# =========================
+# Per-business details and reviews, keyed by business id. Stale entries are
+# served while a background refresh runs. Set YELP_CACHE_DB to a SQLite
+# path to share entries between workers on the same host. Entries are kept
+# YELP_CACHE_FALLBACK_TTL longer still and served when Yelp can't be reached
+# or the call budget is used up.
+YELP_DETAILS_TTL = int(os.getenv('YELP_DETAILS_TTL', '3600'))
+YELP_REVIEWS_TTL = int(os.getenv('YELP_REVIEWS_TTL', '1800'))
+YELP_CACHE_STALE_TTL = int(os.getenv('YELP_CACHE_STALE_TTL', '600'))
+YELP_CACHE_MAX_ENTRIES = int(os.getenv('YELP_CACHE_MAX_ENTRIES', '2000'))
+YELP_CACHE_MAX_BYTES = int(os.getenv('YELP_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+YELP_CACHE_FALLBACK_TTL = int(os.getenv('YELP_CACHE_FALLBACK_TTL', '86400'))
+
+cache_backend = backend_from_env()
+business_cache = ResponseCache('business', ttl=YELP_DETAILS_TTL, stale_ttl=YELP_CACHE_STALE_TTL,
+                               max_entries=YELP_CACHE_MAX_ENTRIES, max_bytes=YELP_CACHE_MAX_BYTES,
+                               backend=cache_backend, fallback_ttl=YELP_CACHE_FALLBACK_TTL,
+                               decode=Restaurant.from_yelp)
+reviews_cache = ResponseCache('reviews', ttl=YELP_REVIEWS_TTL, stale_ttl=YELP_CACHE_STALE_TTL,
+                              max_entries=YELP_CACHE_MAX_ENTRIES, max_bytes=YELP_CACHE_MAX_BYTES,
+                              backend=cache_backend, fallback_ttl=YELP_CACHE_FALLBACK_TTL,
+                              decode=lambda yelp_reviews: [Review.from_yelp(review) for review in yelp_reviews])
+# Ids Yelp has no business for (closed, removed or made up) are remembered
+# for YELP_NOT_FOUND_TTL seconds, so asking again doesn't cost another call.
+YELP_NOT_FOUND_TTL = int(os.getenv('YELP_NOT_FOUND_TTL', '600'))
+missing_businesses = ResponseCache('business_missing', ttl=YELP_NOT_FOUND_TTL, max_entries=YELP_CACHE_MAX_ENTRIES,
+                                   max_bytes=4 * 1024 * 1024, backend=cache_backend)
+
+def known_missing(business_id):
+    return missing_businesses.get(business_id)[1] is not None
+
+# The *_from_response helpers take a requests or httpx response, so the
+# async prefetch in asgi.py stores exactly what the sync fetchers would.
+# Only the compact models (models.py) are kept, never the raw JSON.
+def business_from_response(business_id, response):
+    logs.debug('yelp_business', business_id=business_id, status=response.status_code)
+    if response.status_code == 200:
+        business = Restaurant.from_yelp(response.json())
+        geo_index.add(business)
+        return business
+    logs.warning('yelp_business_error', business_id=business_id, status=response.status_code,
+                 body=response.text[:200])
+    # Yelp failing is an error rather than "no such business", so callers
+    # (and get_businesses' statuses) can tell the two apart.
+    if response.status_code >= 500 or response.status_code == 429:
+        response.raise_for_status()
+    missing_businesses.set(business_id, True)
+    return None
+
+def fetch_business(business_id):
+    if known_missing(business_id):
+        return None
+    return business_from_response(business_id, yelp.business(business_id))
+
+def reviews_from_response(business_id, response):
+    logs.debug('yelp_reviews', business_id=business_id, status=response.status_code)
+    if response.status_code == 200:
+        return [Review.from_yelp(review) for review in response.json().get('reviews', [])]
+    logs.warning('yelp_reviews_error', business_id=business_id, status=response.status_code,
+                 body=response.text[:200])
+    return None
+
+def fetch_business_reviews(business_id):
+    return reviews_from_response(business_id, yelp.reviews(business_id))
+
+# Search results warm this cache with partial records (no hours etc.).
+# Pages that need the full document pass full=True to skip those.
+def get_business(business_id, full=False):
+    accept = (lambda business: not business.partial) if full else None
+    return business_cache.get_or_load(business_id, lambda: fetch_business(business_id), accept=accept)
+
+def get_business_reviews(business_id):
+    return reviews_cache.get_or_load(business_id, lambda: fetch_business_reviews(business_id))
+
+# =========================
+# Hot Restaurant Prewarming
+# =========================
+# Detail and wishlist views count visits per business; the prewarmer keeps
+# the most visited ones' details and reviews fresh (see prewarm.py). It runs
+# here with PREWARM_MODE=inprocess, or as `python prewarm.py`, which shares
+# counts and entries through YELP_CACHE_DB.
+PREWARM_MODE = os.getenv('PREWARM_MODE', 'off')
+PREWARM_DB = os.getenv('PREWARM_DB', os.getenv('YELP_CACHE_DB'))
+
+access_tracker = AccessTracker(half_life=int(os.getenv('PREWARM_HALF_LIFE', '3600')),
+                               store=AccessStore(PREWARM_DB) if PREWARM_DB else None)
+prewarmer = Prewarmer(
+    access_tracker,
+    targets=[('business', business_cache, fetch_business, lambda business: not business.partial),
+             ('reviews', reviews_cache, fetch_business_reviews, None)],
+    top_k=int(os.getenv('PREWARM_TOP_K', '200')),
+    lead=int(os.getenv('PREWARM_LEAD', '300')),
+    rps=float(os.getenv('PREWARM_RPS', '1')),
+    daily_limit=int(os.getenv('PREWARM_DAILY_LIMIT', '2000')),
+    quota=yelp_budget.quota,
+    quota_reserve=float(os.getenv('PREWARM_QUOTA_RESERVE', '0.25')),
+)
+# Started by the first request (see start_background_workers), so a
+# preloading server runs it in each worker rather than only in the parent.
+if PREWARM_MODE == 'inprocess':
+    print(f"🔥 Prewarming the top {prewarmer.top_k} restaurants in-process")
+
+# =========================
+# Local Geospatial Index
+# =========================
+# Lat/lng nearby searches are answered from every business seen in Yelp
+# responses; Yelp is only asked when part of the search circle is cold.
+NEARBY_RADIUS_M = int(os.getenv('NEARBY_RADIUS_M', '2000'))
+NEARBY_RESULTS = 20
+geo_index = GeoIndex(cell_degrees=float(os.getenv('GEO_CELL_DEGREES', '0.005')),
+                     coverage_ttl=int(os.getenv('GEO_COVERAGE_TTL', str(6 * 3600))),
+                     max_businesses=int(os.getenv('GEO_INDEX_MAX_BUSINESSES', '200000')))
+
+# Cold areas are fetched with a wider radius so that searches from nearby
+# points afterwards fall entirely inside covered cells.
+NEARBY_PREFETCH_FACTOR = float(os.getenv('NEARBY_PREFETCH_FACTOR', '2'))
+# An area only counts as covered once every business Yelp matched in it is
+# in the index. A search page holds at most YELP_PAGE_SIZE of them, best
+# matches rather than nearest first, so busier areas are paged through (up
+# to NEARBY_MAX_PAGES pages) or searched again over a smaller circle.
+NEARBY_MAX_PAGES = int(os.getenv('NEARBY_MAX_PAGES', '4'))
+YELP_MAX_RADIUS_M = 40000
+YELP_PAGE_SIZE = 50
+
+def nearby_search_params(latitude, longitude, radius_m=NEARBY_RADIUS_M):
+    return {
+        'latitude': round(latitude, 4),
+        'longitude': round(longitude, 4),
+        'radius': int(min(radius_m * NEARBY_PREFETCH_FACTOR, YELP_MAX_RADIUS_M)),
+        'term': 'restaurants',
+        'limit': YELP_PAGE_SIZE,
+    }
+
+# Returns (complete, total): whether every match was fetched, and how many
+# Yelp has. Areas with more than NEARBY_MAX_PAGES pages stop after the first;
+# the other pages are fetched together once the first gives the total.
+def fetch_nearby_area(params):
+    page = search_yelp(params)
+    total = page['total']
+    if total > NEARBY_MAX_PAGES * YELP_PAGE_SIZE:
+        return False, total
+    first = len(page['businesses'])
+    offsets = range(first, total, YELP_PAGE_SIZE) if first else ()
+    pages = yelp_executor.map(lambda offset: search_yelp(dict(params, offset=offset)), offsets)
+    fetched = first + sum(len(more['businesses']) for more in pages)
+    return fetched >= total, total
+
+# Yelp's nearest matches, for areas too dense to index whole.
+def nearest_businesses(latitude, longitude, radius_m, limit):
+    params = nearby_search_params(latitude, longitude, radius_m)
+    return search_businesses(dict(params, radius=radius_m, sort_by='distance', limit=limit))
+
+def nearby_businesses(latitude, longitude, radius_m=NEARBY_RADIUS_M, limit=NEARBY_RESULTS):
+    if not geo_index.is_covered(latitude, longitude, radius_m):
+        if geo_index.is_dense(latitude, longitude):
+            return nearest_businesses(latitude, longitude, radius_m, limit)
+        params = nearby_search_params(latitude, longitude, radius_m)
+        complete, total = fetch_nearby_area(params)
+        if not complete and params['radius'] > radius_m:
+            # Matches grow with the area: aim for a circle whose matches fit.
+            fitting = params['radius'] * math.sqrt(NEARBY_MAX_PAGES * YELP_PAGE_SIZE / total)
+            params['radius'] = int(max(radius_m, fitting))
+            complete, total = fetch_nearby_area(params)
+        if complete:
+            geo_index.mark_covered(latitude, longitude, params['radius'])
+        else:
+            # Too dense to index whole; let Yelp pick the nearest, here and
+            # for searches starting close by until coverage_ttl passes.
+            logs.info('nearby_area_incomplete', radius_m=params['radius'], total=total)
+            geo_index.mark_dense(latitude, longitude, radius_m)
+            return nearest_businesses(latitude, longitude, radius_m, limit)
+    return [business for distance, business in geo_index.nearby(latitude, longitude, radius_m, limit)]
+
+# =========================
+# Search Result Cache
+# =========================
+# Identical searches within SEARCH_CACHE_TTL share one Yelp call, and
+# concurrent identical searches are coalesced into a single request.
+SEARCH_CACHE_TTL = int(os.getenv('SEARCH_CACHE_TTL', '120'))
+SEARCH_CACHE_STALE_TTL = int(os.getenv('SEARCH_CACHE_STALE_TTL', '60'))
+search_cache = ResponseCache('search', ttl=SEARCH_CACHE_TTL, stale_ttl=SEARCH_CACHE_STALE_TTL,
+                             max_entries=int(os.getenv('SEARCH_CACHE_MAX_ENTRIES', '500')),
+                             max_bytes=YELP_CACHE_MAX_BYTES, backend=cache_backend,
+                             fallback_ttl=YELP_CACHE_FALLBACK_TTL,
+                             decode=lambda page: dict(page, businesses=[Restaurant.from_yelp(business)
+                                                                        for business in page['businesses']]))
+
+def normalize_search_params(params):
+    normalized = {}
+    for key, value in params.items():
+        if value is None or value == '':
+            continue
+        if isinstance(value, str):
+            value = ' '.join(value.lower().split())
+            if key == 'price':
+                value = ','.join(sorted(part.strip() for part in value.split(',') if part.strip()))
+        normalized[key] = value
+    return normalized
+
+def search_cache_key(params):
+    return json.dumps(sorted(params.items()), separators=(',', ':'))
+
+def warm_business_cache(businesses):
+    for business in businesses:
+        if business.id:
+            business_cache.set_if_absent(business.id, business.as_partial())
+    geo_index.add_many(businesses)
+
+def search_from_response(response):
+    if response.status_code != 200:
+        logs.warning('yelp_search_error', status=response.status_code, body=response.text[:200])
+    response.raise_for_status()
+    data = response.json()
+    businesses = [Restaurant.from_yelp(business) for business in data.get('businesses', [])]
+    warm_business_cache(businesses)
+    return {'businesses': businesses, 'total': data.get('total', len(businesses))}
+
+def fetch_search(params):
+    return search_from_response(yelp.search(params))
+
+# Returns {'businesses': [...], 'total': n} for the (normalised) parameters.
+def search_yelp(params):
+    params = normalize_search_params(params)
+    return search_cache.get_or_load(search_cache_key(params), lambda: fetch_search(params))
+
+def search_businesses(params):
+    return search_yelp(params)['businesses']
+
+# Home page search form; None when no location was given.
+def search_form_params(form):
+    location = form.get('location')
+    if not location:
+        return None
+    term = form.get('term', '')
+    price = form.get('price', '')
+    cuisine = form.get('cuisine', '')
+    search_term = term
+    if cuisine and not term:
+        search_term = cuisine
+    elif cuisine and term:
+        search_term = f"{term} {cuisine}"
+    params = {
+        'location': location,
+        'term': search_term,
+        'limit': 20,
+    }
+    if price:
+        params['price'] = price
+    return params
+
+# Nearby page address form; None without a city or zip code.
+def nearby_form_params(form):
+    if not form.get('city', '') and not form.get('zipcode', ''):
+        return None
+    location_parts = [form.get(field, '') for field in ('address', 'city', 'state', 'zipcode')]
+    location_parts.append(form.get('country', 'USA'))
+    return {
+        'location': ", ".join(part for part in location_parts if part),
+        'term': 'restaurants',
+        'limit': 20,
+    }
+
+# Form coordinates as (latitude, longitude), or None when missing or out of range.
+def form_coordinates(form):
+    try:
+        latitude = float(form.get('latitude') or 'nan')
+        longitude = float(form.get('longitude') or 'nan')
+    except ValueError:
+        return None
+    if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+        return latitude, longitude
+    return None
+
+# =========================
+# Featured Restaurants
+# =========================
+FEATURED_COUNT = 6
+FEATURED_MIN_REVIEWS = 20
+FEATURED_DEFAULT_LOCATIONS = [loc.strip() for loc in
+                              os.getenv('FEATURED_LOCATIONS', 'San Francisco, CA').split(';') if loc.strip()]
+# Only what the home page and explore cards render.
+CARD_FIELDS = ('id', 'name', 'image_url', 'rating', 'review_count', 'price')
+
+def restaurant_card(business):
+    card = {field: getattr(business, field) for field in CARD_FIELDS}
+    card['categories'] = [{'title': category.title} for category in business.categories]
+    card['location'] = {'address1': business.location.address1,
+                        'city': business.location.city,
+                        'display_address': list(business.location.display_address)}
+    return card
+
+def load_featured(location):
+    businesses = search_businesses({'location': location, 'term': 'restaurants',
+                                    'sort_by': 'rating', 'limit': 20})
+    well_reviewed = [b for b in businesses if b.review_count >= FEATURED_MIN_REVIEWS]
+    ranked = sorted(well_reviewed or businesses,
+                    key=lambda b: (b.rating or 0, b.review_count), reverse=True)
+    return [restaurant_card(business) for business in ranked[:FEATURED_COUNT]]
+
+FEATURED_MAX_AGE = 300
+featured_lists = FeaturedLists(load_featured,
+                               refresh_interval=int(os.getenv('FEATURED_REFRESH_INTERVAL', '900')),
+                               default_locations=FEATURED_DEFAULT_LOCATIONS)
+
+# Serves precomputed JSON with validators so browsers and the CDN can revalidate.
+def cached_json_response(body, etag, last_modified=None, max_age=60):
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    if last_modified:
+        response.headers['Last-Modified'] = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+# =========================
+# Concurrent Yelp Fan-out
+# =========================
+# One shared pool bounds how many Yelp lookups run at once across requests.
+YELP_FANOUT_WORKERS = int(os.getenv('YELP_FANOUT_WORKERS', '8'))
+WISHLIST_DEADLINE = float(os.getenv('WISHLIST_DEADLINE', '8'))
+yelp_executor = ThreadPoolExecutor(max_workers=YELP_FANOUT_WORKERS, thread_name_prefix='yelp')
+# Firebase reads get their own pool so a busy Yelp fan-out cannot starve them.
+FIREBASE_WORKERS = int(os.getenv('FIREBASE_WORKERS', '4'))
+DETAIL_SOURCE_TIMEOUT = float(os.getenv('DETAIL_SOURCE_TIMEOUT', '5'))
+firebase_executor = ThreadPoolExecutor(max_workers=FIREBASE_WORKERS, thread_name_prefix='firebase')
+# Multi-restaurant lookups (wishlist, /api/restaurants) have a pool of their
+# own, and each call works through its misses YELP_BATCH_CONCURRENCY at a
+# time, so a request for many ids can't hold every thread.
+YELP_BATCH_WORKERS = int(os.getenv('YELP_BATCH_WORKERS', '16'))
+YELP_BATCH_CONCURRENCY = int(os.getenv('YELP_BATCH_CONCURRENCY', '8'))
+batch_executor = ThreadPoolExecutor(max_workers=YELP_BATCH_WORKERS, thread_name_prefix='yelp-batch')
+
+# =========================
+# Last-Known-Good Firebase Reads
+# =========================
+# The wishlist and the detail page's reviews and rating aggregates are still
+# read from Firebase every time; the last good answer of each is kept (in
+# this process) for FIREBASE_FALLBACK_TTL seconds and served when a read
+# fails, e.g. while the storage breaker is open. read() must not return None.
+FIREBASE_FALLBACK_TTL = int(os.getenv('FIREBASE_FALLBACK_TTL', '3600'))
+firebase_reads = ResponseCache('firebase_reads', ttl=0, fallback_ttl=FIREBASE_FALLBACK_TTL,
+                               max_entries=int(os.getenv('FIREBASE_FALLBACK_MAX_ENTRIES', '5000')),
+                               max_bytes=16 * 1024 * 1024)
+
+def read_last_known_good(key, read):
+    return firebase_reads.get_or_load(key, read)
+
+# =========================
+# Batch Restaurant Lookup
+# =========================
+# Many businesses in one call, for the wishlist and /api/restaurants. Ids
+# are deduplicated, cached ones (and ones Yelp recently had no business
+# for) are answered straight away, and only the misses go to Yelp on the
+# batch pool, YELP_BATCH_CONCURRENCY at a time, until the deadline.
+# Returns [(business_id, restaurant or None, status)] in request order,
+# status being one of BATCH_STATUSES:
+#   fresh      cached and current, or just fetched
+#   stale      an older copy (refreshing in the background, or kept because Yelp failed)
+#   not_found  Yelp has no such business
+#   timeout    not back before the deadline
+#   error      the lookup failed and nothing cached could stand in
+BATCH_STATUSES = ('fresh', 'stale', 'not_found', 'timeout', 'error')
+
+def get_businesses(business_ids, deadline=WISHLIST_DEADLINE, full=False):
+    accept = (lambda business: not business.partial) if full else None
+    results = {}
+    misses = deque()
+    for business_id in dict.fromkeys(business_ids):
+        loader = lambda business_id=business_id: fetch_business(business_id)
+        cached, state = business_cache.lookup(business_id, loader, accept)
+        if state is not None:
+            results[business_id] = (cached, state)
+        elif cached is None and known_missing(business_id):
+            results[business_id] = (None, 'not_found')
+        else:
+            misses.append((business_id, loader, cached))
+    if misses:
+        miss_ids = [business_id for business_id, loader, cached in misses]
+        loaded = {}
+
+        def load_misses():
+            while True:
+                try:
+                    business_id, loader, cached = misses.popleft()
+                except IndexError:
+                    return
+                try:
+                    loaded[business_id] = business_cache.load_or_fallback(business_id, loader, cached)
+                except Exception as e:
+                    loaded[business_id] = e
+
+        workers = [batch_executor.submit(load_misses) for _ in range(min(len(misses), YELP_BATCH_CONCURRENCY))]
+        wait(workers, timeout=deadline)
+        # Whatever hasn't started by the deadline is dropped.
+        misses.clear()
+        for worker in workers:
+            worker.cancel()
+        for business_id in miss_ids:
+            outcome = loaded.get(business_id)
+            if business_id not in loaded:
+                logs.warning('business_fetch_timeout', business_id=business_id, deadline_s=deadline)
+                results[business_id] = (None, 'timeout')
+            elif isinstance(outcome, Exception):
+                logs.warning('business_fetch_failed', business_id=business_id, error=outcome)
+                results[business_id] = (None, 'error')
+            else:
+                restaurant, state = outcome
+                results[business_id] = (restaurant, state or 'not_found')
+    return [(business_id,) + results[business_id] for business_id in business_ids]
+
+# Waits for one source until the shared deadline; failures come back as None.
+def join_source(future, deadline, label):
+    try:
+        return future.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FutureTimeoutError:
+        future.cancel()
+        logs.warning('source_timeout', source=label)
+    except Exception as e:
+        logs.warning('source_failed', source=label, error=e)
+    return None
+
+# =========================
+# Autocomplete Cache and Rate Limiting
+# =========================
+# Coordinates are snapped to a grid cell so nearby users share entries, and a
+# cached shorter prefix ("piz") can answer a longer one ("pizz") while the
+# exact answer is fetched in the background.
+AUTOCOMPLETE_TTL = int(os.getenv('AUTOCOMPLETE_TTL', '3600'))
+AUTOCOMPLETE_GRID = float(os.getenv('AUTOCOMPLETE_GRID', '0.05'))
+AUTOCOMPLETE_RATE = float(os.getenv('AUTOCOMPLETE_RATE', '5'))
+AUTOCOMPLETE_BURST = int(os.getenv('AUTOCOMPLETE_BURST', '10'))
+AUTOCOMPLETE_WAIT = float(os.getenv('AUTOCOMPLETE_WAIT', '3'))
+AUTOCOMPLETE_MAX_CLIENTS = 10000
+
+autocomplete_cache = ResponseCache('autocomplete', ttl=AUTOCOMPLETE_TTL, stale_ttl=AUTOCOMPLETE_TTL,
+                                   max_entries=5000, max_bytes=8 * 1024 * 1024, backend=cache_backend)
+autocomplete_limiter = KeyedRateLimiter(AUTOCOMPLETE_RATE, AUTOCOMPLETE_BURST,
+                                        max_keys=AUTOCOMPLETE_MAX_CLIENTS)
+autocomplete_latest = OrderedDict()
+autocomplete_latest_lock = threading.Lock()
+autocomplete_sequence = itertools.count(1)
+# Under asgi.py the limiter check and request sequence are taken before the
+# async Yelp call and handed to the view as (allowed, sequence, outcome) in
+# the environ; outcome is 'superseded' or 'timeout' if the prefetch stopped
+# waiting for Yelp, and None otherwise.
+AUTOCOMPLETE_PREFETCH_KEY = 'dinewise.autocomplete'
+
+def autocomplete_cell(location):
+    latitude, longitude = (float(part) for part in location.split(','))
+    row, col = round(latitude / AUTOCOMPLETE_GRID), round(longitude / AUTOCOMPLETE_GRID)
+    return f'{row}:{col}', round(row * AUTOCOMPLETE_GRID, 5), round(col * AUTOCOMPLETE_GRID, 5)
+
+def autocomplete_from_response(response):
+    response.raise_for_status()
+    return response.json().get('terms', [])
+
+def fetch_autocomplete(params):
+    return autocomplete_from_response(yelp.autocomplete(params))
+
+def autocomplete_params(term, latitude, longitude):
+    return {
+        'text': term,
+        'latitude': latitude,
+        'longitude': longitude,
+        'limit': 5
     }
-}
+
+def autocomplete_prefix_seed(cell_key, term):
+    for end in range(len(term) - 1, 0, -1):
+        terms = autocomplete_cache.peek(f'{cell_key}|{term[:end]}')
+        if terms is not None:
+            return [t for t in terms if t.get('text', '').lower().startswith(term)]
+    return []
+
+# Rate-limit key: the session's client_id, or the address when a request
+# arrives without one, as a client that drops the session cookie would
+# otherwise get a new id, and a full token bucket, on every request. Without
+# TRUSTED_PROXY_COUNT behind a proxy every such request shares one address.
+def autocomplete_client_key(client_id, remote_addr):
+    return f'session:{client_id}' if client_id else f'addr:{remote_addr}'
+
+# Each new request from a client supersedes that client's older ones. Only
+# sessions are tracked: clients sharing an address are different people.
+def start_autocomplete_request(client_id):
+    sequence = next(autocomplete_sequence)
+    with autocomplete_latest_lock:
+        autocomplete_latest[client_id] = sequence
+        autocomplete_latest.move_to_end(client_id)
+        while len(autocomplete_latest) > AUTOCOMPLETE_MAX_CLIENTS:
+            autocomplete_latest.popitem(last=False)
+    return sequence
+
+def autocomplete_superseded(client_id, sequence):
+    with autocomplete_latest_lock:
+        return autocomplete_latest.get(client_id, sequence) != sequence
+
+# =========================
+# Review Rating Aggregates
+# =========================
+# ratings is {review_id: rating} for reviews just written. A business whose
+# reviews predate aggregates has none yet, so its first one starts from the
+# reviews already stored rather than from zero.
+def update_review_stats(business_id, ratings):
+    existing = []
+
+    def add_ratings(current):
+        if current is None:
+            if not existing:
+                reviews = db.reference(f'reviews/{business_id}').get() or {}
+                existing.append(stats_from_reviews({review_id: review for review_id, review in reviews.items()
+                                                    if review_id not in ratings}))
+            current = existing[0]
+        for rating in ratings.values():
+            current = add_rating(current, rating)
+        return current
+
+    try:
+        db.reference(f'{STATS_ROOT}/{business_id}').transaction(add_ratings)
+    except Exception as e:
+        # The review itself is saved; backfill_review_stats.py repairs the aggregate.
+        logs.error('review_stats_update_failed', business_id=business_id, error=e)
+
+# Businesses reviewed before aggregates existed (and not since) get theirs
+# written on first view. This is the one time the whole review subtree is
+# downloaded; if that read fails the page shows no DineWise aggregate.
+def seed_review_stats(business_id):
+    try:
+        stats = stats_from_reviews(db.reference(f'reviews/{business_id}').get() or {})
+    except Exception as e:
+        logs.warning('review_stats_seed_failed', business_id=business_id, error=e)
+        return None
+    try:
+        db.reference(f'{STATS_ROOT}/{business_id}').transaction(lambda current: current or stats)
+    except Exception as e:
+        logs.error('review_stats_seed_failed', business_id=business_id, error=e)
+    return stats
+
+# =========================
+# Review Write Queue
+# =========================
+# add_review journals new reviews to REVIEW_QUEUE_DIR and a background
+# thread writes them in batches (see review_queue.py), so a slow or failing
+# database neither holds up nor fails the request. Until a review is
+# written its id stays in the author's session, and the author's detail
+# page shows it from the journal. REVIEW_QUEUE_DIR= (empty) writes reviews
+# inside the request instead.
+REVIEW_QUEUE_DIR = os.getenv('REVIEW_QUEUE_DIR', 'review_queue')
+PENDING_REVIEWS_MAX = 20
+
+# One multi-path update for all the batch's reviews, then one aggregate
+# update per business. Rewriting a review id is harmless; a replayed batch
+# can count its ratings twice, which backfill_review_stats.py repairs.
+def write_reviews(entries):
+    db.reference('/').update({f"reviews/{entry['business_id']}/{entry['id']}": entry['review']
+                              for entry in entries})
+    ratings = {}
+    for entry in entries:
+        ratings.setdefault(entry['business_id'], {})[entry['id']] = entry['review']['rating']
+    for business_id, business_ratings in ratings.items():
+        update_review_stats(business_id, business_ratings)
+        fragment_cache.invalidate(business_id)
+
+review_queue = None
+if REVIEW_QUEUE_DIR:
+    try:
+        review_queue = ReviewQueue(REVIEW_QUEUE_DIR, write_reviews,
+                                   batch_size=int(os.getenv('REVIEW_QUEUE_BATCH', '50')),
+                                   flush_interval=float(os.getenv('REVIEW_QUEUE_INTERVAL', '1')),
+                                   max_backoff=float(os.getenv('REVIEW_QUEUE_MAX_BACKOFF', '60')))
+    except OSError as e:
+        print(f"❌ Could not open the review queue in {REVIEW_QUEUE_DIR}: {e}")
+
+# False when the review has to be written directly instead.
+def queue_review(business_id, review_id, review):
+    if review_queue is None:
+        return False
+    try:
+        review_queue.submit(business_id, review_id, review)
+    except OSError as e:
+        logs.error('review_queue_append_failed', business_id=business_id, error=e)
+        return False
+    pending = dict(session.get('pending_reviews') or {})
+    pending[review_id] = business_id
+    session['pending_reviews'] = dict(list(pending.items())[-PENDING_REVIEWS_MAX:])
+    return True
+
+# The author's still-queued reviews of this business that loaded_reviews
+# doesn't already include, newest first.
+def pending_reviews_for(business_id, loaded_reviews):
+    pending = session.get('pending_reviews')
+    if not pending or review_queue is None:
+        return []
+    found = review_queue.find(list(pending))
+    if len(found) < len(pending):
+        session['pending_reviews'] = {review_id: pending_business_id for review_id, pending_business_id
+                                      in pending.items() if review_id in found}
+    loaded = {(review.get('user_id'), review.get('timestamp')) for review in loaded_reviews}
+    queued = [dict(entry['review'], pending=True) for entry in found.values()
+              if entry['business_id'] == business_id
+              and (entry['review'].get('user_id'), entry['review'].get('timestamp')) not in loaded]
+    return sorted(queued, key=lambda review: review.get('timestamp', ''), reverse=True)
+
+# =========================
+# Wishlist Storage
+# =========================
+# users/{uid}/wishlist is a map {business_id: added_at}; see wishlists.py.
+# Single adds and removes touch only their own child, bulk changes go out as
+# one multi-path update. Old array wishlists are converted the first time
+# their owner reads or changes them (or by migrate_wishlists.py).
+WISHLIST_BULK_LIMIT = 100
+# Ids already read by asgi.py while it prefetched the wishlist's restaurants.
+WISHLIST_PREFETCH_KEY = 'dinewise.wishlist_ids'
+
+def wishlist_ref(user_id):
+    return db.reference(f'users/{user_id}/wishlist')
+
+def migrate_wishlist(user_id):
+    migrated_at = datetime.now()
+    return wishlist_ref(user_id).transaction(lambda current: to_wishlist_map(current, migrated_at) or None)
+
+def load_wishlist(user_id):
+    return read_last_known_good(f'wishlist/{user_id}', lambda: read_wishlist(user_id))
+
+def read_wishlist(user_id):
+    return wishlist_ids(read_wishlist_map(user_id))
+
+# The stored wishlist, converted first if it is still an array.
+def read_wishlist_map(user_id):
+    raw = wishlist_ref(user_id).get()
+    if is_legacy(raw):
+        raw = migrate_wishlist(user_id)
+    return raw
+
+# Returns True if the item was added, False if it was already there.
+def add_wishlist_item(user_id, business_id):
+    # An item saved as an array element has no child of its own to find.
+    read_wishlist_map(user_id)
+    added_at = datetime.now().isoformat()
+    added = [False]
+
+    def add(current):
+        added[0] = current is None
+        return current if current is not None else added_at
+
+    wishlist_ref(user_id).child(business_id).transaction(add)
+    return added[0]
+
+# Returns True if the item was removed, False if it was not in the wishlist.
+def remove_wishlist_item(user_id, business_id, migrate=True):
+    removed = [False]
+
+    def remove(current):
+        removed[0] = current is not None
+        return None
+
+    wishlist_ref(user_id).child(business_id).transaction(remove)
+    if not removed[0] and migrate and is_legacy(wishlist_ref(user_id).get()):
+        migrate_wishlist(user_id)
+        return remove_wishlist_item(user_id, business_id, migrate=False)
+    return removed[0]
+
+# Adding an item that is already saved moves it to the top of the wishlist.
+# Returns (added, removed): removed leaves out ids that were not saved.
+def update_wishlist(user_id, add=(), remove=()):
+    saved = set(wishlist_ids(read_wishlist_map(user_id)))
+    added_at = datetime.now().isoformat()
+    removed = sorted(set(remove) & saved)
+    changes = {business_id: added_at for business_id in add}
+    changes.update({business_id: None for business_id in removed})
+    if changes:
+        wishlist_ref(user_id).update(changes)
+    return sorted(set(add)), removed
+
+# =========================
+# Paginated User Reviews
+# =========================
+# Reviews are read newest first in pages keyed by (timestamp, review_id), using
+# the reviews/$business_id ".indexOn": ["timestamp"] rule from init_db.py.
+REVIEWS_PAGE_SIZE = int(os.getenv('REVIEWS_PAGE_SIZE', '10'))
+REVIEWS_MAX_PAGE_SIZE = 50
+PUBLIC_REVIEW_FIELDS = ('user_name', 'rating', 'comment', 'timestamp')
+
+def encode_review_cursor(review_id, review):
+    return f"{review.get('timestamp', '')}|{review_id}"
+
+def decode_review_cursor(cursor):
+    timestamp, _, review_id = (cursor or '').rpartition('|')
+    if not timestamp or not review_id:
+        raise ValueError("Invalid review cursor")
+    return timestamp, review_id
+
+def fetch_review_page(business_id, limit, cursor=None):
+    before = decode_review_cursor(cursor) if cursor else None
+    fetch = limit + 1
+    while True:
+        query = db.reference(f'reviews/{business_id}').order_by_child('timestamp')
+        if before:
+            query = query.end_at(before[0])
+        data = query.limit_to_last(fetch).get() or {}
+        items = [(review_id, review) for review_id, review in data.items()
+                 if not before or (review.get('timestamp', ''), review_id) < before]
+        # Reviews sharing the cursor's timestamp are filtered out above, so
+        # widen the window until a full page (plus one) is left or data runs out.
+        if len(items) > limit or len(data) < fetch:
+            break
+        fetch *= 2
+    items.sort(key=lambda item: (item[1].get('timestamp', ''), item[0]), reverse=True)
+    page = items[:limit]
+    next_cursor = encode_review_cursor(*page[-1]) if len(items) > limit else None
+    return [review for review_id, review in page], next_cursor
+
+def load_first_review_page(business_id):
+    try:
+        return fetch_review_page(business_id, REVIEWS_PAGE_SIZE)
+    except Exception as e:
+        # Most likely the timestamp index rule has not been deployed yet.
+        logs.warning('review_page_query_failed', business_id=business_id, error=e,
+                     hint='run init_db.py to add the index rules')
+        reviews_data = db.reference(f'reviews/{business_id}').get() or {}
+        user_reviews = sorted(reviews_data.values(), key=lambda x: x.get('timestamp', ''), reverse=True)
+        return user_reviews, None
+
+# =========================
+# Template Fragment Cache
+# =========================
+# {{ fragment('fragments/x.html', scope=business_id, **context) }} renders a
+# partial once per distinct context and reuses the HTML. Fragments only see
+# what is passed in (no session, request or flashes), so they are the same
+# for every visitor; per-user variants are explicit arguments such as
+# show_wishlist. add_review drops a business's fragments via its scope.
+fragment_cache = FragmentCache(max_entries=int(os.getenv('FRAGMENT_CACHE_MAX_ENTRIES', '5000')),
+                               max_bytes=int(os.getenv('FRAGMENT_CACHE_MAX_BYTES', str(16 * 1024 * 1024))))
+
+@app.template_global()
+def fragment(template_name, scope=None, **context):
+    template = app.jinja_env.get_template(template_name)
+    key = (template_name, scope, content_hash(context, g.setdefault('fragment_hashes', {})))
+    html = fragment_cache.get(key, template)
+    if html is None:
+        html = template.render(context)
+        fragment_cache.set(key, template, html, scope)
+    return Markup(html)
+
+# =========================
+# Request Metrics
+# =========================
+# Timings for whole requests, every Yelp call, every storage operation and
+# every template render, exported at /metrics in Prometheus text format.
+REQUEST_SECONDS = REGISTRY.histogram('dinewise_request_duration_seconds',
+                                     'Time spent handling a request', ('route', 'method', 'status'))
+YELP_SECONDS = REGISTRY.histogram('dinewise_yelp_request_duration_seconds',
+                                  'Time spent on one Yelp API call, including retries', ('endpoint', 'status'))
+STORAGE_SECONDS = REGISTRY.histogram('dinewise_storage_operation_duration_seconds',
+                                     'Time spent on one storage operation', ('backend', 'operation', 'outcome'))
+PREWARM_LAG_SECONDS = REGISTRY.histogram('dinewise_prewarm_refresh_lag_seconds',
+                                         'How long after falling due a hot entry was refreshed',
+                                         buckets=(0.1, 1, 5, 15, 30, 60, 120, 300, 600, 1800))
+TEMPLATE_SECONDS = REGISTRY.histogram('dinewise_template_render_duration_seconds',
+                                      'Time spent rendering a template', ('template',))
+
+prewarmer.observer = PREWARM_LAG_SECONDS.observe
+yelp.observer = lambda endpoint, seconds, status, error: YELP_SECONDS.observe(
+    seconds, endpoint, str(status) if status is not None else 'error')
+db.observer = lambda backend, operation, seconds, error: STORAGE_SECONDS.observe(
+    seconds, backend, operation, 'error' if error else 'ok')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - started, request.endpoint or 'unmatched',
+                                request.method, str(response.status_code))
+    return response
+
+# =========================
+# Startup Timings
+# =========================
+# How long importing this module took, and how long each process took from
+# starting (or, for a worker forked from a preloaded parent, from the fork)
+# to its first response. STARTUP_TARGET_SECONDS is the cold-start budget;
+# going over it is logged with the import and client init times.
+STARTUP_TARGET_SECONDS = float(os.getenv('STARTUP_TARGET_SECONDS', '1.0'))
+STARTUP = {'started': STARTED, 'import_s': None, 'first_response_s': None}
+STARTUP_SECONDS = REGISTRY.histogram('dinewise_startup_seconds', 'Time from start (or fork) to each startup milestone',
+                                     ('phase',), buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30))
+
+def reset_startup_after_fork():
+    STARTUP.update(started=time.time(), first_response_s=None)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_startup_after_fork)
+
+@app.before_request
+def start_background_workers():
+    if PREWARM_MODE == 'inprocess':
+        prewarmer.start()
+
+@app.after_request
+def record_first_response(response):
+    if STARTUP['first_response_s'] is None:
+        elapsed = STARTUP['first_response_s'] = time.time() - STARTUP['started']
+        STARTUP_SECONDS.observe(elapsed, 'first_response')
+        if elapsed > STARTUP_TARGET_SECONDS:
+            logs.warning('slow_first_response', seconds=round(elapsed, 3), target_s=STARTUP_TARGET_SECONDS,
+                         import_s=round(STARTUP['import_s'] or 0, 3),
+                         client_init_ms=round(sum(CLIENTS.init_seconds.values()) * 1000))
+    return response
+
+# While a breaker isn't closed, pages may be showing last-known-good copies;
+# base.html says so.
+@app.context_processor
+def upstream_status():
+    return {'degraded_upstreams': [breaker.name for breaker in BREAKERS if breaker.state != CLOSED]}
+
+def start_template_timer(sender, template, context, **extra):
+    g.setdefault('template_started', []).append(time.perf_counter())
+
+def record_template_time(sender, template, context, **extra):
+    starts = g.get('template_started')
+    if starts:
+        TEMPLATE_SECONDS.observe(time.perf_counter() - starts.pop(), template.name or 'string')
+
+before_render_template.connect(start_template_timer, app)
+template_rendered.connect(record_template_time, app)
+
+CACHE_COUNTERS = ('hits', 'stale_hits', 'misses', 'backend_hits', 'evictions', 'refreshes',
+                  'refresh_errors', 'refreshes_dropped', 'fallback_hits', 'coalesced')
+
+# Turns the existing stats() counters into samples at scrape time.
+def collect_app_stats():
+    caches = (business_cache, reviews_cache, search_cache, autocomplete_cache, firebase_reads,
+              missing_businesses)
+    cache_stats = [(cache.name, cache.stats()) for cache in caches]
+    token_stats = token_cache.stats()
+    geo_stats = geo_index.stats()
+    fragment_stats = fragment_cache.stats()
+    prewarm_stats = prewarmer.stats()
+    budget_stats = yelp_budget.stats()
+    queue_stats = review_queue.stats() if review_queue is not None else None
+    breaker_stats = [(breaker.name, breaker.stats()) for breaker in BREAKERS]
+    return [
+        ('dinewise_cache_events_total', 'counter', 'Response cache lookups and maintenance by outcome',
+         [({'cache': name, 'event': event}, stats.get(event, 0))
+          for name, stats in cache_stats for event in CACHE_COUNTERS]),
+        ('dinewise_cache_entries', 'gauge', 'Entries held by each response cache',
+         [({'cache': name}, stats['entries']) for name, stats in cache_stats]),
+        ('dinewise_cache_bytes', 'gauge', 'Approximate bytes held by each response cache',
+         [({'cache': name}, stats['bytes']) for name, stats in cache_stats]),
+        ('dinewise_token_verifications_total', 'counter', 'ID token checks by whether Firebase verified them',
+         [({'result': 'skipped'}, token_stats['skipped_verifications']),
+          ({'result': 'verified'}, token_stats['verifications'])]),
+        ('dinewise_autocomplete_rate_limited_total', 'counter', 'Autocomplete requests rejected by the rate limiter',
+         [({}, autocomplete_limiter.rejected)]),
+        ('dinewise_geo_index_businesses', 'gauge', 'Businesses in the nearby-search index',
+         [({}, geo_stats['businesses'])]),
+        ('dinewise_fragment_cache_events_total', 'counter', 'Rendered fragment lookups and invalidations',
+         [({'event': event}, fragment_stats[event]) for event in ('hits', 'misses', 'invalidations')]),
+        ('dinewise_prewarm_queue_depth', 'gauge', 'Hot entries waiting to be refreshed',
+         [({}, prewarm_stats['queue_depth'])]),
+        ('dinewise_prewarm_backlog_age_seconds', 'gauge', 'How long the most overdue queued entry has waited',
+         [({}, prewarm_stats['backlog_age_s'])]),
+        ('dinewise_prewarm_events_total', 'counter', 'Prewarm refreshes by outcome',
+         [({'event': event}, prewarm_stats[event]) for event in ('refreshed', 'failed', 'quota_pauses')]),
+        ('dinewise_fragment_cache_bytes', 'gauge', 'Bytes of rendered HTML held by the fragment cache',
+         [({}, fragment_stats['bytes'])]),
+        ('dinewise_yelp_budget_calls_total', 'counter', 'Yelp calls let through or shed by the shared budget',
+         [({'priority': priority, 'outcome': outcome}, budget_stats[outcome][priority])
+          for priority in PRIORITIES for outcome in ('granted', 'shed')]),
+        ('dinewise_yelp_budget_tokens', 'gauge', 'Per-second Yelp call tokens currently available',
+         [({}, budget_stats['tokens'])]),
+        ('dinewise_yelp_quota_remaining', 'gauge', "Yelp's remaining daily call quota, as last reported",
+         [({}, budget_stats['quota']['remaining'])] if 'remaining' in budget_stats['quota'] else []),
+        ('dinewise_review_queue_pending', 'gauge', 'Reviews journaled but not yet written to storage',
+         [({}, queue_stats['pending'])] if queue_stats else []),
+        ('dinewise_review_queue_oldest_age_seconds', 'gauge', 'How long the oldest queued review has waited',
+         [({}, queue_stats['oldest_age_s'])] if queue_stats else []),
+        ('dinewise_circuit_state', 'gauge', 'Upstream circuit breaker state (1 for the current one)',
+         [({'upstream': name, 'state': state}, int(stats['state'] == state))
+          for name, stats in breaker_stats for state in STATES]),
+        ('dinewise_circuit_events_total', 'counter', 'Upstream calls failed, slow or rejected by an open breaker, and times opened',
+         [({'upstream': name, 'event': event}, stats[event])
+          for name, stats in breaker_stats for event in ('failures', 'slow_calls', 'rejected', 'opened')]),
+        ('dinewise_firebase_client_init_seconds', 'gauge', 'Time spent initialising each lazily built Firebase client',
+         [({'client': name}, seconds) for name, seconds in CLIENTS.init_seconds.items()]),
+        ('dinewise_review_queue_events_total', 'counter', 'Review queue writes, failed flushes and adopted entries',
+         [({'event': event}, queue_stats[event]) for event in ('written', 'failures', 'adopted')]
+         if queue_stats else []),
+    ]
+
+REGISTRY.add_collector(collect_app_stats)
+
+# =========================
+# Verified Token Cache
+# =========================
+# login_required used to verify the session's ID token on every request.
+# Tokens that already verified are now trusted until their own expiry.
+TOKEN_CERT_URI = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+
+# Fetches through the verifier's own HTTP-cached session, so this only goes
+# to the network once Google's Cache-Control max-age has run out.
+def refresh_signing_certs():
+    verifier = firebase_admin.auth._get_client(clients.firebase_app())._token_verifier
+    verifier.request(TOKEN_CERT_URI)
+
+def verify_firebase_token(id_token, check_revoked=False):
+    return firebase_admin.auth.verify_id_token(id_token, app=clients.firebase_app(), check_revoked=check_revoked)
+
+verify_id_token = local_auth.verify_id_token if local_auth else verify_firebase_token
+
+token_cache = VerifiedTokenCache(
+    verify_id_token,
+    max_entries=int(os.getenv('TOKEN_CACHE_MAX_ENTRIES', '10000')),
+    cert_refresher=None if local_auth else refresh_signing_certs,
+    cert_refresh_interval=int(os.getenv('TOKEN_CERT_REFRESH_INTERVAL', '600')),
+)
+
+# Routes where a revoked token or disabled account must be noticed
+# immediately can use @login_required(check_revoked=True); those always
+# verify against Firebase and skip the cache.
+def verify_session_token(id_token, check_revoked=False):
+    if check_revoked:
+        return verify_id_token(id_token, check_revoked=True)
+    return token_cache.verify(id_token)
 
 # =========================
 # Login Required Decorator
 # =========================
-def login_required(f):
+def login_required(f=None, check_revoked=False):
+    if f is None:
+        return lambda view: login_required(view, check_revoked=check_revoked)
+
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'user' not in session:
@@ -86,38 +1077,39 @@ def login_required(f):
             user = session.get('user')
             id_token = user.get('idToken')
             if not id_token:
-                print("❌ No idToken found in session user data.")
+                logs.warning('session_missing_id_token')
                 session.clear()
                 flash('Your session data is incomplete. Please log in again.', 'error')
                 return redirect(url_for('login'))
             try:
-                decoded_token = firebase_admin.auth.verify_id_token(id_token)
+                decoded_token = verify_session_token(id_token, check_revoked)
             except firebase_admin.auth.ExpiredIdTokenError:
-                print("⏳ ID token expired. Attempting refresh...")
+                logs.info('id_token_expired')
                 try:
                     refresh_token = user.get('refreshToken')
                     if not refresh_token:
-                        print("❌ No refreshToken found in session for refresh.")
+                        logs.warning('session_missing_refresh_token')
                         raise Exception("Missing refresh token")
+                    auth = auth_client()
                     if not auth:
-                        print("❌ Pyrebase auth object not available for token refresh.")
+                        logs.error('token_refresh_unavailable')
                         raise Exception("Pyrebase auth not initialized")
                     refreshed_user_info = auth.refresh(refresh_token)
-                    print("✅ Token refreshed successfully.")
+                    logs.info('id_token_refreshed')
                     session['user'] = refreshed_user_info
-                    firebase_admin.auth.verify_id_token(refreshed_user_info['idToken'])
+                    verify_session_token(refreshed_user_info['idToken'], check_revoked)
                 except Exception as refresh_err:
-                    print(f"❌ Token refresh failed: {str(refresh_err)}")
+                    logs.warning('id_token_refresh_failed', error=refresh_err)
                     session.clear()
                     flash('Your session has expired. Please log in again.', 'error')
                     return redirect(url_for('login'))
             except firebase_admin.auth.InvalidIdTokenError as invalid_token_err:
-                print(f"❌ Invalid ID token: {str(invalid_token_err)}")
+                logs.warning('id_token_invalid', error=invalid_token_err)
                 session.clear()
                 flash('Your session is invalid. Please log in again.', 'error')
                 return redirect(url_for('login'))
         except Exception as e:
-            print(f"❌ Error during session check/token verification: {str(e)}")
+            logs.error('session_check_failed', error=e)
             session.clear()
             flash('An error occurred validating your session. Please log in again.', 'error')
             return redirect(url_for('login'))
@@ -133,6 +1125,7 @@ def login():
         email = request.form['email']
         password = request.form['password']
         try:
+            auth = auth_client()
             if not auth:
                 print("❌ Pyrebase auth object not initialized!")
                 flash('Authentication service is not available. Please try again later.', 'error')
@@ -149,7 +1142,7 @@ def login():
                 user_ref.set({
                     'name': email.split('@')[0],
                     'email': email,
-                    'wishlist': []
+                    'wishlist': {}
                 })
                 session['name'] = email.split('@')[0]
             flash('Login successful!', 'success')
@@ -198,7 +1191,7 @@ def register():
             return render_template('register.html')
         try:
             print(f"Attempting to register user with email: {email}")
-            auth = firebase.auth()
+            auth = auth_client()
             try:
                 user = auth.create_user_with_email_and_password(email, password)
                 print(f"User created successfully with ID: {user.get('localId')}")
@@ -206,7 +1199,7 @@ def register():
                 user_ref.set({
                     'name': name,
                     'email': email,
-                    'wishlist': []
+                    'wishlist': {}
                 })
                 flash('Registration successful! Please log in.', 'success')
                 return redirect(url_for('login'))
@@ -237,6 +1230,9 @@ def register():
 # =========================
 @app.route('/logout')
 def logout():
+    id_token = (session.get('user') or {}).get('idToken')
+    if id_token:
+        token_cache.invalidate(id_token)
     session.clear()
     flash('You have been logged out.', 'info')
     return redirect(url_for('index'))
@@ -244,44 +1240,37 @@ def logout():
 # =========================
 # Home Page and Restaurant Search
 # =========================
+# Shown when the shared Yelp budget sheds a search and nothing cached can stand in.
+YELP_BUSY_MESSAGE = "We're getting a lot of searches right now. Please try again in a moment."
+# Shown when Yelp's breaker is open and nothing cached can stand in.
+YELP_UNAVAILABLE_MESSAGE = "Restaurant search is temporarily unavailable. Please try again in a minute."
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     results = []
     if request.method == 'POST':
-        location = request.form.get('location')
-        term = request.form.get('term', '')
-        price = request.form.get('price', '')
-        cuisine = request.form.get('cuisine', '')
-        if not location:
+        params = search_form_params(request.form)
+        if not params:
             flash('Please enter a location', 'error')
             return render_template('index.html', results=[])
-        search_term = term
-        if cuisine and not term:
-            search_term = cuisine
-        elif cuisine and term:
-            search_term = f"{term} {cuisine}"
-        headers = {'Authorization': f'Bearer {YELP_API_KEY}'}
-        params = {
-            'location': location,
-            'term': search_term,
-            'limit': 20,
-        }
-        if price:
-            params['price'] = price
         try:
-            response = requests.get('https://api.yelp.com/v3/businesses/search', headers=headers, params=params)
-            response.raise_for_status()
-            results = response.json().get('businesses', [])
+            results = search_businesses(params)
+            logs.debug('search_results', count=len(results), first_id=results[0].id if results else None)
             if results:
-                print(f"DEBUG: First business ID: {results[0].get('id')}")
-                print(f"DEBUG: First business URL: {results[0].get('url')}")
-            if not results:
+                featured_lists.remember(params['location'])
+            else:
                 flash('No restaurants found matching your criteria', 'info')
+        except UpstreamBudgetExceeded as e:
+            logs.warning('yelp_request_shed', route=request.endpoint, error=e)
+            flash(YELP_BUSY_MESSAGE, "warning")
+        except CircuitOpenError as e:
+            logs.warning('yelp_circuit_open', route=request.endpoint, error=e)
+            flash(YELP_UNAVAILABLE_MESSAGE, "warning")
         except requests.exceptions.RequestException as e:
-            print("Yelp API Error:", e)
+            logs.error('yelp_request_failed', route=request.endpoint, error=e)
             flash("Error searching for restaurants. Please try again.", "error")
         except Exception as e:
-            print("Unexpected Error:", e)
+            logs.error('unexpected_error', route=request.endpoint, error=e)
             flash("An unexpected error occurred. Please try again.", "error")
     return render_template('index.html', results=results)
 
@@ -292,47 +1281,44 @@ def index():
 def nearby():
     results = []
     if request.method == 'POST':
-        address = request.form.get('address', '')
-        city = request.form.get('city', '')
-        state = request.form.get('state', '')
-        zipcode = request.form.get('zipcode', '')
-        country = request.form.get('country', 'USA')
-        location_parts = []
-        if address:
-            location_parts.append(address)
-        if city:
-            location_parts.append(city)
-        if state:
-            location_parts.append(state)
-        if zipcode:
-            location_parts.append(zipcode)
-        if country:
-            location_parts.append(country)
-        location = ", ".join(location_parts)
-        if not city and not zipcode:
+        coordinates = form_coordinates(request.form)
+        if coordinates:
+            try:
+                results = nearby_businesses(*coordinates)
+                if not results:
+                    flash('No restaurants found in your area', 'info')
+            except UpstreamBudgetExceeded as e:
+                logs.warning('yelp_request_shed', route=request.endpoint, error=e)
+                flash(YELP_BUSY_MESSAGE, "warning")
+            except CircuitOpenError as e:
+                logs.warning('yelp_circuit_open', route=request.endpoint, error=e)
+                flash(YELP_UNAVAILABLE_MESSAGE, "warning")
+            except requests.exceptions.RequestException as e:
+                logs.error('yelp_request_failed', route=request.endpoint, error=e)
+                flash("Error finding nearby restaurants. Please try again.", "error")
+            return render_template('store_locator.html', results=results)
+        params = nearby_form_params(request.form)
+        if not params:
             flash('Please enter at least a city or zip code', 'error')
             return render_template('store_locator.html', results=[])
-        headers = {'Authorization': f'Bearer {YELP_API_KEY}'}
-        params = {
-            'location': location,
-            'term': 'restaurants',
-            'limit': 20,
-        }
         try:
-            print(f"Searching for restaurants near: {location}")
-            response = requests.get('https://api.yelp.com/v3/businesses/search', headers=headers, params=params)
-            print(f"API Response status: {response.status_code}")
-            if response.status_code != 200:
-                print(f"API Error response: {response.text}")
-            response.raise_for_status()
-            results = response.json().get('businesses', [])
-            if not results:
+            logs.debug('nearby_text_search', location=params['location'])
+            results = search_businesses(params)
+            if results:
+                featured_lists.remember(params['location'])
+            else:
                 flash('No restaurants found in your area', 'info')
+        except UpstreamBudgetExceeded as e:
+            logs.warning('yelp_request_shed', route=request.endpoint, error=e)
+            flash(YELP_BUSY_MESSAGE, "warning")
+        except CircuitOpenError as e:
+            logs.warning('yelp_circuit_open', route=request.endpoint, error=e)
+            flash(YELP_UNAVAILABLE_MESSAGE, "warning")
         except requests.exceptions.RequestException as e:
-            print("Yelp API Error:", e)
+            logs.error('yelp_request_failed', route=request.endpoint, error=e)
             flash("Error finding nearby restaurants. Please try again.", "error")
         except Exception as e:
-            print("Unexpected Error:", e)
+            logs.error('unexpected_error', route=request.endpoint, error=e)
             flash("An unexpected error occurred. Please try again.", "error")
     return render_template('store_locator.html', results=results)
 
@@ -341,99 +1327,58 @@ def nearby():
 # =========================
 @app.route('/restaurant/<business_id>')
 def restaurant_detail(business_id):
-    headers = {'Authorization': f'Bearer {YELP_API_KEY}'}
     restaurant = None
     yelp_reviews = []
     user_reviews = []
+    next_reviews_cursor = None
     dinewise_rating = None
+    dinewise_review_count = 0
     weighted_average_rating = None
     total_combined_reviews = 0
-    try:
-        print(f"Fetching details for restaurant ID: {business_id}")
-        response = requests.get(f'{YELP_ENDPOINT}/{business_id}', headers=headers)
-        print(f"Restaurant API response status: {response.status_code}")
-        if response.status_code == 200:
-            restaurant = response.json()
-        else:
-            print(f"API Error response: {response.text}")
-    except Exception as e:
-        print(f"Error fetching restaurant details: {e}")
+    # The sources are independent, so fetch them side by side and
+    # give each the same deadline.
+    logs.debug('restaurant_detail', business_id=business_id)
+    access_tracker.record(business_id)
+    deadline = time.monotonic() + DETAIL_SOURCE_TIMEOUT
+    restaurant_future = yelp_executor.submit(get_business, business_id, True)
+    yelp_reviews_future = yelp_executor.submit(get_business_reviews, business_id)
+    user_reviews_future = firebase_executor.submit(
+        read_last_known_good, f'reviews/{business_id}', lambda: load_first_review_page(business_id))
+    review_stats_future = firebase_executor.submit(
+        read_last_known_good, f'{STATS_ROOT}/{business_id}',
+        lambda: db.reference(f'{STATS_ROOT}/{business_id}').get() or {})
+    restaurant = join_source(restaurant_future, deadline, 'restaurant details')
     if restaurant:
-        try:
-            reviews_response = requests.get(f'{YELP_ENDPOINT}/{business_id}/reviews', headers=headers)
-            print(f"Reviews API response status: {reviews_response.status_code}")
-            if reviews_response.status_code == 200:
-                yelp_reviews = reviews_response.json().get('reviews', [])
-            else:
-                print(f"Reviews API Error response: {reviews_response.text}")
-        except Exception as e:
-            print(f"Error fetching Yelp reviews: {e}")
-        try:
-            reviews_ref = db.reference(f'reviews/{business_id}')
-            user_reviews_data = reviews_ref.get() or {}
-            user_reviews = [review for review_id, review in user_reviews_data.items()]
-            user_reviews.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-
-            # --- Calculate Weighted Average Rating ---
-            yelp_rating = None
-            yelp_review_count = 0
-            dinewise_review_count = len(user_reviews)
-            total_score = 0.0
-            total_reviews = 0
-
-            # Get Yelp data if restaurant details were fetched
-            if restaurant:
-                try:
-                    yelp_rating = float(restaurant.get('rating'))
-                    yelp_review_count = int(restaurant.get('review_count', 0))
-                    if yelp_rating is not None and yelp_review_count > 0:
-                        total_score += yelp_rating * yelp_review_count
-                        total_reviews += yelp_review_count
-                except (ValueError, TypeError, AttributeError):
-                    print(f"Warning: Could not parse Yelp rating/count for {business_id}")
-
-            # Calculate Dinewise Rating and add its contribution to weighted average
-            if user_reviews:
-                total_dinewise_score = sum(float(review.get('rating', 0)) for review in user_reviews)
-                if dinewise_review_count > 0:
-                    dinewise_rating = round(total_dinewise_score / dinewise_review_count, 1)
-                    total_score += total_dinewise_score
-                    total_reviews += dinewise_review_count
-
-            if total_reviews > 0:
-                weighted_average_rating = round(total_score / total_reviews, 1)
-            total_combined_reviews = total_reviews
-
-            print(f"Found {len(user_reviews)} user reviews")
-        except Exception as e:
-            print(f"Error fetching user reviews: {e}")
+        yelp_reviews = join_source(yelp_reviews_future, deadline, 'Yelp reviews') or []
+        review_stats = join_source(review_stats_future, deadline, 'review stats')
+        user_reviews_page = join_source(user_reviews_future, deadline, 'user reviews')
+        if user_reviews_page is not None:
+            user_reviews, next_reviews_cursor = user_reviews_page
+            logs.debug('user_reviews_loaded', business_id=business_id, count=len(user_reviews))
+        # None means the stats read failed or timed out, which is no reason
+        # to download every review; only a missing aggregate is seeded.
+        if review_stats == {} and user_reviews:
+            review_stats = seed_review_stats(business_id)
+        if review_stats:
+            dinewise_rating = dinewise_average(review_stats)
+            dinewise_review_count = int(review_stats.get('count', 0))
+        weighted_average_rating, total_combined_reviews = combined_rating(
+            restaurant.rating, restaurant.review_count, review_stats)
+        user_reviews = pending_reviews_for(business_id, user_reviews) + user_reviews
     if not restaurant:
-        restaurant = {
-            'name': 'Restaurant information unavailable',
-            'id': business_id,
-            'image_url': None,
-            'rating': None,
-            'review_count': 0,
-            'price': None,
-            'is_closed': None,
-            'location': {'display_address': ['Address unavailable']},
-            'display_phone': None,
-            'phone': None,
-            'url': None,
-            'coordinates': {'latitude': None, 'longitude': None},
-            'categories': []
-        }
+        restaurant = Restaurant.unavailable(business_id, display_address=['Address unavailable'])
         flash("Some restaurant information could not be loaded", "warning")
     is_potentially_new = session.get('user') is not None
-    coordinates = restaurant.get('coordinates') if restaurant else None
-    latitude = coordinates.get('latitude') if coordinates else None
-    longitude = coordinates.get('longitude') if coordinates else None
+    latitude = restaurant.coordinates.latitude
+    longitude = restaurant.coordinates.longitude
     show_promo_banner = is_potentially_new
     return render_template('restaurant_detail.html',
                          restaurant=restaurant,
                          yelp_reviews=yelp_reviews,
                          user_reviews=user_reviews,
+                         next_reviews_cursor=next_reviews_cursor,
                          dinewise_rating=dinewise_rating,
+                         dinewise_review_count=dinewise_review_count,
                          weighted_average_rating=weighted_average_rating,
                          total_combined_reviews=total_combined_reviews,
                          show_new_user_promo=show_promo_banner,
@@ -441,20 +1386,36 @@ def restaurant_detail(business_id):
                          latitude=latitude,
                          longitude=longitude)
 
+# =========================
+# User Reviews Page API (infinite scroll)
+# =========================
+@app.route('/api/restaurant/<business_id>/reviews')
+def restaurant_reviews_api(business_id):
+    cursor = request.args.get('cursor')
+    try:
+        limit = min(max(int(request.args.get('limit', REVIEWS_PAGE_SIZE)), 1), REVIEWS_MAX_PAGE_SIZE)
+        page, next_cursor = fetch_review_page(business_id, limit, cursor)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor or limit'}), 400
+    except Exception as e:
+        logs.error('review_page_failed', business_id=business_id, error=e)
+        return jsonify({'error': 'Reviews are temporarily unavailable'}), 503
+    reviews_out = [{field: review.get(field) for field in PUBLIC_REVIEW_FIELDS} for review in page]
+    return jsonify({'reviews': reviews_out, 'next_cursor': next_cursor})
+
 # =========================
 # Simple Restaurant Detail (for fallback/testing)
 # =========================
 @app.route('/simple-restaurant/<business_id>')
 def simple_restaurant_detail(business_id):
-    headers = {'Authorization': f'Bearer {YELP_API_KEY}'}
     try:
-        response = requests.get(f'{YELP_ENDPOINT}/{business_id}', headers=headers)
-        response.raise_for_status()
-        restaurant = response.json()
+        restaurant = get_business(business_id, full=True)
+        if not restaurant:
+            raise ValueError(f"Restaurant {business_id} not found")
         yelp_reviews = []
         user_reviews = []
     except Exception as e:
-        print(f"Error: {e}")
+        logs.error('simple_restaurant_failed', business_id=business_id, error=e)
         flash("Error loading restaurant details", "error")
         return redirect(url_for('index'))
     return render_template('restaurant_detail.html',
@@ -487,13 +1448,16 @@ def add_review(business_id):
             'comment': comment,
             'timestamp': datetime.now().isoformat()
         }
-        reviews_ref = db.reference(f'reviews/{business_id}/{review_id}')
-        reviews_ref.set(review_data)
+        if not queue_review(business_id, review_id, review_data):
+            reviews_ref = db.reference(f'reviews/{business_id}/{review_id}')
+            reviews_ref.set(review_data)
+            update_review_stats(business_id, {review_id: rating})
+            fragment_cache.invalidate(business_id)
         flash("Review added successfully!", "success")
     except ValueError:
         flash("Invalid rating value", "error")
     except Exception as e:
-        print("Error adding review:", e)
+        logs.error('add_review_failed', business_id=business_id, error=e)
         flash("Error adding review. Please try again.", "error")
     return redirect(url_for('restaurant_detail', business_id=business_id))
 
@@ -504,36 +1468,46 @@ def add_review(business_id):
 @login_required
 def wishlist():
     user_id = session['user']['localId']
-    user_ref = db.reference(f'users/{user_id}/wishlist')
-    wishlist_items = user_ref.get() or []
-    restaurants = []
+    wishlist_items = request.environ.get(WISHLIST_PREFETCH_KEY)
+    if wishlist_items is None:
+        wishlist_items = load_wishlist(user_id)
     for business_id in wishlist_items:
-        try:
-            response = requests.get(f'https://api.yelp.com/v3/businesses/{business_id}',
-                                   headers={'Authorization': f'Bearer {YELP_API_KEY}'})
-            if response.status_code == 200:
-                restaurants.append(response.json())
-            else:
-                print(f"Error fetching restaurant {business_id}: Status {response.status_code}, Response: {response.text}")
-        except Exception as e:
-            print(f"Error fetching restaurant {business_id}: {str(e)}")
-            continue
+        access_tracker.record(business_id)
+    # Businesses Yelp no longer has (closed or removed) are left out; only
+    # ones that timed out or failed get a placeholder and a retry hint.
+    restaurants = [restaurant or Restaurant.unavailable(business_id)
+                   for business_id, restaurant, status in get_businesses(wishlist_items, WISHLIST_DEADLINE)
+                   if status != 'not_found']
+    if any(restaurant.placeholder for restaurant in restaurants):
+        flash('Some restaurants could not be loaded right now. Please refresh to try again.', 'warning')
     return render_template('wishlist.html', restaurants=restaurants)
 
 # =========================
 # Add to Wishlist
 # =========================
+# Shown when a wishlist change could not be written (e.g. the storage breaker is open).
+WISHLIST_UNAVAILABLE_MESSAGE = 'Wishlist is temporarily unavailable, try again in a minute.'
+
 @app.route('/add_to_wishlist/<business_id>')
 @login_required
 def add_to_wishlist(business_id):
     if 'user' not in session:
         flash('Please log in to add to wishlist.', 'error')
         return redirect(url_for('login'))
-    user_ref = db.reference(f'users/{session["user"]["localId"]}/wishlist')
-    current_wishlist = user_ref.get() or []
-    if business_id not in current_wishlist:
-        current_wishlist.append(business_id)
-        user_ref.set(current_wishlist)
+    if not valid_business_id(business_id):
+        flash('Invalid restaurant.', 'error')
+        return redirect(request.referrer or url_for('index'))
+    try:
+        added = add_wishlist_item(session['user']['localId'], business_id)
+    except CircuitOpenError as e:
+        logs.warning('storage_circuit_open', route=request.endpoint, error=e)
+        flash(WISHLIST_UNAVAILABLE_MESSAGE, 'warning')
+        return redirect(request.referrer or url_for('index'))
+    except Exception as e:
+        logs.error('wishlist_update_failed', route=request.endpoint, error=e)
+        flash(WISHLIST_UNAVAILABLE_MESSAGE, 'warning')
+        return redirect(request.referrer or url_for('index'))
+    if added:
         flash('Restaurant added to wishlist!', 'success')
     else:
         flash('Restaurant is already in your wishlist.', 'info')
@@ -547,37 +1521,249 @@ def add_to_wishlist(business_id):
 def remove_from_wishlist(business_id):
     if 'user' not in session:
         return redirect(url_for('login'))
-    user_ref = db.reference(f'users/{session["user"]["localId"]}/wishlist')
-    current_wishlist = user_ref.get() or []
-    if business_id in current_wishlist:
-        current_wishlist.remove(business_id)
-        user_ref.set(current_wishlist)
+    if not valid_business_id(business_id):
+        return redirect(url_for('wishlist'))
+    try:
+        removed = remove_wishlist_item(session['user']['localId'], business_id)
+    except CircuitOpenError as e:
+        logs.warning('storage_circuit_open', route=request.endpoint, error=e)
+        flash(WISHLIST_UNAVAILABLE_MESSAGE, 'warning')
+        return redirect(url_for('wishlist'))
+    except Exception as e:
+        logs.error('wishlist_update_failed', route=request.endpoint, error=e)
+        flash(WISHLIST_UNAVAILABLE_MESSAGE, 'warning')
+        return redirect(url_for('wishlist'))
+    if removed:
         flash('Restaurant removed from wishlist.', 'success')
     return redirect(url_for('wishlist'))
 
+# =========================
+# Bulk Wishlist API
+# =========================
+# POST {"add": [business_id, ...], "remove": [business_id, ...]}
+@app.route('/api/wishlist', methods=['POST'])
+@login_required
+def wishlist_api():
+    payload = request.get_json(silent=True) or {}
+    add = payload.get('add') or []
+    remove = payload.get('remove') or []
+    if not isinstance(add, list) or not isinstance(remove, list):
+        return jsonify({'error': '"add" and "remove" must be lists of business ids'}), 400
+    if len(add) + len(remove) > WISHLIST_BULK_LIMIT:
+        return jsonify({'error': f'At most {WISHLIST_BULK_LIMIT} changes per request'}), 400
+    invalid = [business_id for business_id in add + remove if not valid_business_id(business_id)]
+    if invalid:
+        return jsonify({'error': 'Invalid business ids', 'invalid': invalid}), 400
+    if set(add) & set(remove):
+        return jsonify({'error': 'A business id cannot be both added and removed'}), 400
+    try:
+        added, removed = update_wishlist(session['user']['localId'], add=add, remove=remove)
+    except CircuitOpenError as e:
+        logs.warning('storage_circuit_open', route=request.endpoint, error=e)
+        return jsonify({'error': WISHLIST_UNAVAILABLE_MESSAGE}), 503, {'Retry-After': retry_after(storage_breaker)}
+    except FIREBASE_OUTAGE_ERRORS as e:
+        logs.error('wishlist_update_failed', route=request.endpoint, error=e)
+        return jsonify({'error': WISHLIST_UNAVAILABLE_MESSAGE}), 503, {'Retry-After': '5'}
+    except Exception as e:
+        logs.error('wishlist_update_failed', route=request.endpoint, error=e)
+        return jsonify({'error': 'Could not update wishlist'}), 502
+    return jsonify({'added': added, 'removed': removed})
+
 # =========================
 # Yelp Autocomplete API Endpoint
 # =========================
 @app.route('/api/autocomplete')
 def autocomplete():
-    term = request.args.get('term', '')
+    term = ' '.join(request.args.get('term', '').lower().split())
     location = request.args.get('location', '')
     if not term or not location:
         return jsonify([])
-    headers = {'Authorization': f'Bearer {YELP_API_KEY}'}
+    try:
+        cell_key, latitude, longitude = autocomplete_cell(location)
+    except ValueError:
+        return jsonify([])
+    client_id = session.get('client_id')
+    limiter_key = autocomplete_client_key(client_id, request.remote_addr)
+    session.setdefault('client_id', uuid.uuid4().hex)
+    prefetched = request.environ.get(AUTOCOMPLETE_PREFETCH_KEY)
+    allowed, sequence, outcome = prefetched or (autocomplete_limiter.allow(limiter_key), None, None)
+    if not allowed:
+        return jsonify([]), 429
+    if outcome == 'superseded':
+        return '', 204
+    if outcome == 'timeout':
+        logs.warning('autocomplete_timeout', term=term)
+        return jsonify([])
+    if client_id and sequence is None:
+        sequence = start_autocomplete_request(client_id)
+    key = f'{cell_key}|{term}'
+    params = autocomplete_params(term, latitude, longitude)
+    loader = lambda: fetch_autocomplete(params)
+    terms, state = autocomplete_cache.get(key)
+    if state == FRESH:
+        return jsonify(terms)
+    if state == STALE:
+        autocomplete_cache.refresh_in_background(key, loader)
+        return jsonify(terms)
+    seeded = autocomplete_prefix_seed(cell_key, term)
+    if seeded:
+        autocomplete_cache.refresh_in_background(key, loader)
+        return jsonify(seeded)
+    # Stop waiting as soon as the same client has typed further; the upstream
+    # call still finishes and fills the cache for later prefixes.
+    future = yelp_executor.submit(autocomplete_cache.load, key, loader)
+    deadline = time.monotonic() + AUTOCOMPLETE_WAIT
+    while True:
+        try:
+            return jsonify(future.result(timeout=0.05) or [])
+        except FutureTimeoutError:
+            if sequence is not None and autocomplete_superseded(client_id, sequence):
+                return '', 204
+            if time.monotonic() > deadline:
+                logs.warning('autocomplete_timeout', term=term)
+                return jsonify([])
+        except Exception as e:
+            logs.error('autocomplete_failed', term=term, error=e)
+            return jsonify([])
+
+# =========================
+# API Health Check (used by featured.js)
+# =========================
+@app.route('/api/test')
+def api_test():
+    return jsonify({'status': 'ok', 'yelp_api_key_configured': bool(YELP_API_KEY)})
+
+# =========================
+# Featured Restaurants API
+# =========================
+@app.route('/api/featured')
+def api_featured():
+    location = request.args.get('location', '').strip() or FEATURED_DEFAULT_LOCATIONS[0]
+    if len(location) > featured_lists.max_location_length:
+        return jsonify({'error': 'Location is too long'}), 400
+    try:
+        featured = featured_lists.get(location)
+    except Exception as e:
+        logs.error('featured_failed', location=location, error=e)
+        return jsonify({'error': 'Featured restaurants are unavailable right now'}), 502
+    return cached_json_response(featured.body, featured.etag, featured.last_modified,
+                                max_age=FEATURED_MAX_AGE)
+
+# =========================
+# Batch Restaurants API
+# =========================
+# GET /api/restaurants?ids=a,b,c (or ?ids=a&ids=b) returns, in request
+# order, {"id", "status", "restaurant"} for each id; status is one of
+# BATCH_STATUSES, or "invalid" for a malformed id, and restaurant is null
+# unless there is data to show.
+RESTAURANTS_BATCH_LIMIT = 50
+RESTAURANTS_BATCH_MAX_AGE = 60
+
+# Returns (ids, None), or (None, error message) for a request to reject.
+def restaurant_batch_ids(args):
+    business_ids = [business_id.strip() for value in args.getlist('ids')
+                    for business_id in value.split(',') if business_id.strip()]
+    if not business_ids:
+        return None, 'Pass one or more business ids as ?ids=a,b,c'
+    if len(business_ids) > RESTAURANTS_BATCH_LIMIT:
+        return None, f'At most {RESTAURANTS_BATCH_LIMIT} ids per request'
+    return business_ids, None
+
+@app.route('/api/restaurants')
+def api_restaurants():
+    business_ids, error = restaurant_batch_ids(request.args)
+    if error:
+        return jsonify({'error': error}), 400
+    valid = [business_id for business_id in business_ids if valid_business_id(business_id)]
+    found = {business_id: (restaurant, status)
+             for business_id, restaurant, status in get_businesses(valid, WISHLIST_DEADLINE)}
+    items = []
+    for business_id in business_ids:
+        restaurant, status = found.get(business_id, (None, 'invalid'))
+        items.append({'id': business_id, 'status': status,
+                      'restaurant': restaurant.as_dict() if restaurant is not None else None})
+    body = json.dumps({'restaurants': items, 'stale': any(item['status'] == 'stale' for item in items)},
+                      separators=(',', ':'))
+    # Partial answers shouldn't be reused; the client will ask again.
+    complete = all(item['status'] in ('fresh', 'not_found', 'invalid') for item in items)
+    return cached_json_response(body, hashlib.sha1(body.encode('utf-8')).hexdigest(),
+                                max_age=RESTAURANTS_BATCH_MAX_AGE if complete else 0)
+
+# =========================
+# Explore Page and API
+# =========================
+EXPLORE_PAGE_SIZE = 18
+EXPLORE_DEFAULT_LOCATION = 'San Francisco, CA'
+
+@app.route('/explore')
+def explore():
+    return render_template('explore.html')
+
+@app.route('/api/explore')
+def api_explore():
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', EXPLORE_PAGE_SIZE)), 1), 50)
+        min_rating = float(request.args.get('rating') or 0)
+    except ValueError:
+        return jsonify({'error': 'Invalid offset, limit or rating'}), 400
+    terms = [request.args.get('term', ''), request.args.get('cuisine', '')]
     params = {
-        'text': term,
-        'latitude': location.split(',')[0] if ',' in location else None,
-        'longitude': location.split(',')[1] if ',' in location else None,
-        'limit': 5
+        'location': request.args.get('location', '').strip() or EXPLORE_DEFAULT_LOCATION,
+        'term': ' '.join(t for t in terms if t) or 'restaurants',
+        'price': request.args.get('price', ''),
+        'categories': request.args.get('categories', ''),
+        'sort_by': request.args.get('sort_by', ''),
+        'offset': offset,
+        'limit': limit,
     }
+    if params['sort_by'] not in ('', 'best_match', 'rating', 'review_count', 'distance'):
+        params['sort_by'] = ''
     try:
-        response = requests.get('https://api.yelp.com/v3/autocomplete', headers=headers, params=params)
-        response.raise_for_status()
-        return jsonify(response.json().get('terms', []))
-    except Exception as e:
-        print("Autocomplete Error:", e)
-        return jsonify([])
+        page = search_yelp(params)
+    except UpstreamBudgetExceeded as e:
+        logs.warning('yelp_request_shed', route=request.endpoint, error=e)
+        return jsonify({'error': YELP_BUSY_MESSAGE}), 503, {'Retry-After': '5'}
+    except CircuitOpenError as e:
+        logs.warning('yelp_circuit_open', route=request.endpoint, error=e)
+        return jsonify({'error': YELP_UNAVAILABLE_MESSAGE}), 503, {'Retry-After': retry_after(yelp_breaker)}
+    except requests.exceptions.RequestException as e:
+        logs.error('yelp_request_failed', route=request.endpoint, error=e)
+        return jsonify({'error': 'Error loading restaurants. Please try again.'}), 502
+    businesses = [restaurant_card(b) for b in page['businesses'] if (b.rating or 0) >= min_rating]
+    stale = yelp_breaker.state != CLOSED
+    body = json.dumps({'businesses': businesses, 'total': page['total'],
+                       'offset': offset, 'limit': limit, 'stale': stale}, separators=(',', ':'))
+    return cached_json_response(body, hashlib.sha1(body.encode('utf-8')).hexdigest(),
+                                max_age=0 if stale else SEARCH_CACHE_TTL)
+
+# =========================
+# Prometheus Metrics Endpoint
+# =========================
+# With METRICS_TOKEN set, scrapers must send "Authorization: Bearer <token>".
+# Without it, only direct loopback/private-network clients are served; a
+# request that came through a reverse proxy (X-Forwarded-For) is refused
+# even if the proxy itself connects from loopback.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+def metrics_allowed():
+    if METRICS_TOKEN:
+        supplied = request.headers.get('Authorization', '')
+        return hmac.compare_digest(supplied.encode('utf-8'), f'Bearer {METRICS_TOKEN}'.encode('utf-8'))
+    if request.headers.get('X-Forwarded-For') and not TRUSTED_PROXY_COUNT:
+        return False
+    try:
+        address = ipaddress.ip_address(request.remote_addr or '')
+    except ValueError:
+        return False
+    return address.is_loopback or address.is_private
+
+@app.route('/metrics')
+def metrics():
+    if not metrics_allowed():
+        return "Not Found", 404
+    return Response(REGISTRY.render(), content_type=METRICS_CONTENT_TYPE,
+                    headers={'Cache-Control': 'no-store'})
 
 # =========================
 # Debug: Yelp API Test Endpoint
@@ -597,21 +1783,53 @@ def debug_api_test():
             'location': 'San Francisco',
             'limit': 1
         }
-        search_response = requests.get(f'{YELP_ENDPOINT}/search',
-                                      headers=HEADERS,
-                                      params=search_params)
+        search_response = yelp.search(search_params)
         results['search_status'] = search_response.status_code
         results['search_response'] = search_response.json() if search_response.status_code == 200 else search_response.text
         if search_response.status_code == 200 and search_response.json().get('businesses'):
             business_id = search_response.json()['businesses'][0]['id']
             results['test_business_id'] = business_id
-            business_response = requests.get(f'{YELP_ENDPOINT}/{business_id}', headers=HEADERS)
+            business_response = yelp.business(business_id)
             results['business_status'] = business_response.status_code
             results['business_response'] = business_response.json() if business_response.status_code == 200 else business_response.text
     except Exception as e:
         results['error'] = str(e)
     return jsonify(results)
 
+# =========================
+# Debug: Yelp Client Stats Endpoint
+# =========================
+@app.route('/debug/yelp-stats')
+def debug_yelp_stats():
+    if not app.debug:
+        return "Debug routes only available in debug mode", 403
+    return jsonify({
+        'base_url': yelp.base_url,
+        'timeout': list(yelp.timeout),
+        'endpoints': yelp.stats(),
+        'autocomplete_rate_limited': autocomplete_limiter.rejected,
+        'caches': {
+            'business': business_cache.stats(),
+            'business_missing': missing_businesses.stats(),
+            'search': search_cache.stats(),
+            'autocomplete': autocomplete_cache.stats(),
+            'reviews': reviews_cache.stats(),
+            'firebase_reads': firebase_reads.stats(),
+        },
+        'geo_index': geo_index.stats(),
+        'featured': featured_lists.stats(),
+        'token_cache': token_cache.stats(),
+        'storage': db.stats(),
+        'fragments': fragment_cache.stats(),
+        'prewarm': prewarmer.stats(),
+        'yelp_quota': yelp_budget.quota(),
+        'upstream_budget': yelp_budget.stats(),
+        'review_queue': review_queue.stats() if review_queue is not None else None,
+        'startup': dict(STARTUP, target_s=STARTUP_TARGET_SECONDS),
+        'circuits': {breaker.name: breaker.stats() for breaker in BREAKERS},
+        'clients': CLIENTS.stats(),
+    })
+
 # =========================
 # Debug: Firebase Auth Test Endpoint
 # =========================
@@ -619,10 +1837,11 @@ def debug_api_test():
 def debug_auth_test():
     if not app.debug:
         return "Debug routes only available in debug mode", 403
+    auth = auth_client()
     results = {
-        'firebase_config': {k: '***' if k in ['apiKey', 'appId'] else v for k, v in firebase_config.items()},
+        'firebase_config': {k: '***' if k in ['apiKey', 'appId'] else v for k, v in clients.pyrebase_config().items()},
         'auth_initialized': auth is not None,
-        'admin_initialized': firebase_admin._apps is not None and len(firebase_admin._apps) > 0
+        'admin_initialized': clients.firebase_app() is not None
     }
     test_email = f"test_{datetime.now().strftime('%Y%m%d%H%M%S')}@example.com"
     test_password = "Test123456!"
@@ -673,6 +1892,7 @@ def debug_firebase_config():
         }
         if not all(firebase_config.values()):
             raise ValueError("One or more Firebase configuration environment variables are missing.")
+        import pyrebase
         firebase = pyrebase.initialize_app(firebase_config)
         auth = firebase.auth()
         print("✅ Firebase client initialized successfully from environment variables")
@@ -703,24 +1923,23 @@ def test_yelp_api(business_id):
         'api_key_length': len(YELP_API_KEY) if YELP_API_KEY else 0,
         'endpoint': YELP_ENDPOINT,
     }
-    headers = {'Authorization': f'Bearer {YELP_API_KEY}'}
     try:
-        business_response = requests.get(f'{YELP_ENDPOINT}/{business_id}', headers=headers)
-        results['business_status'] = business_response.status_code
-        if business_response.status_code == 200:
+        results['business_cache_state'] = business_cache.get(business_id)[1] or 'miss'
+        business = get_business(business_id)
+        if business:
             results['business_data'] = {
-                'name': business_response.json().get('name'),
-                'rating': business_response.json().get('rating'),
-                'review_count': business_response.json().get('review_count')
+                'name': business.name,
+                'rating': business.rating,
+                'review_count': business.review_count
             }
         else:
-            results['business_error'] = business_response.text
-        reviews_response = requests.get(f'{YELP_ENDPOINT}/{business_id}/reviews', headers=headers)
-        results['reviews_status'] = reviews_response.status_code
-        if reviews_response.status_code == 200:
-            results['reviews_count'] = len(reviews_response.json().get('reviews', []))
+            results['business_error'] = 'Business details unavailable'
+        results['reviews_cache_state'] = reviews_cache.get(business_id)[1] or 'miss'
+        business_reviews = get_business_reviews(business_id)
+        if business_reviews is not None:
+            results['reviews_count'] = len(business_reviews)
         else:
-            results['reviews_error'] = reviews_response.text
+            results['reviews_error'] = 'Reviews unavailable'
     except Exception as e:
         results['error'] = str(e)
     return jsonify(results)
@@ -793,6 +2012,9 @@ def template_syntax_error(e):
                           error_code=500,
                           message=f"Template syntax error: {str(e)}"), 500
 
+STARTUP['import_s'] = time.time() - STARTED
+STARTUP_SECONDS.observe(STARTUP['import_s'], 'import')
+
 # =========================
 # Main Entrypoint
 # =========================
@@ -0,0 +1,335 @@
+import asyncio
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Request
+
+import app as dinewise
+import logs
+from yelp_client import AsyncYelpClient
+
+# =========================
+# Async (ASGI) Serving Mode
+# =========================
+#   pip install httpx uvicorn
+#   uvicorn asgi:application --host 0.0.0.0 --port 5000
+#
+# The search, nearby, restaurant detail, wishlist, batch restaurant and
+# autocomplete routes spend nearly all their time waiting on Yelp. Here those
+# Yelp calls are made with httpx on the event loop and stored in app.py's
+# caches; the unchanged Flask view then runs on a small thread pool and
+# renders from the warm caches, so a request waiting on Yelp holds no thread
+# and one process can keep thousands of upstream calls in flight. Templates,
+# flashes, sessions and error handling are exactly those of the WSGI app:
+# anything the prefetch could not load is fetched by the view as usual.
+# Firebase reads still happen inside the views (the Admin SDK is synchronous).
+# Only the in-process cache tier is touched on the loop: storing responses
+# (which writes YELP_CACHE_DB) and the call budget run on a few store threads.
+ASGI_WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', '32'))
+ASGI_STORE_THREADS = int(os.getenv('ASGI_STORE_THREADS', '4'))
+
+
+def build_environ(scope, body):
+    script_name = scope.get('root_path', '').encode('utf-8').decode('latin1')
+    path_info = scope['path'].encode('utf-8').decode('latin1')
+    if script_name and path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', []):
+        name, value = name.decode('latin1'), value.decode('latin1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+# Concurrent prefetches of the same key share one upstream call.
+class AsyncFlights:
+    def __init__(self):
+        self._tasks = {}
+
+    async def run(self, key, fetch):
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(self._run(key, fetch))
+        return await asyncio.shield(task)
+
+    async def _run(self, key, fetch):
+        try:
+            return await fetch()
+        except Exception as e:
+            # The view will fetch (and report) it itself.
+            logs.debug('async_prefetch_failed', key=key, error=e)
+            return None
+        finally:
+            self._tasks.pop(key, None)
+
+
+class DineWiseASGI:
+    def __init__(self, flask_app, threads=ASGI_WSGI_THREADS):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+        self.store_executor = ThreadPoolExecutor(max_workers=ASGI_STORE_THREADS, thread_name_prefix='asgi-store')
+        self.flights = AsyncFlights()
+        self._yelp = None
+        self.prefetchers = {
+            'index': self.prefetch_index,
+            'nearby': self.prefetch_nearby,
+            'restaurant_detail': self.prefetch_restaurant_detail,
+            'simple_restaurant_detail': self.prefetch_simple_restaurant_detail,
+            'wishlist': self.prefetch_wishlist,
+            'api_restaurants': self.prefetch_api_restaurants,
+            'autocomplete': self.prefetch_autocomplete,
+        }
+
+    # Created on first use so it binds to the server's event loop.
+    @property
+    def yelp(self):
+        if self._yelp is None:
+            self._yelp = AsyncYelpClient(dinewise.yelp, executor=self.store_executor)
+        return self._yelp
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle_http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._yelp is not None:
+                    await self._yelp.aclose()
+                self.executor.shutdown(wait=False)
+                self.store_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle_http(self, scope, receive, send):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        body = b''.join(chunks)
+        environ = build_environ(scope, body)
+        await self.prefetch(environ, body)
+        loop = asyncio.get_running_loop()
+        status, headers, response_body = await loop.run_in_executor(self.executor, self.run_wsgi, environ)
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]})
+        await send({'type': 'http.response.body', 'body': response_body})
+
+    def run_wsgi(self, environ):
+        started = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+            return written.append
+
+        result = self.flask_app(environ, start_response)
+        try:
+            written.extend(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return started['status'], started['headers'], b''.join(written)
+
+    # Returns once the route's Yelp data is in the caches (or the prefetch
+    # gave up); anything the view should know is left in the environ.
+    async def prefetch(self, environ, body):
+        try:
+            endpoint, view_args = self.flask_app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return
+        prefetcher = self.prefetchers.get(endpoint)
+        if prefetcher is None:
+            return
+        request = Request(dict(environ, **{'wsgi.input': io.BytesIO(body)}), populate_request=False)
+        try:
+            await prefetcher(request, view_args, environ)
+        except Exception as e:
+            logs.warning('async_prefetch_error', endpoint=endpoint, error=e)
+
+    async def store(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.store_executor, fn, *args)
+
+    def session(self, request):
+        return self.flask_app.session_interface.open_session(self.flask_app, request) or {}
+
+    async def load_business(self, business_id, full=False):
+        cached = dinewise.business_cache.peek(business_id)
+        if cached is not None and not (full and cached.partial):
+            return
+        if cached is None and dinewise.missing_businesses.peek(business_id) is not None:
+            return
+
+        def store_business(response):
+            business = dinewise.business_from_response(business_id, response)
+            if business is not None:
+                dinewise.business_cache.set(business_id, business)
+
+        async def fetch():
+            await self.store(store_business, await self.yelp.business(business_id))
+
+        await self.flights.run(('business', business_id), fetch)
+
+    async def load_reviews(self, business_id):
+        if dinewise.reviews_cache.peek(business_id) is not None:
+            return
+
+        def store_reviews(response):
+            yelp_reviews = dinewise.reviews_from_response(business_id, response)
+            if yelp_reviews is not None:
+                dinewise.reviews_cache.set(business_id, yelp_reviews)
+
+        async def fetch():
+            await self.store(store_reviews, await self.yelp.reviews(business_id))
+
+        await self.flights.run(('reviews', business_id), fetch)
+
+    async def load_search(self, params):
+        params = dinewise.normalize_search_params(params)
+        key = dinewise.search_cache_key(params)
+        if dinewise.search_cache.peek(key) is not None:
+            return
+
+        # search_from_response also warms the business cache from the results.
+        def store_search(response):
+            dinewise.search_cache.set(key, dinewise.search_from_response(response))
+
+        async def fetch():
+            await self.store(store_search, await self.yelp.search(params))
+
+        await self.flights.run(('search', key), fetch)
+
+    async def wait_all(self, coroutines, timeout):
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        if tasks:
+            # Stragglers keep running and still fill the caches.
+            await asyncio.wait(tasks, timeout=timeout)
+
+    async def prefetch_index(self, request, view_args, environ):
+        params = dinewise.search_form_params(request.form) if request.method == 'POST' else None
+        if params:
+            await self.load_search(params)
+
+    async def prefetch_nearby(self, request, view_args, environ):
+        if request.method != 'POST':
+            return
+        coordinates = dinewise.form_coordinates(request.form)
+        if coordinates:
+            if not dinewise.geo_index.is_covered(*coordinates, dinewise.NEARBY_RADIUS_M):
+                await self.load_search(dinewise.nearby_search_params(*coordinates))
+            return
+        params = dinewise.nearby_form_params(request.form)
+        if params:
+            await self.load_search(params)
+
+    async def prefetch_restaurant_detail(self, request, view_args, environ):
+        business_id = view_args['business_id']
+        await self.wait_all([self.load_business(business_id, full=True), self.load_reviews(business_id)],
+                            dinewise.DETAIL_SOURCE_TIMEOUT)
+
+    async def prefetch_simple_restaurant_detail(self, request, view_args, environ):
+        await self.load_business(view_args['business_id'], full=True)
+
+    async def prefetch_wishlist(self, request, view_args, environ):
+        user_id = (self.session(request).get('user') or {}).get('localId')
+        if not user_id:
+            return
+        loop = asyncio.get_running_loop()
+        business_ids = await loop.run_in_executor(dinewise.firebase_executor, dinewise.load_wishlist, user_id)
+        environ[dinewise.WISHLIST_PREFETCH_KEY] = business_ids
+        await self.wait_all([self.load_business(business_id) for business_id in business_ids],
+                            dinewise.WISHLIST_DEADLINE)
+
+    async def prefetch_api_restaurants(self, request, view_args, environ):
+        business_ids, error = dinewise.restaurant_batch_ids(request.args)
+        if error:
+            return
+        business_ids = [business_id for business_id in dict.fromkeys(business_ids)
+                        if dinewise.valid_business_id(business_id)]
+        await self.wait_all([self.load_business(business_id) for business_id in business_ids],
+                            dinewise.WISHLIST_DEADLINE)
+
+    # Mirrors the view: same cache key, rate limit and "newer keystroke wins"
+    # rule, but the wait for Yelp happens here instead of on a thread.
+    async def prefetch_autocomplete(self, request, view_args, environ):
+        term = ' '.join(request.args.get('term', '').lower().split())
+        location = request.args.get('location', '')
+        if not term or not location:
+            return None
+        try:
+            cell_key, latitude, longitude = dinewise.autocomplete_cell(location)
+        except ValueError:
+            return None
+        key = f'{cell_key}|{term}'
+        # Clients without a session yet (or without cookies) are rate-limited
+        # and answered by the view, which sees the proxy-corrected address.
+        client_id = self.session(request).get('client_id')
+        if (not client_id or dinewise.autocomplete_cache.peek(key) is not None
+                or dinewise.autocomplete_prefix_seed(cell_key, term)):
+            return None
+        allowed = dinewise.autocomplete_limiter.allow(dinewise.autocomplete_client_key(client_id, None))
+        sequence = dinewise.start_autocomplete_request(client_id) if allowed else None
+        environ[dinewise.AUTOCOMPLETE_PREFETCH_KEY] = (allowed, sequence, None)
+        if not allowed:
+            return None
+        params = dinewise.autocomplete_params(term, latitude, longitude)
+
+        def store_terms(response):
+            dinewise.autocomplete_cache.set(key, dinewise.autocomplete_from_response(response))
+
+        async def fetch():
+            await self.store(store_terms, await self.yelp.autocomplete(params))
+
+        task = asyncio.ensure_future(self.flights.run(('autocomplete', key), fetch))
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + dinewise.AUTOCOMPLETE_WAIT
+        while not task.done():
+            await asyncio.wait([task], timeout=0.05)
+            if task.done():
+                break
+            # The view gives the answer, so the session and metrics are kept.
+            if dinewise.autocomplete_superseded(client_id, sequence):
+                environ[dinewise.AUTOCOMPLETE_PREFETCH_KEY] = (allowed, sequence, 'superseded')
+                return
+            if loop.time() > deadline:
+                environ[dinewise.AUTOCOMPLETE_PREFETCH_KEY] = (allowed, sequence, 'timeout')
+                return
+
+
+application = DineWiseASGI(dinewise.app)
@@ -0,0 +1,43 @@
+import argparse
+
+from firebase_config import db
+from review_stats import STATS_ROOT, NON_BUSINESS_KEYS, stats_from_reviews
+
+# Rebuilds review_stats/{business_id} from the reviews actually stored under
+# reviews/{business_id}. Safe to re-run; use it after importing reviews or if
+# an aggregate update failed while a review was being saved.
+
+def business_ids_with_reviews():
+    keys = db.reference('reviews').get(shallow=True) or {}
+    return sorted(key for key in keys if key not in NON_BUSINESS_KEYS)
+
+def rebuild_review_stats(business_ids=None, dry_run=False):
+    business_ids = business_ids or business_ids_with_reviews()
+    repaired = 0
+    for business_id in business_ids:
+        try:
+            reviews = db.reference(f'reviews/{business_id}').get() or {}
+            stats = stats_from_reviews(reviews)
+            current = db.reference(f'{STATS_ROOT}/{business_id}').get() or {}
+            if current.get('count') == stats['count'] and current.get('sum') == stats['sum']:
+                continue
+            print(f"{business_id}: {current.get('count', 0)} -> {stats['count']} reviews, "
+                  f"sum {current.get('sum', 0)} -> {stats['sum']}")
+            if not dry_run:
+                if stats['count']:
+                    db.reference(f'{STATS_ROOT}/{business_id}').set(stats)
+                else:
+                    db.reference(f'{STATS_ROOT}/{business_id}').delete()
+            repaired += 1
+        except Exception as e:
+            print(f"Error rebuilding stats for {business_id}: {e}")
+    action = "Would repair" if dry_run else "Repaired"
+    print(f"{action} {repaired} of {len(business_ids)} review aggregates.")
+    return repaired
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild per-restaurant review rating aggregates.")
+    parser.add_argument('business_ids', nargs='*', help="Only rebuild these businesses (default: all)")
+    parser.add_argument('--dry-run', action='store_true', help="Report differences without writing")
+    args = parser.parse_args()
+    rebuild_review_stats(args.business_ids, dry_run=args.dry_run)
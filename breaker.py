@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+
+import requests
+
+import logs
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATES = (CLOSED, OPEN, HALF_OPEN)
+
+
+# Raised instead of calling an upstream whose breaker is open. Like
+# UpstreamBudgetExceeded, callers treat it as a failed request (and the
+# response caches fall back to their last good copy).
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+
+# =========================
+# Circuit Breaker
+# =========================
+# One per upstream (Yelp, Firebase), per process.
+#
+#   closed     calls go through; failure_threshold failures in a row open it
+#   open       calls fail at once with CircuitOpenError for reset_timeout seconds
+#   half_open  up to half_open_calls trial calls go through; a success closes
+#              it again, a failure re-opens it for another reset_timeout
+#
+# A call counts as a failure when it raises something is_failure(error)
+# accepts (every exception by default) or, if slow_call_s is set, when it
+# succeeds but takes longer than that: a slow upstream holds worker threads
+# just like a dead one.
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, half_open_calls=1,
+                 slow_call_s=None, is_failure=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.slow_call_s = slow_call_s
+        self.is_failure = is_failure
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trials = 0
+        self.counters = {'calls': 0, 'failures': 0, 'slow_calls': 0, 'rejected': 0, 'opened': 0}
+        self.last_error = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    # Another thread may have held the lock when the process forked.
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._trials = 0
+            logs.info('circuit_half_open', upstream=self.name)
+        return self._state
+
+    # True if a call may go out now (a half-open trial takes a slot until it
+    # reports back, or is given back with cancel()).
+    def allow(self):
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and self._trials < self.half_open_calls:
+                self._trials += 1
+                return True
+            self.counters['rejected'] += 1
+            return False
+
+    # Raises CircuitOpenError unless allow().
+    def check(self):
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} is unavailable (circuit open); call not attempted")
+
+    def cancel(self):
+        with self._lock:
+            if self._state == HALF_OPEN and self._trials:
+                self._trials -= 1
+
+    def success(self, seconds=0.0):
+        if self.slow_call_s is not None and seconds > self.slow_call_s:
+            with self._lock:
+                self.counters['slow_calls'] += 1
+            self.failure(f'slow call ({seconds:.2f}s)')
+            return
+        with self._lock:
+            self.counters['calls'] += 1
+            self._failures = 0
+            if self._state != CLOSED:
+                self._state = CLOSED
+                logs.warning('circuit_closed', upstream=self.name)
+
+    def failure(self, error=None):
+        with self._lock:
+            self.counters['calls'] += 1
+            self.counters['failures'] += 1
+            self._failures += 1
+            self.last_error = str(error) if error is not None else None
+            state = self._current_state(time.monotonic())
+            if state == HALF_OPEN or state == CLOSED and self._failures >= self.failure_threshold:
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self.counters['opened'] += 1
+                reopened = state == HALF_OPEN
+            else:
+                return
+        logs.warning('circuit_opened', upstream=self.name, failures=self._failures, reopened=reopened,
+                     retry_in_s=self.reset_timeout, error=error)
+
+    # Records how a call that went out ended: error is the exception it
+    # raised, if any.
+    def record(self, seconds, error=None):
+        if error is not None and (self.is_failure is None or self.is_failure(error)):
+            self.failure(error)
+        else:
+            self.success(seconds)
+
+    def call(self, fn, *args, **kwargs):
+        self.check()
+        started = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self.record(time.perf_counter() - started, e)
+            raise
+        except BaseException:
+            # Interrupted, not an answer from the upstream: give the slot back.
+            self.cancel()
+            raise
+        self.record(time.perf_counter() - started)
+        return result
+
+    def stats(self):
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at)) if state == OPEN else 0.0
+            return dict(self.counters, state=state, consecutive_failures=self._failures,
+                        retry_in_s=round(retry_in, 1), last_error=self.last_error)
+
+
+# Settings from <PREFIX>_BREAKER_* environment variables, e.g.
+# YELP_BREAKER_THRESHOLD=5, YELP_BREAKER_RESET=30, YELP_BREAKER_SLOW_CALL=8.
+def breaker_from_env(name, prefix, is_failure=None, slow_call_s=None):
+    slow_call = os.getenv(f'{prefix}_BREAKER_SLOW_CALL')
+    return CircuitBreaker(
+        name,
+        failure_threshold=int(os.getenv(f'{prefix}_BREAKER_THRESHOLD', '5')),
+        reset_timeout=float(os.getenv(f'{prefix}_BREAKER_RESET', '30')),
+        half_open_calls=int(os.getenv(f'{prefix}_BREAKER_HALF_OPEN_CALLS', '1')),
+        slow_call_s=float(slow_call) if slow_call else slow_call_s,
+        is_failure=is_failure,
+    )
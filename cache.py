@@ -0,0 +1,451 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import logs
+import upstream
+from models import json_default
+
+FRESH = 'fresh'
+STALE = 'stale'
+
+
+# =========================
+# Shared SQLite Backend
+# =========================
+# Lets several gunicorn workers on one host reuse each other's entries.
+# Values must be JSON-serialisable.
+class SQLiteCacheBackend:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            ' namespace TEXT NOT NULL,'
+            ' key TEXT NOT NULL,'
+            ' value TEXT NOT NULL,'
+            ' stored_at REAL NOT NULL,'
+            ' expires_at REAL NOT NULL,'
+            ' stale_until REAL NOT NULL,'
+            ' PRIMARY KEY (namespace, key))'
+        )
+        conn.commit()
+
+    def _connect(self):
+        # Connections are per thread and per process: one opened before a
+        # fork (e.g. at import under gunicorn --preload) is not reused.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, namespace, key):
+        row = self._connect().execute(
+            'SELECT value, stored_at, expires_at, stale_until FROM cache'
+            ' WHERE namespace = ? AND key = ?', (namespace, key)).fetchone()
+        if row is None or row[3] < time.time():
+            return None
+        return json.loads(row[0]), len(row[0]), row[1], row[2], row[3]
+
+    def set(self, namespace, key, raw_value, stored_at, expires_at, stale_until):
+        self._connect().execute(
+            'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)',
+            (namespace, key, raw_value, stored_at, expires_at, stale_until))
+
+    # Like set(), but keeps a row that is still usable. Returns True if it wrote.
+    def set_if_absent(self, namespace, key, raw_value, stored_at, expires_at, stale_until):
+        cursor = self._connect().execute(
+            'INSERT INTO cache VALUES (?, ?, ?, ?, ?, ?)'
+            ' ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value,'
+            ' stored_at = excluded.stored_at, expires_at = excluded.expires_at,'
+            ' stale_until = excluded.stale_until WHERE cache.stale_until < excluded.stored_at',
+            (namespace, key, raw_value, stored_at, expires_at, stale_until))
+        return cursor.rowcount > 0
+
+    def delete(self, namespace, key):
+        self._connect().execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (namespace, key))
+
+    def purge(self):
+        self._connect().execute('DELETE FROM cache WHERE stale_until < ?', (time.time(),))
+
+
+# =========================
+# Single-Flight Request Coalescing
+# =========================
+# Concurrent callers asking for the same key share one in-flight call
+# instead of each hitting the upstream.
+class _Call:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+# =========================
+# Background Refresh Pool
+# =========================
+# Stale entries of every cache are reloaded on a few shared threads. Once
+# they are all busy and max_pending more refreshes are waiting, new ones are
+# dropped: the stale value is still served and a later read tries again, so
+# a slow upstream can't pile up a thread per stale key.
+class RefreshPool:
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    # A forked child starts with an empty pool of its own.
+    def _reset(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='cache-refresh')
+        self._slots = threading.BoundedSemaphore(self.workers + self.max_pending)
+
+    # Returns False, without running fn, when the pool is full.
+    def submit(self, fn):
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            return False
+
+        def run():
+            try:
+                fn()
+            finally:
+                slots.release()
+
+        self._executor.submit(run)
+        return True
+
+
+REFRESH_POOL = RefreshPool(int(os.getenv('CACHE_REFRESH_WORKERS', '8')),
+                           int(os.getenv('CACHE_REFRESH_MAX_PENDING', '64')))
+
+
+class _Entry:
+    __slots__ = ('value', 'size', 'stored_at', 'expires_at', 'stale_until')
+
+    def __init__(self, value, size, stored_at, expires_at, stale_until):
+        self.value = value
+        self.size = size
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+        self.stale_until = stale_until
+
+
+# =========================
+# TTL + LRU Response Cache
+# =========================
+class ResponseCache:
+    # fallback_ttl keeps entries this much longer than stale_ttl, in this
+    # process only, as a last resort when loading a fresh copy fails.
+    # Values are stored in the backend as JSON (models via as_dict());
+    # decode(value) turns what comes back into the cached type again.
+    def __init__(self, name, ttl, stale_ttl=0, max_entries=1000, max_bytes=32 * 1024 * 1024,
+                 backend=None, fallback_ttl=0, decode=None):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.fallback_ttl = fallback_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self.decode = decode
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._flights = SingleFlight()
+        self._counters = {
+            'hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'backend_hits': 0,
+            'evictions': 0,
+            'refreshes': 0,
+            'refresh_errors': 0,
+            'refreshes_dropped': 0,
+            'fallback_hits': 0,
+        }
+
+    # Returns (value, FRESH|STALE) or (None, None) on a miss.
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.stale_until + self.fallback_ttl < now:
+                    self._drop(key)
+                    entry = None
+                elif entry.stale_until < now:
+                    entry = None
+                else:
+                    self._entries.move_to_end(key)
+        # Another worker may already hold a fresher copy in the shared backend.
+        if self.backend is not None and (entry is None or entry.expires_at < now):
+            shared = self._load_from_backend(key)
+            if shared is not None and (entry is None or shared.expires_at > entry.expires_at):
+                entry = shared
+                self._store(key, entry)
+                self._count('backend_hits')
+        if entry is None:
+            self._count('misses')
+            return None, None
+        if entry.expires_at >= now:
+            self._count('hits')
+            return entry.value, FRESH
+        self._count('stale_hits')
+        return entry.value, STALE
+
+    def set(self, key, value, ttl=None):
+        raw_value, entry = self._entry(value, ttl)
+        self._store(key, entry)
+        if self.backend is not None:
+            try:
+                self.backend.set(self.name, key, raw_value, entry.stored_at,
+                                 entry.expires_at, entry.stale_until)
+            except sqlite3.Error as e:
+                logs.warning('cache_backend_write_failed', cache=self.name, key=key, error=e)
+
+    def _entry(self, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        raw_value = json.dumps(value, separators=(',', ':'), default=json_default)
+        now = time.time()
+        return raw_value, _Entry(value, len(raw_value), now, now + ttl, now + ttl + self.stale_ttl)
+
+    # Reads the in-process tier without touching stats or LRU order.
+    def peek(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry.stale_until < time.time():
+            return None
+        return entry.value
+
+    # An entry past its stale window but still kept for fallback_ttl.
+    def fallback(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry.stale_until + self.fallback_ttl < time.time():
+            return None
+        return entry.value
+
+    # Expiry time of the freshest usable copy (this process or the shared
+    # backend), or None if there is none. Doesn't touch stats or LRU order.
+    def expires_at(self, key, accept=None):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+        candidates = [entry] if entry is not None else []
+        if self.backend is not None:
+            shared = self._load_from_backend(key)
+            if shared is not None:
+                candidates.append(shared)
+        usable = [candidate.expires_at for candidate in candidates
+                  if candidate.stale_until >= now and (accept is None or accept(candidate.value))]
+        return max(usable) if usable else None
+
+    # Used to warm the cache from partial data without clobbering a real
+    # entry, here or one another worker put in the shared backend.
+    def set_if_absent(self, key, value, ttl=None):
+        with self._lock:
+            if key in self._entries:
+                return False
+        raw_value, entry = self._entry(value, ttl)
+        if self.backend is not None:
+            try:
+                if not self.backend.set_if_absent(self.name, key, raw_value, entry.stored_at,
+                                                  entry.expires_at, entry.stale_until):
+                    return False
+            except sqlite3.Error as e:
+                logs.warning('cache_backend_write_failed', cache=self.name, key=key, error=e)
+        with self._lock:
+            if key in self._entries:
+                return False
+        self._store(key, entry)
+        return True
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+        if self.backend is not None:
+            try:
+                self.backend.delete(self.name, key)
+            except sqlite3.Error as e:
+                logs.warning('cache_backend_delete_failed', cache=self.name, key=key, error=e)
+
+    # loader() returns the value to cache, or None for "nothing to cache".
+    # Stale entries are served immediately while one background thread
+    # per key reloads them; concurrent misses share a single loader call.
+    # accept(value) can reject a cached value (e.g. partial data) so it is
+    # reloaded, though it is still returned if the reload comes back empty.
+    # If the load fails or comes back empty, whatever older copy is still
+    # kept (see fallback_ttl) is returned instead.
+    def get_or_load(self, key, loader, accept=None):
+        cached, state = self.lookup(key, loader, accept)
+        if state is None:
+            cached, state = self.load_or_fallback(key, loader, cached)
+        return cached
+
+    # The two halves of get_or_load, for callers that answer hits straight
+    # away and load the misses elsewhere (e.g. several at once on a pool).
+    # lookup() returns (value, FRESH|STALE) for a usable entry, refreshing a
+    # stale one in the background, or (rejected value or None, None) when
+    # the key has to be loaded. load_or_fallback() then loads it, returning
+    # (value, FRESH), or (older copy, STALE) when the load fails or comes
+    # back empty, or (None, None).
+    def lookup(self, key, loader, accept=None):
+        cached, state = self.get(key)
+        if state is not None and accept is not None and not accept(cached):
+            return cached, None
+        if state == STALE:
+            self.refresh_in_background(key, loader)
+        return cached, state
+
+    def load_or_fallback(self, key, loader, cached=None):
+        try:
+            value = self.load(key, loader)
+        except Exception:
+            value = None
+            if cached is None and self.fallback(key) is None:
+                raise
+        if value is not None:
+            return value, FRESH
+        if cached is None:
+            cached = self.fallback(key)
+            if cached is not None:
+                self._count('fallback_hits')
+        return cached, STALE if cached is not None else None
+
+    # Runs loader() for a key (shared by concurrent callers) and stores the result.
+    def load(self, key, loader):
+        def load_and_store():
+            value = loader()
+            if value is not None:
+                self.set(key, value)
+            return value
+
+        return self._flights.do(key, load_and_store)
+
+    def refresh_in_background(self, key, loader):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                with upstream.background():
+                    value = loader()
+                if value is not None:
+                    self.set(key, value)
+                self._count('refreshes')
+            except Exception as e:
+                self._count('refresh_errors')
+                logs.warning('cache_refresh_failed', cache=self.name, key=key, error=e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        if not REFRESH_POOL.submit(refresh):
+            with self._lock:
+                self._refreshing.discard(key)
+                self._counters['refreshes_dropped'] += 1
+
+    def _load_from_backend(self, key):
+        try:
+            row = self.backend.get(self.name, key)
+        except sqlite3.Error as e:
+            logs.warning('cache_backend_read_failed', cache=self.name, key=key, error=e)
+            return None
+        if row is None:
+            return None
+        entry = _Entry(*row)
+        if self.decode is not None:
+            entry.value = self.decode(entry.value)
+        return entry
+
+    def _store(self, key, entry):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while self._entries and (len(self._entries) > self.max_entries or
+                                     self._bytes > self.max_bytes):
+                oldest_key = next(iter(self._entries))
+                self._drop(oldest_key)
+                self._counters['evictions'] += 1
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        stats['coalesced'] = self._flights.coalesced
+        lookups = stats['hits'] + stats['stale_hits'] + stats['misses']
+        stats['hit_ratio'] = round((stats['hits'] + stats['stale_hits']) / lookups, 3) if lookups else 0.0
+        return stats
+
+
+def backend_from_env():
+    path = os.getenv('YELP_CACHE_DB')
+    if not path:
+        return None
+    try:
+        return SQLiteCacheBackend(path)
+    except sqlite3.Error as e:
+        logs.warning('cache_backend_unavailable', path=path, error=e)
+        return None
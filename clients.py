@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+
+import firebase_admin
+
+import logs
+
+# =========================
+# Lazy Firebase Client Registry
+# =========================
+# The Firebase Admin SDK app and the Pyrebase client are built the first
+# time something asks for them rather than when app.py, firebase_config.py
+# or init_db.py is imported: pyrebase alone pulls in oauth2client and
+# google.cloud.storage (~0.5 s), and pages that never touch Firebase (or
+# runs on local storage and local auth) don't need either.
+#
+# Clients are per process. A worker forked from a preloaded parent
+# (gunicorn --preload) drops whatever the parent had built, closing it via
+# the client's close hook, and builds its own on first use, so HTTP
+# connections and credential refresh state are never shared between
+# processes. A client that fails to build is reported once and stays
+# unavailable (None) in that process, as before.
+CREDENTIALS_PATH = 'dinewise-1ade0-firebase-adminsdk-fbsvc-826e342dd1.json'
+CONFIG_PATH = 'firebase_config.json'
+DEFAULT_DATABASE_URL = 'https://your-project-id.firebaseio.com'
+
+
+class ClientRegistry:
+    def __init__(self):
+        self._factories = {}
+        self._clients = {}
+        self._errors = {}
+        self._inherited = {}
+        self._lock = threading.RLock()
+        self.init_seconds = {}
+        self.forks = 0
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    # factory() builds the client; close(client) releases one inherited
+    # from the parent process before this process builds its own.
+    def register(self, name, factory, close=None):
+        self._factories[name] = (factory, close)
+
+    def get(self, name):
+        client = self._clients.get(name)
+        if client is not None or name in self._errors:
+            return client
+        factory, close = self._factories[name]
+        with self._lock:
+            if name in self._clients or name in self._errors:
+                return self._clients.get(name)
+            inherited = self._inherited.pop(name, None)
+            if inherited is not None and close is not None:
+                try:
+                    close(inherited)
+                except Exception as e:
+                    logs.warning('client_close_failed', client=name, error=e)
+            started = time.perf_counter()
+            try:
+                client = factory()
+            except Exception as e:
+                self._errors[name] = str(e)
+                logs.warning('client_init_failed', client=name, error=e)
+                return None
+            self.init_seconds[name] = time.perf_counter() - started
+            self._clients[name] = client
+            print(f"✅ {name} initialized in {self.init_seconds[name] * 1000:.0f} ms")
+            return client
+
+    def initialized(self, name):
+        return name in self._clients
+
+    # Runs in the child right after fork(), where only the forking thread
+    # exists: nothing here may block on a lock another thread held.
+    def _after_fork(self):
+        self._lock = threading.RLock()
+        self._inherited.update(self._clients)
+        self._clients = {}
+        self._errors = {}
+        self.init_seconds = {}
+        self.forks += 1
+
+    def stats(self):
+        return {
+            'initialized': sorted(self._clients),
+            'failed': dict(self._errors),
+            'init_ms': {name: round(seconds * 1000, 1) for name, seconds in self.init_seconds.items()},
+            'forks': self.forks,
+        }
+
+
+CLIENTS = ClientRegistry()
+
+
+# =========================
+# Firebase Admin SDK
+# =========================
+def _firebase_admin_app():
+    from firebase_admin import credentials
+    try:
+        # Initialised by someone else in this process (e.g. an importing script).
+        return firebase_admin.get_app()
+    except ValueError:
+        pass
+    cred = credentials.Certificate(os.getenv('FIREBASE_CREDENTIALS_PATH', CREDENTIALS_PATH))
+    return firebase_admin.initialize_app(cred, {
+        'databaseURL': os.getenv('FIREBASE_DATABASE_URL', DEFAULT_DATABASE_URL),
+        # Realtime Database calls otherwise wait up to two minutes.
+        'httpTimeout': float(os.getenv('FIREBASE_HTTP_TIMEOUT', '10')),
+    })
+
+
+CLIENTS.register('Firebase Admin SDK', _firebase_admin_app, close=firebase_admin.delete_app)
+
+
+def firebase_app():
+    return CLIENTS.get('Firebase Admin SDK')
+
+
+# =========================
+# Pyrebase Client
+# =========================
+# firebase_config.json if present, otherwise the FIREBASE_* environment variables.
+def pyrebase_config():
+    path = os.getenv('FIREBASE_CONFIG_PATH', CONFIG_PATH)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {
+        "apiKey": os.getenv('FIREBASE_API_KEY'),
+        "authDomain": os.getenv('FIREBASE_AUTH_DOMAIN'),
+        "projectId": os.getenv('FIREBASE_PROJECT_ID'),
+        "storageBucket": os.getenv('FIREBASE_STORAGE_BUCKET'),
+        "messagingSenderId": os.getenv('FIREBASE_MESSAGING_SENDER_ID'),
+        "appId": os.getenv('FIREBASE_APP_ID'),
+        "databaseURL": os.getenv('FIREBASE_DATABASE_URL')
+    }
+
+
+def _pyrebase_app():
+    import pyrebase
+    return pyrebase.initialize_app(pyrebase_config())
+
+
+CLIENTS.register('Firebase client', _pyrebase_app)
+
+
+def pyrebase_app():
+    return CLIENTS.get('Firebase client')
+
+
+def pyrebase_auth():
+    firebase = pyrebase_app()
+    return firebase.auth() if firebase is not None else None
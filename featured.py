@@ -0,0 +1,144 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate
+
+import logs
+import upstream
+from cache import SingleFlight
+
+
+class FeaturedList:
+    __slots__ = ('location', 'body', 'etag', 'last_modified', 'refreshed_at')
+
+    def __init__(self, location, body, etag, last_modified, refreshed_at):
+        self.location = location
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.refreshed_at = refreshed_at
+
+
+# =========================
+# Precomputed Featured Lists
+# =========================
+# Serialised JSON per location, kept in memory and rebuilt by a background
+# thread every refresh_interval seconds. Only the default locations and
+# locations users actually searched for (see remember) join the refresh
+# rotation; least recently requested searched ones drop out, defaults never
+# do. Any other location is built for that request and not kept.
+class FeaturedLists:
+    def __init__(self, loader, refresh_interval=900, max_locations=200, default_locations=(),
+                 max_location_length=100):
+        self.loader = loader
+        self.refresh_interval = refresh_interval
+        self.max_locations = max_locations
+        self.max_location_length = max_location_length
+        self.default_locations = tuple(default_locations)
+        self._defaults = {self.normalize(location) for location in self.default_locations}
+        self._searched = OrderedDict()
+        self._lists = OrderedDict()
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+        self._thread = None
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    @staticmethod
+    def normalize(location):
+        return ' '.join((location or '').lower().split())
+
+    def get(self, location):
+        self.start()
+        key = self.normalize(location)
+        with self._lock:
+            featured = self._lists.get(key)
+            if featured is not None:
+                self._lists.move_to_end(key)
+                return featured
+            kept = key in self._defaults or key in self._searched
+        if kept:
+            return self._flights.do(key, lambda: self.refresh(location))
+        return self._flights.do(key, lambda: self.build(location))
+
+    # Records a location a user searched for, making it eligible for the
+    # refresh rotation the next time its featured list is requested.
+    def remember(self, location):
+        key = self.normalize(location)
+        if not key or len(key) > self.max_location_length or key in self._defaults:
+            return
+        with self._lock:
+            self._searched[key] = True
+            self._searched.move_to_end(key)
+            while len(self._searched) > self.max_locations:
+                self._searched.popitem(last=False)
+
+    def build(self, location, previous=None):
+        restaurants = self.loader(location)
+        body = json.dumps({'location': location, 'restaurants': restaurants},
+                          separators=(',', ':')).encode('utf-8')
+        etag = hashlib.sha1(body).hexdigest()
+        now = time.time()
+        # Last-Modified only moves when the content actually changes.
+        if previous is not None and previous.etag == etag:
+            last_modified = previous.last_modified
+        else:
+            last_modified = formatdate(now, usegmt=True)
+        return FeaturedList(location, body, etag, last_modified, now)
+
+    def refresh(self, location):
+        key = self.normalize(location)
+        with self._lock:
+            previous = self._lists.get(key)
+        featured = self.build(location, previous)
+        with self._lock:
+            self._lists[key] = featured
+            self._lists.move_to_end(key)
+            if len(self._lists) > self.max_locations:
+                evictable = [k for k in self._lists if k not in self._defaults]
+                for stale in evictable[:len(self._lists) - self.max_locations]:
+                    del self._lists[stale]
+            self.refreshes += 1
+        return featured
+
+    def refresh_all(self):
+        with self._lock:
+            locations = [featured.location for featured in self._lists.values()]
+        for location in locations:
+            try:
+                self.refresh(location)
+            except Exception as e:
+                self.refresh_errors += 1
+                logs.warning('featured_refresh_failed', location=location, error=e)
+
+    # The worker starts on first use rather than at import, so forking
+    # servers start it in each worker instead of only in the master.
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='featured-refresh', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        with upstream.background():
+            for location in self.default_locations:
+                try:
+                    self.refresh(location)
+                except Exception as e:
+                    self.refresh_errors += 1
+                    logs.warning('featured_preload_failed', location=location, error=e)
+            while True:
+                time.sleep(self.refresh_interval)
+                self.refresh_all()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'locations': len(self._lists),
+                'searched_locations': len(self._searched),
+                'refreshes': self.refreshes,
+                'refresh_errors': self.refresh_errors,
+            }
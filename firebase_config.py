@@ -1,43 +1,19 @@
-import os
-import pyrebase
-import firebase_admin
-from firebase_admin import credentials, db
 from dotenv import load_dotenv
 
+import clients
+import storage
+
 # Load environment variables
 load_dotenv()
 
-# Firebase configuration
-firebase_config = {
-    "apiKey": os.getenv('FIREBASE_API_KEY'),
-    "authDomain": os.getenv('FIREBASE_AUTH_DOMAIN'),
-    "projectId": os.getenv('FIREBASE_PROJECT_ID'),
-    "storageBucket": os.getenv('FIREBASE_STORAGE_BUCKET'),
-    "messagingSenderId": os.getenv('FIREBASE_MESSAGING_SENDER_ID'),
-    "appId": os.getenv('FIREBASE_APP_ID'),
-    "databaseURL": os.getenv('FIREBASE_DATABASE_URL')
-}
-
-# Initialize Firebase Admin SDK
-cred_path = os.getenv('FIREBASE_CREDENTIALS_PATH', "dinewise-1ade0-firebase-adminsdk-fbsvc-826e342dd1.json")
-try:
-    if os.path.exists(cred_path):
-        cred = credentials.Certificate(cred_path)
-        firebase_admin.initialize_app(cred, {
-            'databaseURL': os.getenv('FIREBASE_DATABASE_URL')
-        })
-    else:
-        print(f"WARNING: Firebase credentials file not found at {cred_path}")
-except ValueError:
-    # App already initialized
-    pass
-except Exception as e:
-    print(f"Firebase Admin SDK initialization error: {e}")
-
-# Initialize Pyrebase for authentication
-firebase = pyrebase.initialize_app(firebase_config)
-auth = firebase.auth()
+# Firebase configuration (firebase_config.json, or the FIREBASE_* variables)
+firebase_config = clients.pyrebase_config()
 
-# Export the database reference
-db = firebase_admin.db
+# The Admin SDK app and Pyrebase client come from the shared lazy registry
+# in clients.py; these helpers initialise them on first call.
+firebase_app = clients.firebase_app
+pyrebase_auth = clients.pyrebase_auth
 
+# Export the database (Firebase unless DINEWISE_STORAGE=local); the Admin
+# SDK is initialised by the first reference made through it.
+db = storage.database()
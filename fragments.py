@@ -0,0 +1,98 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from models import Model, json_default
+
+# =========================
+# Rendered Fragment Cache
+# =========================
+# HTML of template fragments that look the same for every visitor, keyed by
+# (template, scope, content hash of the fragment's context). Changed source
+# data simply hashes to a new key; invalidate(scope) drops everything cached
+# for one scope (a business id) at once, e.g. after a review is written.
+# Entries remember the Template they were rendered from, so an edited
+# template (TEMPLATES_AUTO_RELOAD) never serves old markup.
+
+
+# memo maps id(value) -> digest for dicts, lists and models already hashed in this
+# request, so a restaurant shared by several fragments is serialised once.
+# Key order is not normalised: reordered data only costs a cache miss.
+def content_hash(context, memo=None):
+    digest = hashlib.sha1()
+    for name, value in context.items():
+        part = memo.get(id(value)) if memo is not None else None
+        if part is None:
+            raw = json.dumps(value, separators=(',', ':'), default=json_default)
+            part = hashlib.sha1(raw.encode('utf-8')).digest()
+            if memo is not None and isinstance(value, (dict, list, Model)):
+                memo[id(value)] = part
+        digest.update(name.encode('utf-8'))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class FragmentCache:
+    def __init__(self, max_entries=5000, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._scopes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key, template):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] is not template:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, template, html, scope=None):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (template, html, scope)
+            self._bytes += len(html)
+            if scope is not None:
+                self._scopes.setdefault(scope, set()).add(key)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, scope):
+        with self._lock:
+            keys = self._scopes.pop(scope, ())
+            for key in keys:
+                if key in self._entries:
+                    self._drop(key)
+            self.invalidations += 1
+            return len(keys)
+
+    def _drop(self, key):
+        template, html, scope = self._entries.pop(key)
+        self._bytes -= len(html)
+        if scope is not None:
+            keys = self._scopes.get(scope)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._scopes[scope]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
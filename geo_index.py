@@ -0,0 +1,147 @@
+import heapq
+import math
+import threading
+import time
+from collections import OrderedDict
+
+METERS_PER_DEGREE_LAT = 110540.0
+METERS_PER_DEGREE_LNG = 111320.0
+
+
+# =========================
+# Grid-Bucketed Business Index
+# =========================
+# Every business seen in a Yelp response is filed under a lat/lng grid cell.
+# Nearby queries only scan the cells overlapping the search circle, and use an
+# equirectangular distance, which is accurate to well under 1% at city scale.
+# A cell counts as "covered" once a Yelp search around it has been indexed;
+# callers only need to go upstream when part of the circle is not covered.
+class GeoIndex:
+    def __init__(self, cell_degrees=0.005, coverage_ttl=6 * 3600, max_businesses=200000):
+        self.cell_degrees = cell_degrees
+        self.coverage_ttl = coverage_ttl
+        self.max_businesses = max_businesses
+        self._cells = {}
+        self._businesses = OrderedDict()
+        self._covered = {}
+        self._dense = {}
+        self._lock = threading.Lock()
+        self.queries = 0
+
+    def _cell(self, latitude, longitude):
+        return (math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees))
+
+    def _cells_around(self, latitude, longitude, radius_m):
+        lat_delta = radius_m / METERS_PER_DEGREE_LAT
+        lng_delta = radius_m / (METERS_PER_DEGREE_LNG * max(math.cos(math.radians(latitude)), 0.01))
+        min_row, min_col = self._cell(latitude - lat_delta, longitude - lng_delta)
+        max_row, max_col = self._cell(latitude + lat_delta, longitude + lng_delta)
+        return [(row, col) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1)]
+
+    def add(self, business):
+        latitude, longitude = business.coordinates.latitude, business.coordinates.longitude
+        business_id = business.id
+        if business_id is None or latitude is None or longitude is None:
+            return False
+        cell = self._cell(latitude, longitude)
+        with self._lock:
+            previous = self._businesses.pop(business_id, None)
+            if previous is not None:
+                self._remove_from_cell(business_id, previous[3])
+            self._businesses[business_id] = (business, latitude, longitude, cell)
+            self._cells.setdefault(cell, {})[business_id] = (latitude, longitude)
+            while len(self._businesses) > self.max_businesses:
+                evicted_id, evicted = self._businesses.popitem(last=False)
+                self._remove_from_cell(evicted_id, evicted[3])
+        return True
+
+    def _remove_from_cell(self, business_id, cell):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.pop(business_id, None)
+            if not members:
+                del self._cells[cell]
+
+    def add_many(self, businesses):
+        for business in businesses:
+            self.add(business)
+
+    def get(self, business_id):
+        with self._lock:
+            entry = self._businesses.get(business_id)
+        return entry[0] if entry else None
+
+    # Nearest and farthest distance (m) from a point to a cell's rectangle.
+    def _cell_extent_m(self, cell, latitude, longitude, cos_lat):
+        row, col = cell
+        south, north = row * self.cell_degrees, (row + 1) * self.cell_degrees
+        west, east = col * self.cell_degrees, (col + 1) * self.cell_degrees
+        near_dy = (min(max(latitude, south), north) - latitude) * METERS_PER_DEGREE_LAT
+        near_dx = (min(max(longitude, west), east) - longitude) * METERS_PER_DEGREE_LNG * cos_lat
+        far_dy = max(abs(south - latitude), abs(north - latitude)) * METERS_PER_DEGREE_LAT
+        far_dx = max(abs(west - longitude), abs(east - longitude)) * METERS_PER_DEGREE_LNG * cos_lat
+        return math.hypot(near_dx, near_dy), math.hypot(far_dx, far_dy)
+
+    # Only cells lying entirely inside the searched circle are marked, since a
+    # Yelp radius search says nothing about what lies outside it.
+    def mark_covered(self, latitude, longitude, radius_m):
+        now = time.time()
+        cos_lat = math.cos(math.radians(latitude))
+        with self._lock:
+            for cell in self._cells_around(latitude, longitude, radius_m):
+                if self._cell_extent_m(cell, latitude, longitude, cos_lat)[1] <= radius_m:
+                    self._covered[cell] = now
+
+    def is_covered(self, latitude, longitude, radius_m):
+        cutoff = time.time() - self.coverage_ttl
+        cos_lat = math.cos(math.radians(latitude))
+        with self._lock:
+            return all(self._covered.get(cell, 0) >= cutoff
+                       for cell in self._cells_around(latitude, longitude, radius_m)
+                       if self._cell_extent_m(cell, latitude, longitude, cos_lat)[0] <= radius_m)
+
+    # Cells inside a circle with too many matches to index whole; searches
+    # starting in one skip straight to a nearest-first Yelp search.
+    def mark_dense(self, latitude, longitude, radius_m):
+        now = time.time()
+        cos_lat = math.cos(math.radians(latitude))
+        with self._lock:
+            for cell in self._cells_around(latitude, longitude, radius_m):
+                if self._cell_extent_m(cell, latitude, longitude, cos_lat)[1] <= radius_m:
+                    self._dense[cell] = now
+
+    def is_dense(self, latitude, longitude):
+        cutoff = time.time() - self.coverage_ttl
+        with self._lock:
+            return self._dense.get(self._cell(latitude, longitude), 0) >= cutoff
+
+    # Returns [(distance_m, business)] nearest first.
+    def nearby(self, latitude, longitude, radius_m, limit=20):
+        cos_lat = math.cos(math.radians(latitude))
+        radius_sq = radius_m * radius_m
+        candidates = []
+        with self._lock:
+            self.queries += 1
+            for cell in self._cells_around(latitude, longitude, radius_m):
+                members = self._cells.get(cell)
+                if not members:
+                    continue
+                for business_id, (lat, lng) in members.items():
+                    dy = (lat - latitude) * METERS_PER_DEGREE_LAT
+                    dx = (lng - longitude) * METERS_PER_DEGREE_LNG * cos_lat
+                    distance_sq = dx * dx + dy * dy
+                    if distance_sq <= radius_sq:
+                        candidates.append((distance_sq, business_id))
+            nearest = heapq.nsmallest(limit, candidates)
+            return [(math.sqrt(distance_sq), self._businesses[business_id][0])
+                    for distance_sq, business_id in nearest]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'businesses': len(self._businesses),
+                'cells': len(self._cells),
+                'covered_cells': len(self._covered),
+                'dense_cells': len(self._dense),
+                'queries': self.queries,
+            }
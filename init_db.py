@@ -1,9 +1,48 @@
+import requests
+
+import clients
+import storage
 from firebase_config import db
 
+# Realtime Database index rules the app's queries rely on. Merged into the
+# project's existing rules by apply_index_rules().
+INDEX_RULES = {
+    # Paginated user reviews: order_by_child('timestamp') + limit_to_last(n)
+    'reviews': {
+        '$business_id': {
+            '.indexOn': ['timestamp']
+        }
+    }
+}
+
+def merge_rules(existing, additions):
+    for key, value in additions.items():
+        if isinstance(value, dict) and isinstance(existing.get(key), dict):
+            merge_rules(existing[key], value)
+        else:
+            existing[key] = value
+    return existing
+
+def apply_index_rules():
+    app = clients.firebase_app()
+    if app is None:
+        raise ValueError("Firebase Admin SDK is not initialized")
+    database_url = app.options.get('databaseURL')
+    if not database_url:
+        raise ValueError("FIREBASE_DATABASE_URL is not set")
+    rules_url = f"{database_url.rstrip('/')}/.settings/rules.json"
+    headers = {'Authorization': f'Bearer {app.credential.get_access_token().access_token}'}
+    response = requests.get(rules_url, headers=headers, timeout=10)
+    response.raise_for_status()
+    rules = response.json()
+    merge_rules(rules.setdefault('rules', {}), INDEX_RULES)
+    response = requests.put(rules_url, headers=headers, json=rules, timeout=10)
+    response.raise_for_status()
+
 def initialize_database():
     # Create root nodes if they don't exist
-    collections = ['users', 'reviews', 'wishlists']
-    
+    collections = ['users', 'reviews', 'wishlists', 'review_stats']
+
     for collection in collections:
         # Just try to create a dummy entry to ensure the node exists
         try:
@@ -13,16 +52,18 @@ def initialize_database():
         except Exception as e:
             print(f"Error initializing {collection}: {e}")
 
-    # Create indexes for reviews (in Realtime Database, this is just a convention)
-    try:
-        db.reference('reviews/indexes').set({
-            'business_id_index': True
-        })
-    except Exception as e:
-        print(f"Error creating indexes: {e}")
+    # Deploy the index rules used by the review queries
+    if storage.is_local():
+        print("Local storage needs no index rules.")
+    else:
+        try:
+            apply_index_rules()
+            print("Index rules applied.")
+        except Exception as e:
+            print(f"Error applying index rules: {e}")
+            print("Add these rules manually in the Firebase console:", INDEX_RULES)
 
     print("Database initialization complete!")
 
 if __name__ == "__main__":
-    initialize_database() 
-
+    initialize_database()
@@ -0,0 +1,337 @@
+import argparse
+import contextlib
+import itertools
+import json
+import logging
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+# =========================
+# Load Test Harness
+# =========================
+# Drives the real Flask routes with weighted journey mixes and reports
+# throughput and p50/p95/p99 latency per route, plus Yelp calls (from the
+# stub's counters) and storage operations per request. By default the app is
+# started in-process against yelp_stub.py, local storage and local auth, so a
+# run needs no network access and no credentials:
+#
+#   python loadtest.py --mix browse --concurrency 16 --duration 30
+#   python loadtest.py --mix engaged --compare loadtest_results/<earlier run>.json
+#
+# In-process runs share one interpreter (and GIL) with the client threads, so
+# they are best for comparing commits. For absolute numbers, use --target
+# against an app that is already up under a real server, started with
+# YELP_API_BASE pointing at a yelp_stub.py that is passed as --stub.
+# Results are written as JSON under loadtest_results/ so two commits can be
+# compared with --compare or any JSON diff.
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'loadtest_results')
+
+# Rough San Francisco bounding box for nearby and autocomplete locations.
+SF_BOUNDS = ((37.70, 37.81), (-122.51, -122.38))
+SEARCH_TERMS = ['pizza', 'sushi', 'tacos', 'ramen', 'brunch', 'coffee', 'thai', 'burgers', 'vegan', 'dim sum']
+SEARCH_LOCATIONS = ['San Francisco, CA', 'Oakland, CA', 'Berkeley, CA', 'San Jose, CA']
+TYPING_WORDS = ['pizza', 'pasta', 'sushi', 'sandwich', 'thai', 'tacos', 'tapas', 'burger', 'brunch', 'bakery']
+
+# Route weights per journey mix.
+MIXES = {
+    'browse': {'home': 10, 'search': 20, 'nearby': 10, 'restaurant': 40, 'autocomplete': 15, 'wishlist': 5},
+    'engaged': {'search': 10, 'restaurant': 30, 'wishlist': 20, 'add_to_wishlist': 15, 'add_review': 15,
+                'autocomplete': 10},
+    'typing': {'autocomplete': 80, 'search': 20},
+}
+
+
+class Journey:
+    def __init__(self, base_url, catalog_size, zipf_s, rng):
+        self.base_url = base_url.rstrip('/')
+        self.rng = rng
+        self.session = requests.Session()
+        self.business_ids = [f'loadtest-biz-{rank:05d}' for rank in range(catalog_size)]
+        self.cumulative = list(itertools.accumulate(1.0 / (rank + 1) ** zipf_s for rank in range(catalog_size)))
+
+    def business_id(self):
+        return self.rng.choices(self.business_ids, cum_weights=self.cumulative)[0]
+
+    def point(self):
+        (south, north), (west, east) = SF_BOUNDS
+        return round(self.rng.uniform(south, north), 5), round(self.rng.uniform(west, east), 5)
+
+    def login(self, user_number):
+        return self.session.post(f'{self.base_url}/login', allow_redirects=False,
+                                 data={'email': f'user{user_number}@loadtest.local', 'password': 'loadtest'})
+
+    def request(self, route):
+        rng = self.rng
+        if route == 'home':
+            return self.session.get(f'{self.base_url}/', allow_redirects=False)
+        if route == 'search':
+            return self.session.post(f'{self.base_url}/', allow_redirects=False,
+                                     data={'location': rng.choice(SEARCH_LOCATIONS), 'term': rng.choice(SEARCH_TERMS)})
+        if route == 'nearby':
+            latitude, longitude = self.point()
+            return self.session.post(f'{self.base_url}/nearby', allow_redirects=False,
+                                     data={'latitude': latitude, 'longitude': longitude})
+        if route == 'restaurant':
+            return self.session.get(f'{self.base_url}/restaurant/{self.business_id()}', allow_redirects=False)
+        if route == 'wishlist':
+            return self.session.get(f'{self.base_url}/wishlist', allow_redirects=False)
+        if route == 'add_to_wishlist':
+            return self.session.get(f'{self.base_url}/add_to_wishlist/{self.business_id()}', allow_redirects=False)
+        if route == 'add_review':
+            return self.session.post(f'{self.base_url}/add_review/{self.business_id()}', allow_redirects=False,
+                                     data={'rating': rng.randint(1, 5), 'comment': 'Load test review'})
+        if route == 'autocomplete':
+            word = rng.choice(TYPING_WORDS)
+            latitude, longitude = self.point()
+            return self.session.get(f'{self.base_url}/api/autocomplete', allow_redirects=False,
+                                    params={'term': word[:rng.randint(2, len(word))],
+                                            'location': f'{latitude},{longitude}'})
+        raise ValueError(f'Unknown route {route}')
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(int(math.ceil(p / 100.0 * len(sorted_values))) - 1, 0)]
+
+
+# =========================
+# Run
+# =========================
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.statuses = {}
+        self.errors = {}
+        self.measuring = False
+        self._lock = threading.Lock()
+
+    def record(self, route, elapsed_ms, status):
+        if not self.measuring:
+            return
+        with self._lock:
+            self.samples.setdefault(route, []).append(elapsed_ms)
+            counts = self.statuses.setdefault(route, {})
+            counts[str(status)] = counts.get(str(status), 0) + 1
+            if status == 'error' or (isinstance(status, int) and status >= 500):
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+
+def worker(number, args, base_url, recorder, stop, seed):
+    rng = random.Random(seed + number)
+    journey = Journey(base_url, args.catalog, args.zipf, rng)
+    journey.login(number)
+    routes = list(MIXES[args.mix])
+    weights = [MIXES[args.mix][route] for route in routes]
+    while not stop.is_set():
+        route = rng.choices(routes, weights)[0]
+        started = time.perf_counter()
+        try:
+            status = journey.request(route).status_code
+        except requests.RequestException:
+            status = 'error'
+        recorder.record(route, (time.perf_counter() - started) * 1000, status)
+        if args.think_ms:
+            time.sleep(rng.uniform(0, 2 * args.think_ms) / 1000.0)
+
+
+def stub_stats(stub_url):
+    try:
+        return requests.get(f'{stub_url}/__stub/stats', timeout=5).json()
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def storage_operations(app_module):
+    if app_module is None:
+        return None
+    return {operation: stats['requests'] for operation, stats in app_module.db.stats()['operations'].items()}
+
+
+def diff_counts(after, before):
+    if after is None or before is None:
+        return None
+    return {key: after.get(key, 0) - before.get(key, 0) for key in after if after.get(key, 0) - before.get(key, 0)}
+
+
+def start_in_process(args):
+    import yelp_stub
+    stub = yelp_stub.start_stub(port=0, latency_ms=args.stub_latency_ms, jitter_ms=args.stub_jitter_ms,
+                                error_rate=args.stub_error_rate)
+    stub_url = f'http://127.0.0.1:{stub.server_address[1]}'
+    os.environ['YELP_API_BASE'] = f'{stub_url}/v3'
+    os.environ['DINEWISE_STORAGE'] = 'local'
+    os.environ['DINEWISE_LOCAL_AUTH'] = '1'
+    from werkzeug.serving import make_server
+    import app as app_module
+    if not args.show_app_output:
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='loadtest-app', daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}', stub_url, app_module
+
+
+def summarize(recorder, measured_s):
+    routes = {}
+    total = 0
+    for route, samples in sorted(recorder.samples.items()):
+        samples.sort()
+        total += len(samples)
+        routes[route] = {
+            'requests': len(samples),
+            'errors': recorder.errors.get(route, 0),
+            'rps': round(len(samples) / measured_s, 2),
+            'mean_ms': round(sum(samples) / len(samples), 2),
+            'p50_ms': round(percentile(samples, 50), 2),
+            'p95_ms': round(percentile(samples, 95), 2),
+            'p99_ms': round(percentile(samples, 99), 2),
+            'max_ms': round(samples[-1], 2),
+            'statuses': recorder.statuses.get(route, {}),
+        }
+    everything = sorted(sample for samples in recorder.samples.values() for sample in samples)
+    overall = {
+        'requests': total,
+        'errors': sum(recorder.errors.values()),
+        'rps': round(total / measured_s, 2),
+        'p50_ms': round(percentile(everything, 50), 2),
+        'p95_ms': round(percentile(everything, 95), 2),
+        'p99_ms': round(percentile(everything, 99), 2),
+    }
+    return overall, routes
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_report(result, baseline=None):
+    print(f"\nMix '{result['config']['mix']}', {result['config']['concurrency']} users, "
+          f"{result['config']['duration_s']}s @ {result['commit']}")
+    header = f"{'route':<16}{'reqs':>8}{'err':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}"
+    print(header)
+    print('-' * len(header))
+    rows = list(result['routes'].items()) + [('TOTAL', result['overall'])]
+    for route, stats in rows:
+        print(f"{route:<16}{stats['requests']:>8}{stats['errors']:>6}{stats['rps']:>9.1f}"
+              f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}")
+        if baseline:
+            before = baseline['overall'] if route == 'TOTAL' else baseline.get('routes', {}).get(route)
+            if before:
+                print(f"{'  vs baseline':<16}{'':>14}{_delta(stats['rps'], before['rps']):>9}"
+                      f"{_delta(stats['p50_ms'], before['p50_ms']):>9}{_delta(stats['p95_ms'], before['p95_ms']):>9}"
+                      f"{_delta(stats['p99_ms'], before['p99_ms']):>9}")
+    upstream = result['upstream']
+    if upstream:
+        print(f"\nYelp calls per request: {upstream['calls_per_request']} {upstream['by_endpoint']}")
+    if result['storage']:
+        print(f"Storage ops per request: {result['storage']['ops_per_request']} {result['storage']['by_operation']}")
+
+
+def _delta(after, before):
+    if not before:
+        return 'n/a'
+    return f"{(after - before) / before * 100:+.0f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the DineWise routes against local stand-ins.")
+    parser.add_argument('--mix', choices=sorted(MIXES), default='browse')
+    parser.add_argument('--concurrency', type=int, default=16, help="Concurrent simulated users")
+    parser.add_argument('--duration', type=float, default=30, help="Measured seconds")
+    parser.add_argument('--warmup', type=float, default=5, help="Unmeasured seconds before measuring")
+    parser.add_argument('--think-ms', type=float, default=0, help="Mean pause between a user's requests")
+    parser.add_argument('--catalog', type=int, default=500, help="Distinct restaurant ids")
+    parser.add_argument('--zipf', type=float, default=1.1, help="Popularity skew of restaurant ids")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--target', help="Base URL of an already running app (default: start one in-process)")
+    parser.add_argument('--stub', help="Base URL of the yelp_stub.py used by --target, for call counts")
+    parser.add_argument('--stub-latency-ms', type=float, default=80)
+    parser.add_argument('--stub-jitter-ms', type=float, default=40)
+    parser.add_argument('--stub-error-rate', type=float, default=0.0)
+    parser.add_argument('--output', help="Result file (default: loadtest_results/<time>-<commit>-<mix>.json)")
+    parser.add_argument('--compare', help="Earlier result file to compare against")
+    parser.add_argument('--show-app-output', action='store_true', help="Don't silence the app's prints")
+    args = parser.parse_args()
+
+    app_module = None
+    if args.target:
+        base_url, stub_url = args.target, (args.stub or '').rstrip('/') or None
+    else:
+        base_url, stub_url, app_module = start_in_process(args)
+    print(f"Running '{args.mix}' against {base_url} (stub: {stub_url or 'none'})", file=sys.stderr)
+
+    recorder = Recorder()
+    stop = threading.Event()
+    quiet = open(os.devnull, 'w') if app_module is not None and not args.show_app_output else None
+    with contextlib.redirect_stdout(quiet) if quiet else contextlib.nullcontext():
+        threads = [threading.Thread(target=worker, args=(number, args, base_url, recorder, stop, args.seed),
+                                    daemon=True) for number in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.warmup)
+        stub_before, storage_before = stub_stats(stub_url) if stub_url else None, storage_operations(app_module)
+        recorder.measuring = True
+        measured_from = time.perf_counter()
+        time.sleep(args.duration)
+        recorder.measuring = False
+        measured_s = time.perf_counter() - measured_from
+        stub_after, storage_after = stub_stats(stub_url) if stub_url else None, storage_operations(app_module)
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=30)
+    if quiet:
+        quiet.close()
+
+    overall, routes = summarize(recorder, measured_s)
+    upstream = None
+    if stub_before and stub_after:
+        calls = diff_counts(stub_after['calls'], stub_before['calls'])
+        upstream = {'calls': sum(calls.values()), 'by_endpoint': calls,
+                    'calls_per_request': round(sum(calls.values()) / max(overall['requests'], 1), 3)}
+    storage = None
+    operations = diff_counts(storage_after, storage_before)
+    if operations is not None:
+        storage = {'ops': sum(operations.values()), 'by_operation': operations,
+                   'ops_per_request': round(sum(operations.values()) / max(overall['requests'], 1), 3)}
+    result = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+                  | {'duration_s': round(measured_s, 2)},
+        'overall': overall,
+        'routes': routes,
+        'upstream': upstream,
+        'storage': storage,
+    }
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{result['commit'] or 'nogit'}-{args.mix}.json")
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import hashlib
+import hmac
+import time
+
+import firebase_admin.auth
+
+# =========================
+# Local Auth (load tests only)
+# =========================
+# Stand-in for the Pyrebase auth object when DINEWISE_STORAGE=local and
+# DINEWISE_LOCAL_AUTH=1: any email/password signs in, the uid is derived from
+# the email, and ID tokens are HMAC-signed "local.<uid>.<exp>.<sig>" strings.
+# verify_id_token raises the same firebase_admin errors as the real verifier,
+# so login_required and the token cache behave exactly as in production.
+TOKEN_LIFETIME = 3600
+
+
+class LocalAuth:
+    def __init__(self, secret, token_lifetime=TOKEN_LIFETIME):
+        self._secret = secret.encode('utf-8') if isinstance(secret, str) else secret
+        self.token_lifetime = token_lifetime
+
+    def _sign(self, payload):
+        return hmac.new(self._secret, payload.encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+    def _token(self, uid):
+        payload = f'local.{uid}.{int(time.time()) + self.token_lifetime}'
+        return f'{payload}.{self._sign(payload)}'
+
+    def _user(self, uid, email):
+        token = self._token(uid)
+        return {'localId': uid, 'email': email, 'idToken': token, 'refreshToken': f'refresh.{uid}.{email}',
+                'expiresIn': str(self.token_lifetime), 'registered': True}
+
+    def sign_in_with_email_and_password(self, email, password):
+        email = email.strip().lower()
+        return self._user(hashlib.sha1(email.encode('utf-8')).hexdigest()[:28], email)
+
+    def create_user_with_email_and_password(self, email, password):
+        return self.sign_in_with_email_and_password(email, password)
+
+    def refresh(self, refresh_token):
+        _, uid, email = refresh_token.split('.', 2)
+        user = self._user(uid, email)
+        return {'userId': uid, 'idToken': user['idToken'], 'refreshToken': refresh_token,
+                'localId': uid, 'email': email}
+
+    def verify_id_token(self, id_token, check_revoked=False):
+        try:
+            prefix, uid, expires, signature = id_token.split('.')
+            expires = int(expires)
+        except (AttributeError, ValueError):
+            raise firebase_admin.auth.InvalidIdTokenError('Malformed local ID token')
+        payload = f'{prefix}.{uid}.{expires}'
+        if prefix != 'local' or not hmac.compare_digest(signature, self._sign(payload)):
+            raise firebase_admin.auth.InvalidIdTokenError('Invalid local ID token signature')
+        if expires <= time.time():
+            raise firebase_admin.auth.ExpiredIdTokenError('Local ID token has expired', None)
+        return {'uid': uid, 'user_id': uid, 'sub': uid, 'exp': expires}
@@ -0,0 +1,62 @@
+import logging
+import os
+import random
+import sys
+
+# =========================
+# Structured, Sampled Logging
+# =========================
+# Request-path logging as one "event=name key=value ..." line per event.
+# Warnings and errors are always written; routine debug/info events are
+# sampled (DINEWISE_LOG_SAMPLE_RATE, default 1%) so busy routes don't spend
+# their time writing to stdout. Sampled lines carry sample_rate=... so
+# counts can be scaled back up.
+#
+#   DINEWISE_LOG_LEVEL=INFO          DEBUG shows the per-request detail
+#   DINEWISE_LOG_SAMPLE_RATE=0.01    1.0 logs every debug/info event
+logger = logging.getLogger('dinewise')
+SAMPLE_RATE = float(os.getenv('DINEWISE_LOG_SAMPLE_RATE', '0.01'))
+
+if not logger.handlers:
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(os.getenv('DINEWISE_LOG_LEVEL', 'INFO').upper())
+    logger.propagate = False
+
+
+def _format_value(value):
+    text = str(value)
+    if not text or any(char in text for char in ' ="\n'):
+        return '"' + text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+    return text
+
+
+def format_event(event, fields):
+    return ' '.join([f'event={event}'] + [f'{key}={_format_value(value)}' for key, value in fields.items()])
+
+
+def _emit(level, event, fields, sample_rate):
+    if not logger.isEnabledFor(level):
+        return
+    if sample_rate < 1.0:
+        if random.random() >= sample_rate:
+            return
+        fields['sample_rate'] = sample_rate
+    logger.log(level, format_event(event, fields))
+
+
+def debug(event, **fields):
+    _emit(logging.DEBUG, event, fields, SAMPLE_RATE)
+
+
+def info(event, **fields):
+    _emit(logging.INFO, event, fields, SAMPLE_RATE)
+
+
+def warning(event, **fields):
+    _emit(logging.WARNING, event, fields, 1.0)
+
+
+def error(event, **fields):
+    _emit(logging.ERROR, event, fields, 1.0)
@@ -0,0 +1,149 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# =========================
+# Prometheus Metrics
+# =========================
+# Minimal Prometheus text-format (0.0.4) exporter: labelled histograms and
+# counters that are cheap to update from request threads, plus collectors
+# that turn the existing stats() dicts (caches, rate limiters, ...) into
+# samples at scrape time. Served by the /metrics route in app.py.
+# Each gunicorn worker keeps its own series, so every sample carries a
+# worker="<pid>" label; sum without(worker) in queries to aggregate.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Seconds; from a cached lookup up to a slow Yelp call with retries.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                # Per-bucket counts (not cumulative) + [sum, count]
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labelvalues):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labelvalues)
+
+    def collect(self, extra=()):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        for labels, counts, total, count in sorted(series, key=lambda item: tuple(map(str, item[0]))):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = _format_labels(self.labelnames, labels, [*extra, ('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            label_text = _format_labels(self.labelnames, labels, extra)
+            lines.append(f'{self.name}_sum{label_text} {_format_value(total)}')
+            lines.append(f'{self.name}_count{label_text} {count}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def collect(self, extra=()):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda item: tuple(map(str, item[0])))
+        lines.extend(f'{self.name}{_format_labels(self.labelnames, labels, extra)} {_format_value(value)}'
+                     for labels, value in values)
+        return lines
+
+
+# A collector returns [(name, type, help, [(labels_dict, value), ...]), ...]
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def add_collector(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        with self._lock:
+            metrics, collectors = list(self._metrics), list(self._collectors)
+        # Read at scrape time so forked workers report their own pid
+        worker = [('worker', os.getpid())]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect(worker))
+        families = {}
+        for collector in collectors:
+            try:
+                for name, metric_type, documentation, samples in collector():
+                    family = families.setdefault(name, (metric_type, documentation, []))
+                    family[2].extend(samples)
+            except Exception as e:
+                lines.append(f'# collector {getattr(collector, "__name__", collector)} failed: {_escape(e)}')
+        for name, (metric_type, documentation, samples) in families.items():
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in samples:
+                label_text = _format_labels(labels.keys(), labels.values(), worker)
+                lines.append(f'{name}{label_text} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
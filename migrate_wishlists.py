@@ -0,0 +1,41 @@
+import argparse
+from datetime import datetime
+
+from firebase_config import db
+from wishlists import is_legacy, to_wishlist_map
+
+# One-off conversion of users/{uid}/wishlist from the old array of business
+# ids to the {business_id: added_at} map the app now writes. Each user is
+# converted inside a transaction, so it is safe to run while the app is live
+# and safe to re-run; already-converted wishlists are left untouched.
+
+def user_ids():
+    return sorted((db.reference('users').get(shallow=True) or {}).keys())
+
+def migrate_wishlists(uids=None, dry_run=False):
+    uids = uids or user_ids()
+    migrated = 0
+    for uid in uids:
+        try:
+            ref = db.reference(f'users/{uid}/wishlist')
+            raw = ref.get()
+            if not is_legacy(raw):
+                continue
+            migrated_at = datetime.now()
+            converted = to_wishlist_map(raw, migrated_at)
+            print(f"{uid}: {len(converted)} wishlist items")
+            if not dry_run:
+                ref.transaction(lambda current: to_wishlist_map(current, migrated_at) or None)
+            migrated += 1
+        except Exception as e:
+            print(f"Error migrating wishlist for {uid}: {e}")
+    action = "Would migrate" if dry_run else "Migrated"
+    print(f"{action} {migrated} of {len(uids)} wishlists.")
+    return migrated
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert array wishlists to keyed maps.")
+    parser.add_argument('uids', nargs='*', help="Only migrate these users (default: all)")
+    parser.add_argument('--dry-run', action='store_true', help="Report what would change without writing")
+    args = parser.parse_args()
+    migrate_wishlists(args.uids, dry_run=args.dry_run)
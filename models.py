@@ -0,0 +1,201 @@
+# =========================
+# Compact Restaurant and Review Models
+# =========================
+# Yelp business and review documents carry much more than the pages show
+# (photos, transactions, attributes, special hours, ...). These slotted
+# classes keep only what the templates and JSON APIs read, and are what the
+# Yelp caches, the geo index and the views hold. as_dict() gives the kept
+# fields back in Yelp's shape (for the shared SQLite cache and JSON), and
+# from_yelp() reads either a Yelp document or such a dict.
+
+
+class Model:
+    __slots__ = ()
+
+    def as_dict(self):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.as_dict()!r})'
+
+
+# json.dumps(..., default=json_default) for values that may contain models.
+def json_default(value):
+    if isinstance(value, Model):
+        return value.as_dict()
+    return str(value)
+
+
+class Location(Model):
+    __slots__ = ('address1', 'city', 'state', 'zip_code', 'display_address')
+
+    def __init__(self, address1=None, city=None, state=None, zip_code=None, display_address=()):
+        self.address1 = address1
+        self.city = city
+        self.state = state
+        self.zip_code = zip_code
+        self.display_address = tuple(display_address or ())
+
+    @classmethod
+    def from_yelp(cls, data):
+        data = data or {}
+        return cls(data.get('address1'), data.get('city'), data.get('state'), data.get('zip_code'),
+                   data.get('display_address'))
+
+    def as_dict(self):
+        return {'address1': self.address1, 'city': self.city, 'state': self.state,
+                'zip_code': self.zip_code, 'display_address': list(self.display_address)}
+
+
+class Coordinates(Model):
+    __slots__ = ('latitude', 'longitude')
+
+    def __init__(self, latitude=None, longitude=None):
+        self.latitude = latitude
+        self.longitude = longitude
+
+    @classmethod
+    def from_yelp(cls, data):
+        data = data or {}
+        return cls(data.get('latitude'), data.get('longitude'))
+
+    def as_dict(self):
+        return {'latitude': self.latitude, 'longitude': self.longitude}
+
+
+class Category(Model):
+    __slots__ = ('alias', 'title')
+
+    def __init__(self, alias=None, title=None):
+        self.alias = alias
+        self.title = title
+
+    @classmethod
+    def from_yelp(cls, data):
+        return cls(data.get('alias'), data.get('title'))
+
+    def as_dict(self):
+        return {'alias': self.alias, 'title': self.title}
+
+
+# One regular opening period; day 0 is Monday, start/end are "HHMM".
+class OpeningHours(Model):
+    __slots__ = ('day', 'start', 'end')
+
+    def __init__(self, day, start, end):
+        self.day = day
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def from_yelp(cls, data):
+        return cls(data.get('day'), data.get('start'), data.get('end'))
+
+    def as_dict(self):
+        return {'day': self.day, 'start': self.start, 'end': self.end}
+
+
+# partial: built from a search result, which lacks hours and the phone
+# number, so pages that show those fetch the full details.
+# placeholder: stands in for a restaurant that could not be loaded.
+class Restaurant(Model):
+    __slots__ = ('id', 'name', 'image_url', 'url', 'rating', 'review_count', 'price', 'phone',
+                 'display_phone', 'location', 'coordinates', 'categories', 'hours', 'partial', 'placeholder')
+
+    def __init__(self, id, name=None, image_url=None, url=None, rating=None, review_count=0, price=None,
+                 phone=None, display_phone=None, location=None, coordinates=None, categories=(), hours=(),
+                 partial=False, placeholder=False):
+        self.id = id
+        self.name = name
+        self.image_url = image_url
+        self.url = url
+        self.rating = rating
+        self.review_count = review_count
+        self.price = price
+        self.phone = phone
+        self.display_phone = display_phone
+        self.location = location or Location()
+        self.coordinates = coordinates or Coordinates()
+        self.categories = tuple(categories)
+        self.hours = tuple(hours)
+        self.partial = partial
+        self.placeholder = placeholder
+
+    @classmethod
+    def from_yelp(cls, data, partial=None):
+        # Yelp nests the regular week as hours[0].open.
+        hours = data.get('hours') or []
+        periods = (hours[0].get('open') or []) if hours else []
+        return cls(
+            data.get('id'),
+            name=data.get('name'),
+            image_url=data.get('image_url'),
+            url=data.get('url'),
+            rating=data.get('rating'),
+            review_count=data.get('review_count') or 0,
+            price=data.get('price'),
+            phone=data.get('phone'),
+            display_phone=data.get('display_phone'),
+            location=Location.from_yelp(data.get('location')),
+            coordinates=Coordinates.from_yelp(data.get('coordinates')),
+            categories=[Category.from_yelp(category) for category in data.get('categories') or []],
+            hours=[OpeningHours.from_yelp(period) for period in periods],
+            partial=bool(data.get('partial')) if partial is None else partial,
+            placeholder=bool(data.get('placeholder')),
+        )
+
+    @classmethod
+    def unavailable(cls, business_id, display_address=()):
+        return cls(business_id, name='Restaurant information unavailable',
+                   location=Location(display_address=display_address), placeholder=True)
+
+    def as_partial(self):
+        copy = Restaurant(**{field: getattr(self, field) for field in self.__slots__})
+        copy.partial = True
+        return copy
+
+    def as_dict(self):
+        data = {
+            'id': self.id,
+            'name': self.name,
+            'image_url': self.image_url,
+            'url': self.url,
+            'rating': self.rating,
+            'review_count': self.review_count,
+            'price': self.price,
+            'phone': self.phone,
+            'display_phone': self.display_phone,
+            'location': self.location.as_dict(),
+            'coordinates': self.coordinates.as_dict(),
+            'categories': [category.as_dict() for category in self.categories],
+            'hours': [{'open': [period.as_dict() for period in self.hours]}] if self.hours else [],
+        }
+        if self.partial:
+            data['partial'] = True
+        if self.placeholder:
+            data['placeholder'] = True
+        return data
+
+
+# A Yelp review excerpt.
+class Review(Model):
+    __slots__ = ('id', 'rating', 'text', 'time_created', 'url', 'user_name')
+
+    def __init__(self, id, rating=None, text=None, time_created=None, url=None, user_name=None):
+        self.id = id
+        self.rating = rating
+        self.text = text
+        self.time_created = time_created
+        self.url = url
+        self.user_name = user_name
+
+    @classmethod
+    def from_yelp(cls, data):
+        user = data.get('user') or {}
+        return cls(data.get('id'), rating=data.get('rating'), text=data.get('text'),
+                   time_created=data.get('time_created'), url=data.get('url'),
+                   user_name=data.get('user_name', user.get('name')))
+
+    def as_dict(self):
+        return {'id': self.id, 'rating': self.rating, 'text': self.text, 'time_created': self.time_created,
+                'url': self.url, 'user_name': self.user_name}
@@ -0,0 +1,359 @@
+import argparse
+import heapq
+import itertools
+import math
+import os
+import sqlite3
+import threading
+import time
+
+import logs
+import upstream
+from ratelimit import TokenBucket
+
+# =========================
+# Hot Restaurant Prewarming
+# =========================
+# restaurant_detail and wishlist record each business id they serve. The
+# prewarmer takes the top-K ids by recent popularity and refreshes their
+# details and reviews shortly before the cached copies expire (or when they
+# are missing), so popular pages are not the ones waiting on Yelp.
+# Refreshes are paced by a requests-per-second budget, capped per day, and
+# paused while Yelp's reported remaining daily quota is below the share
+# reserved for user traffic.
+#
+#   PREWARM_MODE=inprocess   run the worker as a thread inside the app
+#   python prewarm.py        run it as a separate process; needs YELP_CACHE_DB
+#                            so app and worker share cache entries and counts
+#
+# Popularity is an exponentially decayed hit count stored as a rank,
+# log2(count) + t / half_life, so ranks stay comparable over time and nothing
+# has to be decayed in place.
+EPOCH = 1700000000
+
+
+def add_hits(rank, hits, now_term):
+    current = 2 ** (rank - now_term) if rank is not None else 0.0
+    return math.log2(current + hits) + now_term
+
+
+# =========================
+# Shared Access Counts
+# =========================
+class AccessStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS prewarm_access ('
+                     ' business_id TEXT PRIMARY KEY,'
+                     ' rank REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS prewarm_access_rank ON prewarm_access (rank)')
+
+    def _connect(self):
+        # Per thread and per process, as in SQLiteCacheBackend.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def add(self, hits, now_term, max_keys):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for business_id, count in hits.items():
+                row = conn.execute('SELECT rank FROM prewarm_access WHERE business_id = ?',
+                                   (business_id,)).fetchone()
+                conn.execute('INSERT OR REPLACE INTO prewarm_access VALUES (?, ?)',
+                             (business_id, add_hits(row[0] if row else None, count, now_term)))
+            conn.execute('DELETE FROM prewarm_access WHERE business_id NOT IN'
+                         ' (SELECT business_id FROM prewarm_access ORDER BY rank DESC LIMIT ?)', (max_keys,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def top(self, k):
+        rows = self._connect().execute('SELECT business_id FROM prewarm_access ORDER BY rank DESC LIMIT ?',
+                                       (k,)).fetchall()
+        return [row[0] for row in rows]
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM prewarm_access').fetchone()[0]
+
+
+# =========================
+# Access Tracker
+# =========================
+# With a store, hits are also flushed to it every flush_interval seconds and
+# top() ranks across every process that shares the store.
+class AccessTracker:
+    def __init__(self, half_life=3600, max_keys=20000, store=None, flush_interval=30):
+        self.half_life = half_life
+        self.max_keys = max_keys
+        self.store = store
+        self.flush_interval = flush_interval
+        self._ranks = {}
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _now_term(self):
+        return (time.time() - EPOCH) / self.half_life
+
+    def record(self, business_id, hits=1):
+        with self._lock:
+            self._ranks[business_id] = add_hits(self._ranks.get(business_id), hits, self._now_term())
+            if len(self._ranks) > self.max_keys + self.max_keys // 10:
+                keep = heapq.nlargest(self.max_keys, self._ranks.items(), key=lambda item: item[1])
+                self._ranks = dict(keep)
+            if self.store is None:
+                return
+            self._pending[business_id] = self._pending.get(business_id, 0) + hits
+            flush_due = time.monotonic() - self._last_flush >= self.flush_interval
+        if flush_due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending or self.store is None:
+            return
+        try:
+            self.store.add(pending, self._now_term(), self.max_keys)
+        except sqlite3.Error as e:
+            logs.warning('prewarm_access_flush_failed', ids=len(pending), error=e)
+
+    def top(self, k):
+        if self.store is not None:
+            self.flush()
+            try:
+                return self.store.top(k)
+            except sqlite3.Error as e:
+                logs.warning('prewarm_access_read_failed', error=e)
+        with self._lock:
+            return heapq.nlargest(k, self._ranks, key=self._ranks.get)
+
+    def __len__(self):
+        if self.store is not None:
+            try:
+                return len(self.store)
+            except sqlite3.Error:
+                pass
+        return len(self._ranks)
+
+
+# =========================
+# Prewarm Worker
+# =========================
+# targets: [(name, cache, fetch(business_id), accept(value) or None)]. A
+# refresh goes through cache.load(), so it is coalesced with any visitor
+# loading the same entry at the same moment.
+class Prewarmer:
+    def __init__(self, tracker, targets, top_k=200, lead=300, rps=1.0, daily_limit=2000,
+                 quota=None, quota_reserve=0.25, scan_interval=30, retry_after=600):
+        self.tracker = tracker
+        self.targets = {name: (cache, fetch, accept) for name, cache, fetch, accept in targets}
+        self.top_k = top_k
+        self.lead = lead
+        self.rps = rps
+        self.daily_limit = daily_limit
+        self.quota = quota
+        self.quota_reserve = quota_reserve
+        self.scan_interval = scan_interval
+        self.retry_after = retry_after
+        self.bucket = TokenBucket(rps, max(1.0, rps))
+        # Optional callable(lag_seconds) for each refresh, e.g. for metrics.
+        self.observer = None
+        self._queue = []
+        self._queued = set()
+        self._failed_until = {}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._day = None
+        self.calls_today = 0
+        self.scans = 0
+        self.refreshed = 0
+        self.failed = 0
+        self.quota_pauses = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._total_lag = 0.0
+
+    # Queues every hot entry that is missing or becomes due before the next scan.
+    def scan(self):
+        now = time.time()
+        horizon = now + self.scan_interval
+        queued = 0
+        for business_id in self.tracker.top(self.top_k):
+            for name, (cache, fetch, accept) in self.targets.items():
+                key = (name, business_id)
+                if key in self._queued or self._failed_until.get(key, 0) > now:
+                    continue
+                expires_at = cache.expires_at(business_id, accept)
+                due_at = now if expires_at is None else expires_at - self.lead
+                if due_at <= horizon:
+                    with self._lock:
+                        heapq.heappush(self._queue, (due_at, next(self._sequence), name, business_id))
+                        self._queued.add(key)
+                    queued += 1
+        self.scans += 1
+        return queued
+
+    def _quota_available(self):
+        today = time.strftime('%Y-%m-%d', time.gmtime())
+        if today != self._day:
+            self._day, self.calls_today = today, 0
+        if self.daily_limit and self.calls_today >= self.daily_limit:
+            return False
+        quota = self.quota() if self.quota else {}
+        if quota.get('daily_limit') and quota.get('remaining') is not None:
+            return quota['remaining'] > quota['daily_limit'] * self.quota_reserve
+        return True
+
+    # Refreshes the next due entry if the budget allows; returns how long to
+    # wait before trying again.
+    def step(self):
+        with self._lock:
+            if not self._queue:
+                return self.scan_interval
+            due_at, _, name, business_id = self._queue[0]
+        now = time.time()
+        if due_at > now:
+            return due_at - now
+        if not self._quota_available():
+            self.quota_pauses += 1
+            return self.scan_interval
+        if not self.bucket.try_acquire():
+            return 1.0 / self.rps
+        with self._lock:
+            heapq.heappop(self._queue)
+            self._queued.discard((name, business_id))
+        self.refresh(name, business_id, due_at)
+        return 0
+
+    def refresh(self, name, business_id, due_at):
+        cache, fetch, accept = self.targets[name]
+        self.calls_today += 1
+        try:
+            with upstream.background():
+                value = cache.load(business_id, lambda: fetch(business_id))
+        except Exception as e:
+            logs.warning('prewarm_refresh_failed', target=name, business_id=business_id, error=e)
+            value = None
+        if value is None:
+            self.failed += 1
+            self._failed_until[(name, business_id)] = time.time() + self.retry_after
+            return
+        lag = max(0.0, time.time() - due_at)
+        self.refreshed += 1
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self._total_lag += lag
+        if self.observer is not None:
+            self.observer(lag)
+
+    # One scan and everything currently due, within the budget (CLI --once).
+    def run_once(self):
+        self.scan()
+        while True:
+            wait = self.step()
+            with self._lock:
+                next_due = self._queue[0][0] if self._queue else None
+            if next_due is None or next_due > time.time() or wait >= self.scan_interval:
+                return
+            if wait:
+                time.sleep(wait)
+
+    def run(self):
+        next_scan = 0.0
+        while not self._stop.is_set():
+            if time.time() >= next_scan:
+                try:
+                    self.scan()
+                except Exception as e:
+                    logs.error('prewarm_scan_failed', error=e)
+                next_scan = time.time() + self.scan_interval
+                now = time.time()
+                self._failed_until = {key: until for key, until in self._failed_until.items() if until > now}
+            wait = self.step()
+            if wait:
+                self._stop.wait(min(wait, max(0.0, next_scan - time.time())))
+
+    # Safe to call on every request; also starts a fresh thread in a worker
+    # forked from a process that had started one.
+    def start(self):
+        if self._thread is not None and self._thread.is_alive() or self._stop.is_set():
+            return self
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='prewarm', daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def queue_depth(self):
+        with self._lock:
+            return len(self._queue)
+
+    # Seconds the most overdue queued entry has been waiting (0 if none is due).
+    def backlog_age(self):
+        with self._lock:
+            oldest = self._queue[0][0] if self._queue else None
+        return max(0.0, time.time() - oldest) if oldest is not None else 0.0
+
+    def stats(self):
+        return {
+            'running': self._thread is not None and self._thread.is_alive(),
+            'tracked_ids': len(self.tracker),
+            'queue_depth': self.queue_depth(),
+            'backlog_age_s': round(self.backlog_age(), 3),
+            'scans': self.scans,
+            'refreshed': self.refreshed,
+            'failed': self.failed,
+            'quota_pauses': self.quota_pauses,
+            'calls_today': self.calls_today,
+            'lag_last_s': round(self.last_lag, 3),
+            'lag_max_s': round(self.max_lag, 3),
+            'lag_avg_s': round(self._total_lag / self.refreshed, 3) if self.refreshed else 0.0,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep the most visited restaurants warm in the shared Yelp cache.")
+    parser.add_argument('--once', action='store_true', help="Refresh what is due now and exit")
+    parser.add_argument('--top-k', type=int, help="How many of the hottest restaurants to keep warm")
+    parser.add_argument('--rps', type=float, help="Yelp requests per second the worker may use")
+    parser.add_argument('--report-every', type=float, default=60, help="Seconds between status lines")
+    args = parser.parse_args()
+
+    import app as dinewise
+
+    worker = dinewise.prewarmer
+    if dinewise.cache_backend is None or worker.tracker.store is None:
+        raise SystemExit("prewarm.py needs YELP_CACHE_DB (shared with the app) to see its traffic and caches")
+    if args.top_k:
+        worker.top_k = args.top_k
+    if args.rps:
+        worker.rps = args.rps
+        worker.bucket = TokenBucket(args.rps, max(1.0, args.rps))
+    if args.once:
+        worker.run_once()
+        print(worker.stats())
+    else:
+        print(f"🔥 Prewarming the top {worker.top_k} restaurants at up to {worker.rps} Yelp requests/s")
+        worker.start()
+        try:
+            while True:
+                time.sleep(args.report_every)
+                print(worker.stats())
+        except KeyboardInterrupt:
+            worker.stop()
@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# =========================
+# Token Bucket
+# =========================
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def available(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return self.tokens
+
+
+# =========================
+# Per-Client Rate Limiter
+# =========================
+# One bucket per client key; the least recently seen clients are dropped once
+# max_keys is reached so memory stays bounded.
+class KeyedRateLimiter:
+    def __init__(self, rate, capacity, max_keys=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def allow(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+        allowed = bucket.try_acquire()
+        if not allowed:
+            with self._lock:
+                self.rejected += 1
+        return allowed
@@ -0,0 +1,268 @@
+import glob
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import logs
+
+try:
+    import fcntl  # journal ownership between worker processes (POSIX only)
+except ImportError:
+    fcntl = None
+
+# =========================
+# Write-Behind Review Queue
+# =========================
+# add_review appends the review to an on-disk journal (fsynced) and returns;
+# a background thread writes queued reviews to storage in batches through
+# writer(entries), retrying with exponential back-off until it succeeds.
+#
+# Each process owns one journal file in the queue directory and holds an
+# exclusive lock on it while alive. A journal nobody holds belongs to a
+# process that has exited (or crashed): the next process to start, or the
+# next flusher pass, adopts its unfinished entries, so a restart loses
+# nothing. The journal is append-only JSON lines:
+#
+#   {"op": "add", "id": ..., "business_id": ..., "review": {...}}
+#   {"op": "done", "ids": [...]}
+#
+# and is rewritten with only the pending entries once it grows past
+# compact_bytes. writer() must be safe to repeat for a batch (a crash after
+# the write but before the "done" record replays it).
+JOURNAL_SUFFIX = '.journal'
+
+
+def _lock(journal, blocking=True):
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(journal.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        return True
+    except BlockingIOError:
+        return False
+
+
+# Pending entries of a journal, in order; a torn last line is ignored.
+def read_journal(path):
+    pending = OrderedDict()
+    with open(path, encoding='utf-8') as journal:
+        for line in journal:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('op') == 'add':
+                pending[record['id']] = {key: record[key] for key in ('id', 'business_id', 'review')}
+            elif record.get('op') == 'done':
+                for entry_id in record.get('ids', ()):
+                    pending.pop(entry_id, None)
+    return pending
+
+
+class ReviewQueue:
+    def __init__(self, directory, writer, batch_size=50, flush_interval=1.0, max_backoff=60.0,
+                 compact_bytes=1024 * 1024):
+        self.directory = directory
+        self.writer = writer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.compact_bytes = compact_bytes
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pending = OrderedDict()
+        self._queued_at = {}
+        self.submitted = 0
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.adopted = 0
+        self.last_error = None
+        os.makedirs(directory, exist_ok=True)
+        self.path, self._journal = self._create_journal()
+        self.adopt()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    # A worker forked from the process that opened the journal (e.g. under
+    # gunicorn --preload) leaves that journal and its entries to the parent
+    # and opens its own. Only the forking thread exists here.
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pending = OrderedDict()
+        self._queued_at = {}
+        self._journal.close()
+        self.path, self._journal = self._create_journal()
+
+    # Written under a temporary name and locked before it gets its real
+    # name, so other processes never see it unlocked.
+    def _create_journal(self, entries=()):
+        name = os.path.join(self.directory, uuid.uuid4().hex)
+        journal = open(name + '.tmp', 'a', encoding='utf-8')
+        _lock(journal)
+        self._write(journal, [dict(entry, op='add') for entry in entries])
+        os.replace(name + '.tmp', name + JOURNAL_SUFFIX)
+        return name + JOURNAL_SUFFIX, journal
+
+    @staticmethod
+    def _write(journal, records):
+        if not records:
+            return
+        journal.write(''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records))
+        journal.flush()
+        os.fsync(journal.fileno())
+
+    def submit(self, business_id, entry_id, review):
+        entry = {'id': entry_id, 'business_id': business_id, 'review': review}
+        with self._lock:
+            self._write(self._journal, [dict(entry, op='add')])
+            self._pending[entry_id] = entry
+            self._queued_at[entry_id] = time.time()
+            self.submitted += 1
+        self.start()
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    # Takes over the entries of journals whose owners are gone.
+    def adopt(self):
+        if fcntl is None:
+            return 0
+        adopted = 0
+        for path in glob.glob(os.path.join(self.directory, '*' + JOURNAL_SUFFIX)):
+            if path == self.path:
+                continue
+            try:
+                orphan = open(path, encoding='utf-8')
+            except FileNotFoundError:
+                continue
+            with orphan:
+                if not _lock(orphan, blocking=False):
+                    continue
+                # The owner may have compacted it away while we waited.
+                try:
+                    if os.stat(path).st_ino != os.fstat(orphan.fileno()).st_ino:
+                        continue
+                    entries = read_journal(path)
+                except FileNotFoundError:
+                    continue
+                with self._lock:
+                    fresh = [entry for entry_id, entry in entries.items() if entry_id not in self._pending]
+                    self._write(self._journal, [dict(entry, op='add') for entry in fresh])
+                    for entry in fresh:
+                        self._pending[entry['id']] = entry
+                        self._queued_at[entry['id']] = time.time()
+                os.remove(path)
+            adopted += len(fresh)
+        if adopted:
+            self.adopted += adopted
+            logs.warning('review_queue_adopted', entries=adopted)
+            self.start()
+        return adopted
+
+    # Writes one batch; returns how many entries were written.
+    def flush_once(self):
+        with self._lock:
+            batch = list(itertools.islice(self._pending.values(), self.batch_size))
+        if not batch:
+            return 0
+        self.writer(batch)
+        ids = [entry['id'] for entry in batch]
+        with self._lock:
+            self._write(self._journal, [{'op': 'done', 'ids': ids}])
+            for entry_id in ids:
+                self._pending.pop(entry_id, None)
+                self._queued_at.pop(entry_id, None)
+            self.written += len(ids)
+            self.batches += 1
+            if self._journal.tell() > self.compact_bytes:
+                self._compact()
+        return len(ids)
+
+    def _compact(self):
+        old_path, old_journal = self.path, self._journal
+        self.path, self._journal = self._create_journal(self._pending.values())
+        os.remove(old_path)
+        old_journal.close()
+
+    def run(self):
+        backoff = 0.0
+        next_adopt = time.monotonic() + 60
+        while not self._stop.is_set():
+            if backoff:
+                self._stop.wait(backoff)
+            else:
+                self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if time.monotonic() >= next_adopt:
+                self.adopt()
+                next_adopt = time.monotonic() + 60
+            try:
+                while self.flush_once() == self.batch_size and not self._stop.is_set():
+                    pass
+                backoff = 0.0
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                backoff = min(self.max_backoff, max(1.0, backoff * 2))
+                logs.warning('review_queue_flush_failed', pending=len(self._pending), retry_in=backoff, error=e)
+
+    # Started on first use, so forking servers run it in each worker.
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='review-queue', daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    # Reviews still waiting to be written, e.g. to show to their author.
+    def pending(self, business_id=None):
+        with self._lock:
+            return [entry for entry in self._pending.values()
+                    if business_id is None or entry['business_id'] == business_id]
+
+    # Pending entries by id, including ones queued by other processes
+    # sharing the directory; ids already written are left out.
+    def find(self, entry_ids):
+        with self._lock:
+            found = {entry_id: self._pending[entry_id] for entry_id in entry_ids if entry_id in self._pending}
+        missing = set(entry_ids) - set(found)
+        for path in glob.glob(os.path.join(self.directory, '*' + JOURNAL_SUFFIX)):
+            if not missing:
+                break
+            if path == self.path:
+                continue
+            try:
+                entries = read_journal(path)
+            except OSError:
+                continue
+            for entry_id in missing & set(entries):
+                found[entry_id] = entries[entry_id]
+            missing -= set(found)
+        return found
+
+    def stats(self):
+        with self._lock:
+            oldest = min(self._queued_at.values()) if self._queued_at else None
+            return {
+                'journal': self.path,
+                'pending': len(self._pending),
+                'oldest_age_s': round(time.time() - oldest, 3) if oldest else 0.0,
+                'submitted': self.submitted,
+                'written': self.written,
+                'batches': self.batches,
+                'failures': self.failures,
+                'adopted': self.adopted,
+                'last_error': self.last_error,
+            }
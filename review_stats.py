@@ -0,0 +1,63 @@
+from datetime import datetime
+
+# =========================
+# Review Rating Aggregates
+# =========================
+# Stored at review_stats/{business_id} as {count, sum, updated_at} so pages
+# never have to download every review just to show an average.
+STATS_ROOT = 'review_stats'
+
+# Keys under reviews/ that are bookkeeping rather than business ids.
+NON_BUSINESS_KEYS = {'indexes', 'init'}
+
+
+def empty_stats():
+    return {'count': 0, 'sum': 0.0, 'updated_at': None}
+
+
+def add_rating(stats, rating):
+    stats = stats or empty_stats()
+    return {
+        'count': int(stats.get('count', 0)) + 1,
+        'sum': float(stats.get('sum', 0.0)) + float(rating),
+        'updated_at': datetime.now().isoformat()
+    }
+
+
+def stats_from_reviews(reviews):
+    stats = empty_stats()
+    for review in (reviews or {}).values():
+        try:
+            stats['sum'] += float(review.get('rating', 0))
+            stats['count'] += 1
+        except (ValueError, TypeError, AttributeError):
+            continue
+    stats['updated_at'] = datetime.now().isoformat()
+    return stats
+
+
+def dinewise_average(stats):
+    if not stats or not stats.get('count'):
+        return None
+    return round(float(stats['sum']) / int(stats['count']), 1)
+
+
+# Returns (weighted_average_rating, total_combined_reviews) across the Yelp
+# rating and the DineWise aggregate.
+def combined_rating(yelp_rating, yelp_review_count, stats):
+    total_score = 0.0
+    total_reviews = 0
+    try:
+        yelp_rating = float(yelp_rating)
+        yelp_review_count = int(yelp_review_count or 0)
+        if yelp_review_count > 0:
+            total_score += yelp_rating * yelp_review_count
+            total_reviews += yelp_review_count
+    except (ValueError, TypeError):
+        pass
+    if stats and stats.get('count'):
+        total_score += float(stats['sum'])
+        total_reviews += int(stats['count'])
+    if total_reviews == 0:
+        return None, 0
+    return round(total_score / total_reviews, 1), total_reviews
@@ -0,0 +1,56 @@
+// Debounced search-term suggestions backed by /api/autocomplete.
+// Only the latest keystroke's request is kept alive; older ones are aborted.
+document.addEventListener('DOMContentLoaded', function() {
+    const input = document.querySelector('[data-autocomplete]');
+    if (!input || !navigator.geolocation) return;
+
+    const DEBOUNCE_MS = 250;
+    const MIN_CHARS = 2;
+    const datalist = document.createElement('datalist');
+    datalist.id = `${input.id}-suggestions`;
+    input.setAttribute('list', datalist.id);
+    input.setAttribute('autocomplete', 'off');
+    input.after(datalist);
+
+    let coords = null;
+    let timer = null;
+    let controller = null;
+    let lastQuery = '';
+
+    input.addEventListener('focus', function() {
+        if (coords) return;
+        navigator.geolocation.getCurrentPosition(
+            position => { coords = `${position.coords.latitude},${position.coords.longitude}`; },
+            error => console.log('Autocomplete disabled without location:', error.message),
+            {timeout: 5000, maximumAge: 600000}
+        );
+    }, {once: true});
+
+    input.addEventListener('input', function() {
+        clearTimeout(timer);
+        timer = setTimeout(suggest, DEBOUNCE_MS);
+    });
+
+    function suggest() {
+        const term = input.value.trim();
+        if (!coords || term.length < MIN_CHARS || term === lastQuery) return;
+        lastQuery = term;
+        if (controller) controller.abort();
+        controller = new AbortController();
+        const params = new URLSearchParams({term: term, location: coords});
+        fetch(`/api/autocomplete?${params.toString()}`, {signal: controller.signal})
+            .then(response => (response.status === 200 ? response.json() : null))
+            .then(terms => {
+                if (!terms) return;
+                datalist.innerHTML = '';
+                terms.forEach(item => {
+                    const option = document.createElement('option');
+                    option.value = item.text;
+                    datalist.appendChild(option);
+                });
+            })
+            .catch(error => {
+                if (error.name !== 'AbortError') console.error('Autocomplete error:', error);
+            });
+    }
+});
@@ -0,0 +1,430 @@
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import clients
+from yelp_client import EndpointStats
+
+# =========================
+# Storage Backend Selection
+# =========================
+# Users, reviews, wishlists and rating aggregates all go through
+# db.reference(path) using the firebase_admin Realtime Database API. The
+# backend behind that API is chosen once at startup:
+#
+#   DINEWISE_STORAGE=firebase  (default) the live Realtime Database
+#   DINEWISE_STORAGE=local     LocalDatabase below, in memory, or persisted to
+#                              the SQLite file named by DINEWISE_LOCAL_DB
+#
+# Either way every operation is timed per kind (get, set, transaction, ...),
+# so the two backends can be compared from /debug/yelp-stats.
+def backend_name():
+    return os.getenv('DINEWISE_STORAGE', 'firebase').strip().lower()
+
+
+def _split(path):
+    return [part for part in (path or '').split('/') if part]
+
+
+# Firebase stores arrays as maps keyed "0", "1", ... and drops nulls and
+# empty maps; values are normalised the same way before they are stored.
+def _normalize(value):
+    if isinstance(value, (list, tuple)):
+        value = {str(index): item for index, item in enumerate(value)}
+    if isinstance(value, dict):
+        children = {}
+        for key, item in value.items():
+            item = _normalize(item)
+            if item is not None:
+                children[str(key)] = item
+        return children or None
+    return value
+
+
+# ...and read back as lists when the keys look like array indexes.
+def _denormalize(value):
+    if not isinstance(value, dict):
+        return value
+    children = {key: _denormalize(item) for key, item in value.items()}
+    if children and all(key.isdigit() for key in children):
+        highest = max(int(key) for key in children)
+        if highest < 2 * len(children):
+            return [children.get(str(index)) for index in range(highest + 1)]
+    return children
+
+
+# Realtime Database ordering: null < false < true < numbers < strings < maps.
+def _value_order(value):
+    if value is None:
+        return (0, 0)
+    if value is False:
+        return (1, 0)
+    if value is True:
+        return (2, 0)
+    if isinstance(value, (int, float)):
+        return (3, value)
+    if isinstance(value, str):
+        return (4, value)
+    return (5, 0)
+
+
+# Keys that look like integers sort numerically before all other keys.
+def _key_order(key):
+    if key.lstrip('-').isdigit():
+        return (0, int(key), '')
+    return (1, 0, key)
+
+
+# =========================
+# Local Realtime Database Stand-in
+# =========================
+# Implements the subset of firebase_admin.db the app relies on: get (incl.
+# shallow), set, update (multi-path, None deletes), delete, transaction,
+# child, and ordered queries with start_at / end_at / equal_to /
+# limit_to_first / limit_to_last. The whole tree lives in memory; with a
+# SQLite path, each first- and second-level node (e.g. users/{uid},
+# reviews/{business_id}) is stored as one JSON row and rewritten when it
+# changes, so data survives restarts.
+class LocalDatabase:
+    DOCUMENT_DEPTH = 2
+
+    def __init__(self, path=''):
+        self.path = path
+        self._tree = {}
+        self._lock = threading.RLock()
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS nodes (path TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            for node_path, value in self._conn.execute('SELECT path, value FROM nodes'):
+                self._put(_split(node_path), json.loads(value))
+
+    def reference(self, path='/'):
+        return LocalReference(self, _split(path))
+
+    def _node(self, parts):
+        node = self._tree
+        for part in parts:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def _put(self, parts, value):
+        if not parts:
+            self._tree = value if isinstance(value, dict) else {}
+            return
+        parents = [self._tree]
+        for part in parts[:-1]:
+            child = parents[-1].get(part)
+            if not isinstance(child, dict):
+                if value is None:
+                    return
+                child = parents[-1][part] = {}
+            parents.append(child)
+        if value is None:
+            parents[-1].pop(parts[-1], None)
+            # Drop parents left empty, as Firebase does.
+            for depth in range(len(parents) - 1, 0, -1):
+                if parents[depth]:
+                    break
+                parents[depth - 1].pop(parts[depth - 1], None)
+        else:
+            parents[-1][parts[-1]] = value
+
+    def _write(self, changes):
+        with self._lock:
+            for parts, value in changes:
+                self._put(parts, _normalize(value))
+            if self._conn is not None:
+                self._persist([parts for parts, _ in changes])
+
+    def _persist(self, changed):
+        documents = set()
+        for parts in changed:
+            if len(parts) >= self.DOCUMENT_DEPTH:
+                documents.add(tuple(parts[:self.DOCUMENT_DEPTH]))
+                continue
+            # A write above document level replaces every document under it.
+            prefix = '/'.join(parts)
+            self._conn.execute('DELETE FROM nodes WHERE path = ? OR path LIKE ?',
+                               (prefix, f'{prefix}/%' if prefix else '%'))
+            node = self._node(parts)
+            if node is not None and not isinstance(node, dict):
+                documents.add(tuple(parts))
+            elif isinstance(node, dict):
+                stack = [(list(parts), node)]
+                while stack:
+                    node_parts, value = stack.pop()
+                    if len(node_parts) == self.DOCUMENT_DEPTH or not isinstance(value, dict):
+                        documents.add(tuple(node_parts))
+                    else:
+                        stack.extend((node_parts + [key], item) for key, item in value.items())
+        for document in documents:
+            path = '/'.join(document)
+            value = self._node(list(document))
+            if value is None:
+                self._conn.execute('DELETE FROM nodes WHERE path = ?', (path,))
+            else:
+                self._conn.execute('INSERT OR REPLACE INTO nodes (path, value) VALUES (?, ?)',
+                                   (path, json.dumps(value, separators=(',', ':'))))
+
+
+class LocalReference:
+    def __init__(self, database, parts):
+        self._database = database
+        self._parts = parts
+
+    @property
+    def key(self):
+        return self._parts[-1] if self._parts else None
+
+    @property
+    def path(self):
+        return '/' + '/'.join(self._parts)
+
+    @property
+    def parent(self):
+        return LocalReference(self._database, self._parts[:-1]) if self._parts else None
+
+    def child(self, path):
+        return LocalReference(self._database, self._parts + _split(path))
+
+    def get(self, etag=False, shallow=False):
+        if etag:
+            raise ValueError('etag reads are not supported by the local database')
+        with self._database._lock:
+            value = self._database._node(self._parts)
+            if shallow and isinstance(value, dict):
+                return {key: True for key in value}
+            return _denormalize(copy.deepcopy(value))
+
+    def set(self, value):
+        if value is None:
+            raise ValueError('Value must not be None.')
+        self._database._write([(self._parts, value)])
+
+    def update(self, value):
+        if not value or not isinstance(value, dict):
+            raise ValueError('Value argument must be a non-empty dictionary.')
+        if None in value.keys():
+            raise ValueError('Dictionary must not contain None keys.')
+        self._database._write([(self._parts + _split(key), item) for key, item in value.items()])
+
+    def delete(self):
+        self._database._write([(self._parts, None)])
+
+    def transaction(self, transaction_update):
+        with self._database._lock:
+            new_value = transaction_update(self.get())
+            self._database._write([(self._parts, new_value)])
+            return new_value
+
+    def order_by_child(self, path):
+        return LocalQuery(self, 'child', path)
+
+    def order_by_key(self):
+        return LocalQuery(self, 'key')
+
+    def order_by_value(self):
+        return LocalQuery(self, 'value')
+
+
+class LocalQuery:
+    def __init__(self, reference, order_by, child_path=None):
+        self._reference = reference
+        self._order_by = order_by
+        self._child_parts = _split(child_path)
+        self._start = self._end = self._equal = None
+        self._first = self._last = None
+
+    def start_at(self, start):
+        self._start = start
+        return self
+
+    def end_at(self, end):
+        self._end = end
+        return self
+
+    def equal_to(self, value):
+        self._equal = value
+        return self
+
+    def limit_to_first(self, limit):
+        self._first = limit
+        return self
+
+    def limit_to_last(self, limit):
+        self._last = limit
+        return self
+
+    def _ordered_value(self, key, value):
+        if self._order_by == 'key':
+            return key
+        if self._order_by == 'value':
+            return value
+        for part in self._child_parts:
+            value = value.get(part) if isinstance(value, dict) else None
+        return value
+
+    def get(self):
+        with self._reference._database._lock:
+            node = copy.deepcopy(self._reference._database._node(self._reference._parts))
+        if not isinstance(node, dict):
+            return node
+        if self._order_by == 'key':
+            rank = lambda item: _key_order(item[0])
+            bound = lambda limit: _key_order(str(limit))
+        else:
+            rank = lambda item: _value_order(item[1])
+            bound = _value_order
+        items = [(key, self._ordered_value(key, value)) for key, value in node.items()]
+        items.sort(key=lambda item: (rank(item), _key_order(item[0])))
+        if self._equal is not None:
+            items = [item for item in items if rank(item) == bound(self._equal)]
+        if self._start is not None:
+            items = [item for item in items if rank(item) >= bound(self._start)]
+        if self._end is not None:
+            items = [item for item in items if rank(item) <= bound(self._end)]
+        if self._first is not None:
+            items = items[:self._first]
+        if self._last is not None:
+            items = items[-self._last:] if self._last else []
+        return OrderedDict((key, _denormalize(node[key])) for key, _ in items)
+
+
+# =========================
+# Timed Storage Client
+# =========================
+# Thin wrapper around either backend that records per-operation latency.
+class StorageClient:
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        # Optional callable(backend, operation, seconds, error), e.g. for metrics.
+        self.observer = None
+        # Optional breaker.CircuitBreaker: while it is open operations fail at once.
+        self.breaker = None
+
+    def reference(self, path='/'):
+        return _TimedReference(self, self.backend.reference(path))
+
+    def _timed(self, operation, fn, *args, **kwargs):
+        breaker = self.breaker
+        if breaker is not None:
+            breaker.check()
+        started = time.perf_counter()
+        error = None
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self._stats_lock:
+                self._stats.setdefault(operation, EndpointStats()).record(elapsed_ms, error=error is not None)
+            if self.observer is not None:
+                self.observer(self.name, operation, elapsed_ms / 1000, error is not None)
+            if breaker is not None:
+                breaker.record(elapsed_ms / 1000, error)
+
+    def stats(self):
+        with self._stats_lock:
+            operations = {operation: stats.as_dict() for operation, stats in self._stats.items()}
+        return {'backend': self.name, 'operations': operations}
+
+
+class _TimedReference:
+    def __init__(self, client, reference):
+        self._client = client
+        self._reference = reference
+
+    def __getattr__(self, name):
+        return getattr(self._reference, name)
+
+    def child(self, path):
+        return _TimedReference(self._client, self._reference.child(path))
+
+    def get(self, *args, **kwargs):
+        return self._client._timed('get', self._reference.get, *args, **kwargs)
+
+    def set(self, value):
+        return self._client._timed('set', self._reference.set, value)
+
+    def update(self, value):
+        return self._client._timed('update', self._reference.update, value)
+
+    def delete(self):
+        return self._client._timed('delete', self._reference.delete)
+
+    def transaction(self, transaction_update):
+        return self._client._timed('transaction', self._reference.transaction, transaction_update)
+
+    def order_by_child(self, path):
+        return _TimedQuery(self._client, self._reference.order_by_child(path))
+
+    def order_by_key(self):
+        return _TimedQuery(self._client, self._reference.order_by_key())
+
+    def order_by_value(self):
+        return _TimedQuery(self._client, self._reference.order_by_value())
+
+
+class _TimedQuery:
+    def __init__(self, client, query):
+        self._client = client
+        self._query = query
+
+    def __getattr__(self, name):
+        attribute = getattr(self._query, name)
+        if not callable(attribute):
+            return attribute
+
+        def chained(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            return self if result is self._query else result
+        return chained
+
+    def get(self):
+        return self._client._timed('query', self._query.get)
+
+
+# =========================
+# Firebase Realtime Database
+# =========================
+# firebase_admin.db on the app from clients.py, which is only initialised
+# when the first reference is made.
+class FirebaseDatabase:
+    def reference(self, path='/'):
+        from firebase_admin import db as firebase_db
+        return firebase_db.reference(path, app=clients.firebase_app())
+
+
+_database = None
+_database_lock = threading.Lock()
+
+def database():
+    global _database
+    with _database_lock:
+        if _database is None:
+            backend = backend_name()
+            if backend == 'local':
+                path = os.getenv('DINEWISE_LOCAL_DB', '')
+                _database = StorageClient(LocalDatabase(path), 'local')
+                print(f"🗄️ Using local storage ({path or 'in memory'})")
+            elif backend == 'firebase':
+                _database = StorageClient(FirebaseDatabase(), 'firebase')
+            else:
+                raise ValueError(f"Unknown DINEWISE_STORAGE backend: {backend}")
+        return _database
+
+def is_local():
+    return database().name == 'local'
@@ -0,0 +1,92 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import logs
+
+
+# =========================
+# Verified ID Token Cache
+# =========================
+# Remembers the decoded claims of ID tokens that already passed verification,
+# keyed by a SHA-256 of the token so raw tokens are never held in memory.
+# Each entry lives until the token's own `exp`; after that the verifier runs
+# again and raises ExpiredIdTokenError as before, which triggers the refresh.
+class VerifiedTokenCache:
+    def __init__(self, verify, max_entries=10000, cert_refresher=None, cert_refresh_interval=3600):
+        self._verify = verify
+        self.max_entries = max_entries
+        self.cert_refresher = cert_refresher
+        self.cert_refresh_interval = cert_refresh_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.skipped = 0
+        self.verified = 0
+        self.cert_refreshes = 0
+        self.cert_refresh_errors = 0
+
+    @staticmethod
+    def _key(id_token):
+        return hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+
+    def verify(self, id_token):
+        self.start()
+        key = self._key(id_token)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, claims = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.skipped += 1
+                    return claims
+                del self._entries[key]
+        claims = self._verify(id_token)
+        with self._lock:
+            self.verified += 1
+            self._entries[key] = (claims.get('exp', 0), claims)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return claims
+
+    def invalidate(self, id_token):
+        with self._lock:
+            self._entries.pop(self._key(id_token), None)
+
+    # Keeps the signing certificates warm so the occasional real verification
+    # never waits on a certificate download. Started lazily so forking servers
+    # run it in each worker.
+    def start(self):
+        if self.cert_refresher is None:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='token-cert-refresh', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.cert_refresher()
+                self.cert_refreshes += 1
+            except Exception as e:
+                self.cert_refresh_errors += 1
+                logs.warning('signing_cert_refresh_failed', error=e)
+            time.sleep(self.cert_refresh_interval)
+
+    def stats(self):
+        with self._lock:
+            total = self.skipped + self.verified
+            return {
+                'entries': len(self._entries),
+                'skipped_verifications': self.skipped,
+                'verifications': self.verified,
+                'skip_ratio': round(self.skipped / total, 3) if total else 0.0,
+                'cert_refreshes': self.cert_refreshes,
+                'cert_refresh_errors': self.cert_refresh_errors,
+            }
@@ -0,0 +1,265 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import logs
+
+# =========================
+# Upstream Priorities
+# =========================
+# Every Yelp call is interactive (a visitor is waiting on a page), autocomplete
+# (a keystroke that a cached prefix or an empty list can answer), or
+# background (cache refreshes, prewarming, featured lists). When the budget
+# runs low, background calls are shed first, then autocomplete.
+INTERACTIVE = 'interactive'
+AUTOCOMPLETE = 'autocomplete'
+BACKGROUND = 'background'
+PRIORITIES = (INTERACTIVE, AUTOCOMPLETE, BACKGROUND)
+
+_state = threading.local()
+
+
+# Marks the Yelp calls made inside the block (on this thread) as background work.
+@contextmanager
+def background():
+    previous = getattr(_state, 'background', False)
+    _state.background = True
+    try:
+        yield
+    finally:
+        _state.background = previous
+
+
+def priority_for(endpoint):
+    if getattr(_state, 'background', False):
+        return BACKGROUND
+    if endpoint == 'autocomplete':
+        return AUTOCOMPLETE
+    return INTERACTIVE
+
+
+def parse_reset_time(value):
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+# =========================
+# Shared Upstream Budget
+# =========================
+# A token bucket for Yelp's per-second limit plus Yelp's own daily quota
+# (RateLimit-* headers), shared by every worker through one SQLite row when
+# a path is given (YELP_LIMIT_DB, defaulting to YELP_CACHE_DB).
+#
+# A call may only take a token if the bucket keeps its priority's reserve
+# (a share of the burst), and only spend daily quota while the remaining
+# quota stays above its priority's daily reserve, so user traffic keeps
+# headroom the other kinds can't touch. Interactive calls wait up to
+# max_wait for a token; the others are shed straight away. A 429 pauses
+# every worker until Retry-After, or until the daily reset when the quota
+# itself is used up.
+DEFAULT_RESERVES = {INTERACTIVE: 0.0, AUTOCOMPLETE: 0.3, BACKGROUND: 0.6}
+DEFAULT_DAILY_RESERVES = {INTERACTIVE: 0.0, AUTOCOMPLETE: 0.05, BACKGROUND: 0.25}
+# Pause after a 429 that says nothing about when to come back.
+DEFAULT_PAUSE = 1.0
+QUOTA_PAUSE = 3600
+
+
+class UpstreamBudget:
+    def __init__(self, rate, burst=None, path=None, reserves=None, daily_reserves=None, max_wait=0.5):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, self.rate))
+        self.path = path
+        self.reserves = dict(DEFAULT_RESERVES, **(reserves or {}))
+        self.daily_reserves = dict(DEFAULT_DAILY_RESERVES, **(daily_reserves or {}))
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._memory = self._initial_state()
+        self.granted = {priority: 0 for priority in PRIORITIES}
+        self.shed = {priority: 0 for priority in PRIORITIES}
+        self.waits = 0
+        self.pauses = 0
+        self.errors = 0
+        if path:
+            conn = self._connect()
+            conn.execute('CREATE TABLE IF NOT EXISTS upstream_budget ('
+                         ' id INTEGER PRIMARY KEY CHECK (id = 1),'
+                         ' tokens REAL NOT NULL, updated REAL NOT NULL, paused_until REAL NOT NULL,'
+                         ' daily_limit INTEGER, remaining INTEGER, reset_at REAL)')
+            state = self._initial_state()
+            conn.execute('INSERT OR IGNORE INTO upstream_budget VALUES (1, ?, ?, ?, ?, ?, ?)',
+                         tuple(state.values()))
+
+    def _initial_state(self):
+        return {'tokens': self.burst, 'updated': time.time(), 'paused_until': 0.0,
+                'daily_limit': None, 'remaining': None, 'reset_at': None}
+
+    def _connect(self):
+        # Per thread, and reopened in a worker forked after __init__ opened one.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    # Runs update(state) atomically across every process sharing the budget
+    # and returns its result.
+    def _transact(self, update):
+        if not self.path:
+            with self._lock:
+                return update(self._memory)
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated, paused_until, daily_limit, remaining, reset_at'
+                               ' FROM upstream_budget WHERE id = 1').fetchone()
+            state = dict(zip(('tokens', 'updated', 'paused_until', 'daily_limit', 'remaining', 'reset_at'), row))
+            result = update(state)
+            conn.execute('UPDATE upstream_budget SET tokens = ?, updated = ?, paused_until = ?,'
+                         ' daily_limit = ?, remaining = ?, reset_at = ? WHERE id = 1', tuple(state.values()))
+            conn.execute('COMMIT')
+            return result
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    # Returns (granted, seconds until it might be granted or None).
+    def _take(self, state, priority, now):
+        if state['paused_until'] > now:
+            return False, state['paused_until'] - now
+        if state['reset_at'] is not None and now >= state['reset_at']:
+            state['remaining'] = state['reset_at'] = None
+        if state['daily_limit'] and state['remaining'] is not None:
+            if state['remaining'] - 1 < state['daily_limit'] * self.daily_reserves[priority]:
+                return False, None
+        if self.rate > 0:
+            state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * self.rate)
+            state['updated'] = now
+            floor = self.burst * self.reserves[priority]
+            if state['tokens'] - 1 < floor:
+                return False, (floor + 1 - state['tokens']) / self.rate
+            state['tokens'] -= 1
+        if state['remaining'] is not None:
+            state['remaining'] -= 1
+        return True, None
+
+    # True if a call of this priority may go to Yelp now. Budget storage
+    # errors let the call through rather than taking the site down.
+    def acquire(self, priority=INTERACTIVE, wait=True):
+        deadline = time.monotonic() + (self.max_wait if wait and priority == INTERACTIVE else 0)
+        while True:
+            try:
+                granted, retry_in = self._transact(lambda state: self._take(state, priority, time.time()))
+            except sqlite3.Error as e:
+                self.errors += 1
+                logs.warning('upstream_budget_error', error=e)
+                granted, retry_in = True, None
+            if granted:
+                self.granted[priority] += 1
+                return True
+            if retry_in is None or time.monotonic() + retry_in > deadline:
+                self.shed[priority] += 1
+                logs.info('upstream_call_shed', priority=priority)
+                return False
+            self.waits += 1
+            time.sleep(retry_in)
+
+    # Records Yelp's view of the quota from a response, and pauses everyone on a 429.
+    def note_response(self, status, headers, body=''):
+        now = time.time()
+        update = {}
+        try:
+            if headers.get('RateLimit-Remaining') is not None:
+                update['remaining'] = int(float(headers['RateLimit-Remaining']))
+            if headers.get('RateLimit-DailyLimit'):
+                update['daily_limit'] = int(float(headers['RateLimit-DailyLimit']))
+        except ValueError:
+            update = {}
+        if headers.get('RateLimit-ResetTime'):
+            update['reset_at'] = parse_reset_time(headers['RateLimit-ResetTime'])
+        paused_until = None
+        if status == 429:
+            retry_after = headers.get('Retry-After')
+            if 'ACCESS_LIMIT_REACHED' in (body or '') or update.get('remaining') == 0:
+                paused_until = update.get('reset_at') or now + QUOTA_PAUSE
+            elif retry_after and retry_after.isdigit():
+                paused_until = now + float(retry_after)
+            else:
+                paused_until = now + DEFAULT_PAUSE
+        if not update and paused_until is None:
+            return
+
+        def apply(state):
+            state.update(update)
+            if paused_until is not None:
+                state['paused_until'] = max(state['paused_until'], paused_until)
+
+        try:
+            self._transact(apply)
+        except sqlite3.Error as e:
+            self.errors += 1
+            logs.warning('upstream_budget_error', error=e)
+            return
+        if paused_until is not None:
+            self.pauses += 1
+            logs.warning('yelp_rate_limited', paused_s=round(paused_until - now, 1))
+
+    def _snapshot(self):
+        def read(state):
+            return dict(state)
+        try:
+            return self._transact(read)
+        except sqlite3.Error as e:
+            logs.warning('upstream_budget_error', error=e)
+            return dict(self._memory)
+
+    # Shared view of Yelp's daily quota, in the shape of YelpClient.quota.
+    def quota(self, state=None):
+        state = state or self._snapshot()
+        quota = {}
+        if state['remaining'] is not None:
+            quota['remaining'] = state['remaining']
+        if state['daily_limit']:
+            quota['daily_limit'] = state['daily_limit']
+        if state['reset_at']:
+            quota['reset_at'] = state['reset_at']
+        return quota
+
+    def stats(self):
+        state = self._snapshot()
+        now = time.time()
+        tokens = state['tokens']
+        if self.rate > 0:
+            tokens = min(self.burst, tokens + (now - state['updated']) * self.rate)
+        return {
+            'shared': bool(self.path),
+            'rate': self.rate,
+            'burst': self.burst,
+            'tokens': round(tokens, 2),
+            'paused_for_s': round(max(0.0, state['paused_until'] - now), 1),
+            'quota': self.quota(state),
+            'granted': dict(self.granted),
+            'shed': dict(self.shed),
+            'waits': self.waits,
+            'pauses': self.pauses,
+            'errors': self.errors,
+        }
+
+
+def budget_from_env():
+    path = os.getenv('YELP_LIMIT_DB', os.getenv('YELP_CACHE_DB'))
+    rate = float(os.getenv('YELP_RATE_LIMIT', '50'))
+    burst = float(os.getenv('YELP_RATE_BURST', str(max(1.0, 2 * rate))))
+    max_wait = float(os.getenv('YELP_RATE_MAX_WAIT', '0.5'))
+    try:
+        return UpstreamBudget(rate, burst, path=path, max_wait=max_wait)
+    except sqlite3.Error as e:
+        print(f"❌ Could not open shared Yelp budget at {path}: {e}")
+        return UpstreamBudget(rate, burst, max_wait=max_wait)
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+# =========================
+# Wishlist Storage Format
+# =========================
+# users/{uid}/wishlist used to be an array of business ids that every add and
+# remove read, edited and wrote back whole. It is now a map
+# {business_id: added_at}, so each item is written on its own and concurrent
+# tabs cannot overwrite each other. Firebase hands arrays back as a list, or
+# as a dict of index keys once new-style items are mixed in, so both readers
+# below accept old, new and mixed data.
+
+# Characters Firebase does not allow in keys.
+INVALID_KEY_CHARS = set('.$#[]/')
+MAX_KEY_LENGTH = 768
+
+def valid_business_id(business_id):
+    return (isinstance(business_id, str) and 0 < len(business_id) <= MAX_KEY_LENGTH
+            and not INVALID_KEY_CHARS.intersection(business_id))
+
+def _entries(raw):
+    if isinstance(raw, list):
+        return [(str(index), value) for index, value in enumerate(raw) if value is not None]
+    if isinstance(raw, dict):
+        return list(raw.items())
+    return []
+
+def is_legacy(raw):
+    return any(isinstance(value, str) and key.isdigit() for key, value in _entries(raw))
+
+# Legacy items are older than anything added since the switch, so they are
+# dated just before the oldest dated item (or migrated_at), one microsecond
+# apart, keeping their array order (last appended = most recent).
+def to_wishlist_map(raw, migrated_at):
+    wishlist = {}
+    legacy = []
+    for key, value in _entries(raw):
+        if isinstance(value, str) and key.isdigit():
+            if valid_business_id(value) and value not in legacy:
+                legacy.append(value)
+        else:
+            wishlist[key] = value
+    anchor = migrated_at
+    for added_at in wishlist.values():
+        try:
+            anchor = min(anchor, datetime.fromisoformat(added_at))
+        except (TypeError, ValueError):
+            pass
+    for position, business_id in enumerate(reversed(legacy), start=1):
+        if business_id not in wishlist:
+            wishlist[business_id] = (anchor - timedelta(microseconds=position)).isoformat()
+    return wishlist
+
+# Business ids, most recently added first.
+def wishlist_ids(raw):
+    dated = {}
+    legacy = []
+    for key, value in _entries(raw):
+        if isinstance(value, str) and key.isdigit():
+            legacy.append(value)
+        else:
+            dated[key] = value if isinstance(value, str) else ''
+    ids = sorted(dated, key=lambda business_id: dated[business_id], reverse=True)
+    seen = set(ids)
+    for business_id in reversed(legacy):
+        if business_id not in seen:
+            seen.add(business_id)
+            ids.append(business_id)
+    return ids
@@ -0,0 +1,331 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from breaker import CircuitOpenError
+from upstream import priority_for
+
+try:
+    import httpx  # only needed by AsyncYelpClient (asgi.py)
+except ImportError:
+    httpx = None
+
+# =========================
+# Yelp Client Configuration
+# =========================
+# Point at yelp_stub.py (e.g. http://127.0.0.1:8765/v3) for offline load tests.
+YELP_API_BASE = os.getenv('YELP_API_BASE', 'https://api.yelp.com/v3').rstrip('/')
+DEFAULT_POOL_SIZE = int(os.getenv('YELP_POOL_SIZE', '20'))
+DEFAULT_CONNECT_TIMEOUT = float(os.getenv('YELP_CONNECT_TIMEOUT', '3.05'))
+DEFAULT_READ_TIMEOUT = float(os.getenv('YELP_READ_TIMEOUT', '10'))
+DEFAULT_MAX_RETRIES = int(os.getenv('YELP_MAX_RETRIES', '2'))
+DEFAULT_BACKOFF_FACTOR = float(os.getenv('YELP_BACKOFF_FACTOR', '0.3'))
+# Upper bound on how long a single Retry-After is honoured, so a long
+# server-side back-off turns into an error instead of a stuck worker.
+DEFAULT_RETRY_AFTER_MAX = float(os.getenv('YELP_RETRY_AFTER_MAX', '5'))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Upstream calls one asgi.py process may keep in flight at once.
+DEFAULT_ASYNC_CONNECTIONS = int(os.getenv('YELP_ASYNC_CONNECTIONS', '200'))
+
+
+# Raised instead of calling Yelp when the shared budget (upstream.py) sheds
+# the call; callers treat it like any other failed request.
+class UpstreamBudgetExceeded(requests.exceptions.RequestException):
+    pass
+
+
+class _CappedRetry(Retry):
+    retry_after_max = DEFAULT_RETRY_AFTER_MAX
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, self.retry_after_max)
+
+    def new(self, **kw):
+        new_retry = super().new(**kw)
+        new_retry.retry_after_max = self.retry_after_max
+        return new_retry
+
+
+# =========================
+# Per-Endpoint Stats
+# =========================
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_status = None
+
+    def record(self, elapsed_ms, status=None, error=False):
+        self.requests += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.last_status = status
+        if error:
+            self.errors += 1
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'avg_ms': round(self.total_ms / self.requests, 2) if self.requests else 0.0,
+            'max_ms': round(self.max_ms, 2),
+            'last_status': self.last_status,
+        }
+
+
+# =========================
+# Pooled Yelp HTTP Client
+# =========================
+class YelpClient:
+    def __init__(self, api_key, base_url=YELP_API_BASE, pool_size=DEFAULT_POOL_SIZE,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR,
+                 retry_after_max=DEFAULT_RETRY_AFTER_MAX):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.retry_after_max = retry_after_max
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        # Optional callable(endpoint, seconds, status, error), e.g. for metrics.
+        self.observer = None
+        # Latest RateLimit-* headers from Yelp; see note_quota().
+        self.quota = {}
+        # Optional upstream.UpstreamBudget every call must get past first.
+        self.limiter = None
+        # Optional breaker.CircuitBreaker: while it is open calls fail at once.
+        self.breaker = None
+
+        retry = _CappedRetry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            status=max_retries,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(['GET']),
+            backoff_factor=backoff_factor,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        retry.retry_after_max = retry_after_max
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry, pool_block=False)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Authorization': f'Bearer {api_key}',
+            'Accept': 'application/json',
+        })
+
+    # Routes still inspect status codes and call raise_for_status()
+    # themselves, so every helper hands back the raw response.
+    def get(self, endpoint, path, params=None):
+        self.check_upstream(endpoint)
+        start = time.perf_counter()
+        noted = False
+        try:
+            try:
+                response = self.session.get(f'{self.base_url}/{path.lstrip("/")}',
+                                            params=params, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                self._record(endpoint, start, error=True)
+                noted = self.note_outcome(start, error=e)
+                raise
+            self._record(endpoint, start, status=response.status_code,
+                         error=response.status_code >= 400)
+            noted = self.note_outcome(start, response.status_code)
+        finally:
+            if not noted:
+                self.release_upstream()
+        self.note_response(response.status_code, response.headers,
+                           response.text if response.status_code == 429 else '')
+        return response
+
+    def search(self, params):
+        return self.get('search', 'businesses/search', params=params)
+
+    def business(self, business_id):
+        return self.get('business', f'businesses/{business_id}')
+
+    def reviews(self, business_id):
+        return self.get('reviews', f'businesses/{business_id}/reviews')
+
+    def autocomplete(self, params):
+        return self.get('autocomplete', 'autocomplete', params=params)
+
+    def _record(self, endpoint, start, status=None, error=False):
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._stats_lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = EndpointStats()
+            stats.record(elapsed_ms, status=status, error=error)
+        if self.observer is not None:
+            self.observer(endpoint, elapsed_ms / 1000, status, error)
+
+    def check_budget(self, endpoint, wait=True):
+        if self.limiter is not None and not self.limiter.acquire(priority_for(endpoint), wait=wait):
+            self._record(endpoint, time.perf_counter(), status='shed', error=True)
+            raise UpstreamBudgetExceeded(f"Yelp call budget exhausted; {endpoint} request shed")
+
+    # The breaker first, so calls it rejects don't use up the budget.
+    def check_upstream(self, endpoint, wait=True):
+        if self.breaker is not None and not self.breaker.allow():
+            self._record(endpoint, time.perf_counter(), status='circuit_open', error=True)
+            raise CircuitOpenError(f"Yelp is unavailable (circuit open); {endpoint} request not attempted")
+        try:
+            self.check_budget(endpoint, wait=wait)
+        except UpstreamBudgetExceeded:
+            if self.breaker is not None:
+                self.breaker.cancel()
+            raise
+
+    # 5xx answers and transport errors count against the breaker; 4xx
+    # (including 429, which the budget handles) mean Yelp is up. True once
+    # the outcome is recorded.
+    def note_outcome(self, start, status=None, error=None):
+        if self.breaker is None:
+            return True
+        if error is None and status is not None and status >= 500:
+            error = requests.exceptions.HTTPError(f"Yelp returned {status}")
+        self.breaker.record(time.perf_counter() - start, error)
+        return True
+
+    # A call that passed check_upstream but ended without an outcome (an
+    # unexpected exception, a cancelled task) hands back its half-open
+    # trial slot; otherwise the breaker would reject calls for good.
+    def release_upstream(self):
+        if self.breaker is not None:
+            self.breaker.cancel()
+
+    def note_response(self, status, headers, body=''):
+        self.note_quota(headers)
+        if self.limiter is not None:
+            self.limiter.note_response(status, headers, body)
+
+    # Yelp reports the daily call allowance on every response.
+    def note_quota(self, headers):
+        remaining = headers.get('RateLimit-Remaining')
+        if remaining is None:
+            return
+        try:
+            quota = {'remaining': int(float(remaining)), 'updated': time.time()}
+            if headers.get('RateLimit-DailyLimit'):
+                quota['daily_limit'] = int(float(headers['RateLimit-DailyLimit']))
+        except ValueError:
+            return
+        if headers.get('RateLimit-ResetTime'):
+            quota['reset_time'] = headers['RateLimit-ResetTime']
+        self.quota = quota
+
+    def stats(self):
+        with self._stats_lock:
+            return {endpoint: stats.as_dict() for endpoint, stats in self._stats.items()}
+
+
+# =========================
+# Async Yelp HTTP Client
+# =========================
+# Non-blocking twin of YelpClient for asgi.py. It takes its settings from a
+# YelpClient and records into that client's stats (and so /metrics); retries
+# follow the same rules: connect errors and RETRY_STATUSES, exponential
+# back-off, Retry-After honoured up to retry_after_max. The call budget
+# check and quota bookkeeping can wait on the shared SQLite file, so they
+# run on executor (None: the loop's default) rather than on the loop.
+class AsyncYelpClient:
+    def __init__(self, client, max_connections=DEFAULT_ASYNC_CONNECTIONS, executor=None):
+        if httpx is None:
+            raise RuntimeError("AsyncYelpClient needs httpx (pip install httpx)")
+        self.client = client
+        self.executor = executor
+        connect_timeout, read_timeout = client.timeout
+        self.session = httpx.AsyncClient(
+            headers={
+                'Authorization': f'Bearer {client.api_key}',
+                'Accept': 'application/json',
+            },
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections),
+        )
+
+    def _backoff(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.client.retry_after_max)
+        # Same schedule as urllib3: no wait before the first retry, then doubling.
+        return 0 if attempt == 0 else self.client.backoff_factor * (2 ** attempt)
+
+    # A shed call fails at once rather than holding up the event loop.
+    async def get(self, endpoint, path, params=None):
+        loop = asyncio.get_running_loop()
+        check = loop.run_in_executor(self.executor, functools.partial(self.client.check_upstream, endpoint, wait=False))
+        try:
+            await asyncio.shield(check)
+        except asyncio.CancelledError:
+            # The check still finishes on the executor; give back whatever slot it takes.
+            check.add_done_callback(
+                lambda done: done.cancelled() or done.exception() or self.client.release_upstream())
+            raise
+        start = time.perf_counter()
+        url = f'{self.client.base_url}/{path.lstrip("/")}'
+        attempt = 0
+        noted = False
+        try:
+            while True:
+                try:
+                    response = await self.session.get(url, params=params)
+                except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                    if attempt >= self.client.max_retries:
+                        self.client._record(endpoint, start, error=True)
+                        noted = self.client.note_outcome(start, error=e)
+                        raise
+                    await asyncio.sleep(self._backoff(attempt))
+                    attempt += 1
+                    continue
+                except httpx.HTTPError as e:
+                    self.client._record(endpoint, start, error=True)
+                    noted = self.client.note_outcome(start, error=e)
+                    raise
+                if response.status_code not in RETRY_STATUSES or attempt >= self.client.max_retries:
+                    break
+                await asyncio.sleep(self._backoff(attempt, response))
+                attempt += 1
+            self.client._record(endpoint, start, status=response.status_code,
+                                error=response.status_code >= 400)
+            noted = self.client.note_outcome(start, response.status_code)
+        finally:
+            if not noted:
+                self.client.release_upstream()
+        await loop.run_in_executor(self.executor, self.client.note_response, response.status_code,
+                                   response.headers, response.text if response.status_code == 429 else '')
+        return response
+
+    async def search(self, params):
+        return await self.get('search', 'businesses/search', params=params)
+
+    async def business(self, business_id):
+        return await self.get('business', f'businesses/{business_id}')
+
+    async def reviews(self, business_id):
+        return await self.get('reviews', f'businesses/{business_id}/reviews')
+
+    async def autocomplete(self, params):
+        return await self.get('autocomplete', 'autocomplete', params=params)
+
+    async def aclose(self):
+        await self.session.aclose()
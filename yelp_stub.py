@@ -0,0 +1,365 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+
+import requests
+
+# =========================
+# Yelp Replay Stub
+# =========================
+# Local stand-in for https://api.yelp.com/v3 so the app can be load tested
+# without spending Yelp quota. Point the app at it with
+#
+#   YELP_API_BASE=http://127.0.0.1:8765/v3 python app.py
+#
+# Responses come from recorded fixtures when one matches the request,
+# otherwise they are generated deterministically from the request, so any
+# business id or search returns a stable, well-formed answer:
+#
+#   fixtures/yelp/businesses/{id}.json          GET /businesses/{id}
+#   fixtures/yelp/reviews/{id}.json             GET /businesses/{id}/reviews
+#   fixtures/yelp/search/{request_key}.json     GET /businesses/search
+#   fixtures/yelp/autocomplete/{request_key}.json  GET /autocomplete
+#
+# request_key is a hash of the sorted query string (see request_key()).
+# --record forwards unmatched requests to the real API (YELP_API_KEY) and
+# saves the answers as new fixtures.
+#
+# Latency and failures can be injected from the command line or changed while
+# running with POST /__stub/config; GET /__stub/stats returns call counts.
+# With daily_limit set, responses carry Yelp's RateLimit-* headers and calls
+# past the limit get Yelp's 429 ACCESS_LIMIT_REACHED.
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'yelp')
+DEFAULT_CENTER = (37.7749, -122.4194)
+CATEGORIES = [('pizza', 'Pizza'), ('sushi', 'Sushi Bars'), ('mexican', 'Mexican'), ('italian', 'Italian'),
+              ('thai', 'Thai'), ('cafes', 'Cafes'), ('burgers', 'Burgers'), ('indpak', 'Indian')]
+ROUTES = [
+    ('search', re.compile(r'^/v3/businesses/search$')),
+    ('autocomplete', re.compile(r'^/v3/autocomplete$')),
+    ('reviews', re.compile(r'^/v3/businesses/(?P<id>[^/]+)/reviews$')),
+    ('businesses', re.compile(r'^/v3/businesses/(?P<id>[^/]+)$')),
+]
+
+
+def request_key(params):
+    query = '&'.join(f'{key}={value}' for key, value in sorted(params.items()))
+    return hashlib.sha1(query.encode('utf-8')).hexdigest()[:16]
+
+
+def _rng(*parts):
+    return random.Random(hashlib.sha1('|'.join(map(str, parts)).encode('utf-8')).hexdigest())
+
+
+# =========================
+# Generated Responses
+# =========================
+def make_business(business_id, latitude=None, longitude=None):
+    rng = _rng('business', business_id)
+    if latitude is None or longitude is None:
+        latitude = DEFAULT_CENTER[0] + rng.uniform(-0.05, 0.05)
+        longitude = DEFAULT_CENTER[1] + rng.uniform(-0.05, 0.05)
+    alias, title = rng.choice(CATEGORIES)
+    name = f"{title} {business_id[-6:].title()}"
+    street = f"{rng.randint(1, 2999)} {rng.choice(['Market', 'Mission', 'Valencia', 'Geary', 'Castro'])} St"
+    return {
+        'id': business_id,
+        'alias': business_id,
+        'name': name,
+        'image_url': '',
+        'is_closed': False,
+        'url': f'https://www.yelp.com/biz/{business_id}',
+        'review_count': rng.randint(5, 2500),
+        'categories': [{'alias': alias, 'title': title}],
+        'rating': rng.choice([3.0, 3.5, 4.0, 4.5, 5.0]),
+        'coordinates': {'latitude': round(latitude, 6), 'longitude': round(longitude, 6)},
+        'transactions': ['pickup', 'delivery'],
+        'price': '$' * rng.randint(1, 4),
+        'location': {'address1': street, 'address2': '', 'address3': '', 'city': 'San Francisco',
+                     'zip_code': '94103', 'country': 'US', 'state': 'CA',
+                     'display_address': [street, 'San Francisco, CA 94103']},
+        'phone': '+14155550100',
+        'display_phone': '(415) 555-0100',
+        'photos': [],
+        'hours': [{'open': [{'is_overnight': False, 'start': '1100', 'end': '2200', 'day': day}
+                            for day in range(7)],
+                   'hours_type': 'REGULAR', 'is_open_now': True}],
+    }
+
+
+def make_search(params):
+    limit = min(int(params.get('limit', 20) or 20), 50)
+    offset = int(params.get('offset', 0) or 0)
+    total = 240
+    key = request_key({k: v for k, v in params.items() if k not in ('limit', 'offset')})
+    center = DEFAULT_CENTER
+    if params.get('latitude') and params.get('longitude'):
+        center = (float(params['latitude']), float(params['longitude']))
+    # Spread results over roughly the requested radius around the centre.
+    spread = min(float(params.get('radius', 5000) or 5000), 40000) / 111000.0
+    businesses = []
+    for index in range(offset, min(offset + limit, total)):
+        business_id = f'stub-{key[:8]}-{index}'
+        rng = _rng('position', business_id)
+        business = make_business(business_id, center[0] + rng.uniform(-spread, spread) * 0.7,
+                                  center[1] + rng.uniform(-spread, spread) * 0.7)
+        business['distance'] = round(rng.uniform(50, spread * 111000.0), 1)
+        businesses.append(business)
+    return {'businesses': businesses, 'total': total,
+            'region': {'center': {'latitude': center[0], 'longitude': center[1]}}}
+
+
+def make_reviews(business_id):
+    rng = _rng('reviews', business_id)
+    reviews = [{
+        'id': f'{business_id}-r{index}',
+        'url': f'https://www.yelp.com/biz/{business_id}?hrid=r{index}',
+        'text': rng.choice(['Great food and friendly staff.', 'Solid spot, a bit of a wait.',
+                            'Would come back for the desserts.', 'Portions were generous.']),
+        'rating': rng.randint(2, 5),
+        'time_created': f'2024-0{rng.randint(1, 9)}-1{rng.randint(0, 9)} 19:2{index}:00',
+        'user': {'id': f'u{index}', 'name': rng.choice(['Alex P.', 'Sam K.', 'Jordan L.', 'Riley M.'])},
+    } for index in range(3)]
+    return {'reviews': reviews, 'total': len(reviews), 'possible_languages': ['en']}
+
+
+def make_autocomplete(params):
+    text = params.get('text', '')
+    return {
+        'terms': [{'text': text + suffix} for suffix in (' delivery', ' near me', ' takeout')],
+        'businesses': [],
+        'categories': [{'alias': alias, 'title': title} for alias, title in CATEGORIES
+                       if title.lower().startswith(text.lower())],
+    }
+
+
+# =========================
+# Stub State
+# =========================
+class StubState:
+    def __init__(self, fixtures_dir=FIXTURES_DIR, latency_ms=0, jitter_ms=0, error_rate=0.0,
+                 error_status=503, timeout_rate=0.0, timeout_s=30.0, daily_limit=None, record_upstream=None,
+                 api_key=None):
+        self.fixtures_dir = fixtures_dir
+        self.record_upstream = record_upstream
+        self.api_key = api_key
+        self.config = {
+            'latency_ms': latency_ms,
+            'jitter_ms': jitter_ms,
+            'error_rate': error_rate,
+            'error_status': error_status,
+            'timeout_rate': timeout_rate,
+            'timeout_s': timeout_s,
+            'daily_limit': daily_limit,
+            # Per-endpoint overrides, e.g. {"reviews": {"latency_ms": 400}}
+            'endpoints': {},
+        }
+        self.calls = {}
+        self.fixture_hits = 0
+        self.generated = 0
+        self.injected_errors = 0
+        self.injected_timeouts = 0
+        self.quota_used = 0
+        self._lock = threading.Lock()
+
+    def setting(self, endpoint, name):
+        with self._lock:
+            return self.config['endpoints'].get(endpoint, {}).get(name, self.config[name])
+
+    def update(self, changes):
+        with self._lock:
+            for name, value in changes.items():
+                if name == 'endpoints':
+                    for endpoint, overrides in value.items():
+                        self.config['endpoints'].setdefault(endpoint, {}).update(overrides)
+                elif name in self.config:
+                    self.config[name] = value
+            return json.loads(json.dumps(self.config))
+
+    def count(self, endpoint, field='calls'):
+        with self._lock:
+            if field == 'calls':
+                self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            else:
+                setattr(self, field, getattr(self, field) + 1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': dict(self.calls),
+                'total_calls': sum(self.calls.values()),
+                'fixture_hits': self.fixture_hits,
+                'generated': self.generated,
+                'injected_errors': self.injected_errors,
+                'injected_timeouts': self.injected_timeouts,
+                'quota_used': self.quota_used,
+                'config': json.loads(json.dumps(self.config)),
+            }
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+            self.fixture_hits = self.generated = self.injected_errors = self.injected_timeouts = 0
+            self.quota_used = 0
+
+    # Returns the RateLimit-* headers for one more call, or None if unlimited;
+    # remaining is negative once the limit has been used up.
+    def use_quota(self):
+        with self._lock:
+            limit = self.config['daily_limit']
+            if limit is None:
+                return None
+            self.quota_used += 1
+            remaining = limit - self.quota_used
+        reset_at = time.gmtime(time.time() // 86400 * 86400 + 86400)
+        return {'RateLimit-DailyLimit': str(limit), 'RateLimit-Remaining': str(max(remaining, 0)),
+                'RateLimit-ResetTime': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', reset_at),
+                'exhausted': remaining < 0}
+
+    def fixture_path(self, endpoint, name):
+        safe = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+        return os.path.join(self.fixtures_dir, endpoint, f'{safe}.json')
+
+    def load_fixture(self, endpoint, name):
+        try:
+            with open(self.fixture_path(endpoint, name), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_fixture(self, endpoint, name, body):
+        path = self.fixture_path(endpoint, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(body, f, indent=2)
+
+    def record(self, path, params):
+        response = requests.get(f'{self.record_upstream.rstrip("/")}{path[len("/v3"):]}', params=params,
+                                headers={'Authorization': f'Bearer {self.api_key}'}, timeout=15)
+        return response.status_code, response.json()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+    quota_headers = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.quota_headers = None
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        if url.path == '/__stub/stats':
+            return self._send(200, self.state.stats())
+        for endpoint, pattern in ROUTES:
+            match = pattern.match(url.path)
+            if match:
+                return self._serve(endpoint, match.groupdict().get('id'), url.path, params)
+        self._send(404, {'error': {'code': 'NOT_FOUND', 'description': 'Unknown stub path'}})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if url.path == '/__stub/config':
+            return self._send(200, self.state.update(body))
+        if url.path == '/__stub/reset':
+            self.state.reset()
+            return self._send(200, self.state.stats())
+        self._send(404, {'error': {'code': 'NOT_FOUND', 'description': 'Unknown stub path'}})
+
+    def _serve(self, endpoint, business_id, path, params):
+        state = self.state
+        state.count(endpoint)
+        self.quota_headers = state.use_quota()
+        if self.quota_headers and self.quota_headers.pop('exhausted'):
+            return self._send(429, {'error': {'code': 'ACCESS_LIMIT_REACHED',
+                                              'description': 'You have reached the daily limit'}})
+        delay_ms = state.setting(endpoint, 'latency_ms') + random.uniform(0, state.setting(endpoint, 'jitter_ms'))
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000.0)
+        if random.random() < state.setting(endpoint, 'timeout_rate'):
+            state.count(endpoint, 'injected_timeouts')
+            time.sleep(state.setting(endpoint, 'timeout_s'))
+        if random.random() < state.setting(endpoint, 'error_rate'):
+            state.count(endpoint, 'injected_errors')
+            status = state.setting(endpoint, 'error_status')
+            headers = {'Retry-After': '1'} if status == 429 else {}
+            return self._send(status, {'error': {'code': 'STUB_INJECTED', 'description': 'Injected failure'}},
+                              headers)
+
+        fixture_name = business_id if business_id else request_key(params)
+        body = state.load_fixture(endpoint, fixture_name)
+        if body is not None:
+            state.count(endpoint, 'fixture_hits')
+            return self._send(200, body)
+        if state.record_upstream:
+            status, body = state.record(path, params)
+            if status == 200:
+                state.save_fixture(endpoint, fixture_name, body)
+            return self._send(status, body)
+
+        state.count(endpoint, 'generated')
+        if endpoint == 'search':
+            body = make_search(params)
+        elif endpoint == 'autocomplete':
+            body = make_autocomplete(params)
+        elif endpoint == 'reviews':
+            body = make_reviews(business_id)
+        else:
+            body = make_business(business_id)
+        self._send(200, body)
+
+    def _send(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in dict(self.quota_headers or {}, **(headers or {})).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_stub(host='127.0.0.1', port=8765, **settings):
+    handler = type('BoundStubHandler', (StubHandler,), {'state': StubState(**settings)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='yelp-stub', daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay Yelp Fusion API responses locally.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fixtures', default=FIXTURES_DIR, help="Fixture directory")
+    parser.add_argument('--latency-ms', type=float, default=0, help="Added to every response")
+    parser.add_argument('--jitter-ms', type=float, default=0, help="Random extra latency, 0..N ms")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument('--error-status', type=int, default=503, help="Status code for injected failures")
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help="Fraction of requests that hang")
+    parser.add_argument('--timeout-s', type=float, default=30.0, help="How long hanging requests hang")
+    parser.add_argument('--daily-limit', type=int, default=None,
+                        help="Simulate Yelp's daily quota (RateLimit-* headers, 429 once used up)")
+    parser.add_argument('--record', metavar='UPSTREAM', nargs='?', const='https://api.yelp.com/v3',
+                        help="Forward unmatched requests upstream and save them as fixtures")
+    args = parser.parse_args()
+    server = start_stub(args.host, args.port, fixtures_dir=args.fixtures, latency_ms=args.latency_ms,
+                        jitter_ms=args.jitter_ms, error_rate=args.error_rate, error_status=args.error_status,
+                        timeout_rate=args.timeout_rate, timeout_s=args.timeout_s,
+                        daily_limit=args.daily_limit, record_upstream=args.record, api_key=os.getenv('YELP_API_KEY'))
+    print(f"🍽️ Yelp stub listening on http://{args.host}:{args.port}/v3 (fixtures: {args.fixtures})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()